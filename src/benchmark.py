@@ -0,0 +1,437 @@
+#!/usr/bin/python
+"""
+Microbenchmarks of the parts of the engine run once per event or once per pass
+of the main loop.
+
+Each benchmark builds its scenario in a temporary directory, with Shotgun
+connections that never reach the network, and reports the number of
+operations per second along with the number of objects each operation
+retains, those still tracked by the garbage collector once a run returned.
+Objects allocated and freed during a run are not counted, the figure shows
+leaks and growing caches rather than allocation costs. The results can be
+saved as a baseline later runs are compared to:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json
+
+The comparison exits with a status of 1 when a benchmark is slower than its
+baseline by more than the tolerance or retains more objects per operation.
+"""
+
+import datetime
+import gc
+import json
+import logging
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import shotgunEventDaemon
+
+
+CONFIG = """[daemon]
+pidFile: %(dir)s/shotgunEventDaemon.pid
+eventIdFile: %(dir)s/shotgunEventDaemon.id
+stateBackend: %(backend)s
+logMode: 0
+logPath: %(dir)s
+logFile: shotgunEventDaemon
+logging: 20
+conn_retry_sleep = 60
+max_conn_retries = 5
+fetch_interval = 5
+prefetch_depth = 0
+
+[shotgun]
+server: https://benchmark.shotgunstudio.com
+name: benchmark
+key: 0123456789abcdef0123456789abcdef01234567
+use_session_uuid: False
+
+[plugins]
+paths: %(pluginPath)s
+
+[emails]
+server:
+from:
+to:
+subject: [SG]
+"""
+
+PLUGIN = """
+def registerCallbacks(reg):
+    matchEvents = {
+        'Shotgun_Task_Change': ['sg_status_list'],
+        'Shotgun_Version_Change': ['description', 'sg_status_list'],
+        '*': ['sg_cut_in', 'sg_cut_out'],
+    }
+    reg.registerCallback('benchmark', '0123456789abcdef0123456789abcdef01234567', process, matchEvents)
+
+def process(sg, logger, event, args):
+    pass
+"""
+
+EVENT_TYPES = [
+    ('Shotgun_Task_Change', 'sg_status_list'),
+    ('Shotgun_Task_Change', 'content'),
+    ('Shotgun_Version_Change', 'description'),
+    ('Shotgun_Version_Change', 'sg_path_to_frames'),
+    ('Shotgun_Shot_Change', 'sg_cut_in'),
+    ('Shotgun_Shot_Change', 'description'),
+    ('Shotgun_Note_New', None),
+    ('Shotgun_Attachment_Retirement', 'retirement_date'),
+]
+
+# Minimum number of seconds of a timed round.
+MIN_ROUND_TIME = 0.2
+
+
+class OfflineShotgun(object):
+    """
+    Stands for the Shotgun connections of the engine during the benchmarks.
+    """
+
+    def __init__(self, base_url, script_name, api_key, **kwargs):
+        self.base_url = base_url
+
+    def set_session_uuid(self, session_uuid):
+        pass
+
+    def find(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, **kwargs):
+        return []
+
+    def find_one(self, entity_type, filters, fields=None, order=None, **kwargs):
+        return {'type': entity_type, 'id': 1}
+
+
+class Scenario(object):
+    """
+    A temporary directory holding plugin files and the config of an engine
+    loading them.
+    """
+
+    def __init__(self, pluginCount, backend='pickle'):
+        self.path = tempfile.mkdtemp(prefix='shotgunEventBenchmark')
+        pluginPath = os.path.join(self.path, 'plugins')
+        os.mkdir(pluginPath)
+        for i in range(pluginCount):
+            fh = open(os.path.join(pluginPath, 'plugin%03d.py' % i), 'w')
+            fh.write(PLUGIN)
+            fh.close()
+
+        configPath = os.path.join(self.path, 'shotgunEventDaemon.conf')
+        fh = open(configPath, 'w')
+        fh.write(CONFIG % {'dir': self.path, 'backend': backend, 'pluginPath': pluginPath})
+        fh.close()
+
+        connection = shotgunEventDaemon.sg.Shotgun
+        stdout = sys.stdout
+        shotgunEventDaemon.sg.Shotgun = OfflineShotgun
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            self.engine = shotgunEventDaemon.Engine(configPath)
+            self.site = self.engine.getSites()[0]
+            self.site.loadPlugins()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            shotgunEventDaemon.sg.Shotgun = connection
+
+        self.collection = self.site._pluginCollections[0]
+        self.plugins = list(self.collection)
+
+    def close(self):
+        self.site.stop()
+        logger = logging.getLogger()
+        for handler in logger.handlers[:]:
+            if isinstance(handler, logging.FileHandler):
+                logger.removeHandler(handler)
+                handler.close()
+        shutil.rmtree(self.path, True)
+
+
+def makeEvents(count, firstId=1):
+    """
+    @return: Events of the types plugins usually listen to, and some others.
+    @rtype: I{list} of Shotgun event dictionaries.
+    """
+    events = []
+    created = datetime.datetime(2020, 1, 1)
+    for i in range(count):
+        eventType, attributeName = EVENT_TYPES[i % len(EVENT_TYPES)]
+        entityType = eventType.split('_')[1]
+        events.append({
+            'type': 'EventLogEntry',
+            'id': firstId + i,
+            'event_type': eventType,
+            'attribute_name': attributeName,
+            'meta': {'type': 'attribute_change', 'old_value': 'ip', 'new_value': 'fin'},
+            'entity': {'type': entityType, 'id': 1000 + i % 97},
+            'user': {'type': 'HumanUser', 'id': 1 + i % 13, 'name': 'Artist'},
+            'project': {'type': 'Project', 'id': 65 + i % 3},
+            'session_uuid': None,
+            'created_at': created + datetime.timedelta(seconds=i),
+        })
+    return events
+
+
+def makeBacklog(lastEventId, size):
+    expiration = datetime.datetime.now() + datetime.timedelta(days=1)
+    return dict([(lastEventId - 2 * i, expiration) for i in range(1, size + 1)])
+
+
+def benchCanProcess(scenarios):
+    """
+    Callback.canProcess against the filter of a typical plugin.
+    """
+    callback = scenarios.get(1).plugins[0]._callbacks[0]
+    events = makeEvents(1000)
+
+    def run():
+        for event in events:
+            callback.canProcess(event)
+    return run, len(events)
+
+
+def benchNextUnprocessedEventId(scenarios):
+    """
+    Plugin.getNextUnprocessedEventId with a backlog of 5000 ids.
+    """
+    plugin = scenarios.get(1).plugins[0]
+    plugin.setState((1000000, makeBacklog(1000000, 5000)))
+
+    def run():
+        plugin.getNextUnprocessedEventId()
+    return run, 1
+
+
+def benchUpdateLastEventId(scenarios):
+    """
+    Plugin._updateLastEventId with a backlog of 5000 ids, one id in 50
+    skipped.
+    """
+    plugin = scenarios.get(1).plugins[0]
+    plugin.setState((1000000, makeBacklog(1000000, 5000)))
+    eventIds = [i for i in range(1000001, 1001001) if i % 50]
+
+    def run():
+        plugin.setState((1000000, plugin.getState()[1]))
+        for eventId in eventIds:
+            plugin._updateLastEventId(eventId)
+        backlog = plugin.getState()[1]
+        for eventId in range(1000050, 1001000, 50):
+            del(backlog[eventId])
+    return run, len(eventIds)
+
+
+def _benchSave(scenario):
+    for i, plugin in enumerate(scenario.plugins):
+        plugin.setState((1000000 + i, makeBacklog(1000000 + i, 20)))
+    scenario.site.saveEventIdData()
+
+    def run():
+        for plugin in scenario.plugins:
+            plugin.setStateChanged(True)
+        scenario.site.saveEventIdData()
+    return run, 1
+
+
+def benchSavePickle(scenarios):
+    """
+    Site.saveEventIdData of 300 plugins with the pickle backend.
+    """
+    return _benchSave(scenarios.get(300, 'pickle'))
+
+
+def benchSaveSqlite(scenarios):
+    """
+    Site.saveEventIdData of 300 plugins with the sqlite backend.
+    """
+    return _benchSave(scenarios.get(300, 'sqlite'))
+
+
+def _benchLoad(scenario):
+    _benchSave(scenario)[0]()
+
+    def run():
+        scenario.site._stateStore = None
+        scenario.site.loadEventIdData()
+    return run, 1
+
+
+def benchLoadPickle(scenarios):
+    """
+    Site.loadEventIdData of 300 plugins with the pickle backend.
+    """
+    return _benchLoad(scenarios.get(300, 'pickle'))
+
+
+def benchLoadSqlite(scenarios):
+    """
+    Site.loadEventIdData of 300 plugins with the sqlite backend.
+    """
+    return _benchLoad(scenarios.get(300, 'sqlite'))
+
+
+def benchCollectionLoad(scenarios):
+    """
+    PluginCollection.load over 200 unchanged plugin files.
+    """
+    collection = scenarios.get(200).collection
+
+    def run():
+        collection.load()
+    return run, 1
+
+
+BENCHMARKS = [
+    ('callback.canProcess', benchCanProcess),
+    ('plugin.getNextUnprocessedEventId', benchNextUnprocessedEventId),
+    ('plugin.updateLastEventId', benchUpdateLastEventId),
+    ('state.save.pickle', benchSavePickle),
+    ('state.save.sqlite', benchSaveSqlite),
+    ('state.load.pickle', benchLoadPickle),
+    ('state.load.sqlite', benchLoadSqlite),
+    ('collection.load', benchCollectionLoad),
+]
+
+
+class Scenarios(object):
+    """
+    The scenarios built for a run, shared by the benchmarks.
+    """
+
+    def __init__(self):
+        self._scenarios = {}
+
+    def get(self, pluginCount, backend='pickle'):
+        key = (pluginCount, backend)
+        if key not in self._scenarios:
+            self._scenarios[key] = Scenario(pluginCount, backend)
+        return self._scenarios[key]
+
+    def close(self):
+        for scenario in self._scenarios.values():
+            scenario.close()
+        self._scenarios = {}
+
+
+def measure(run, count, rounds):
+    """
+    Time a benchmark.
+
+    @param run: Runs I{count} operations.
+    @type run: A function object.
+    @param count: The number of operations of a run.
+    @type count: I{int}
+    @param rounds: The number of timed rounds, the best one is reported.
+    @type rounds: I{int}
+
+    @return: The operations per second and the number of objects retained
+        by each operation.
+    @rtype: I{tuple}
+    """
+    # Warm up and find how many runs fill a round.
+    runs = 1
+    while True:
+        start = time.time()
+        for i in xrange(runs):
+            run()
+        elapsed = time.time() - start
+        if elapsed >= MIN_ROUND_TIME:
+            break
+        runs *= 2
+
+    gc.collect()
+    gc.disable()
+    try:
+        best = None
+        for i in range(rounds):
+            start = time.time()
+            for j in xrange(runs):
+                run()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        # Objects tracked by the garbage collector that a run leaves behind.
+        before = len(gc.get_objects())
+        run()
+        retained = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+
+    return runs * count / best, max(retained, 0) / float(count)
+
+
+def compare(results, baseline, tolerance):
+    """
+    @return: The names of the benchmarks that regressed from the baseline.
+    @rtype: I{list} of I{str}
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result['ops'] < reference['ops'] * (1 - tolerance):
+            regressions.append(name)
+        elif 'retained' in reference and result['retained'] > reference['retained'] + 0.01:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--baseline', help='Compare the results to the ones saved in this file.')
+    parser.add_option('--save', help='Save the results to this file.')
+    parser.add_option('--rounds', type='int', default=5, help='Number of timed rounds per benchmark. [default: %default]')
+    parser.add_option('--tolerance', type='float', default=0.2, help='Fraction of the baseline speed a benchmark can lose. [default: %default]')
+    options, names = parser.parse_args()
+
+    baseline = {}
+    if options.baseline:
+        fh = open(options.baseline)
+        try:
+            baseline = json.load(fh)
+        finally:
+            fh.close()
+
+    results = {}
+    scenarios = Scenarios()
+    try:
+        for name, bench in BENCHMARKS:
+            if names and name not in names:
+                continue
+
+            run, count = bench(scenarios)
+            ops, retained = measure(run, count, options.rounds)
+            results[name] = {'ops': ops, 'retained': retained}
+
+            line = '%-36s %14.1f ops/s %8.2f retained/op' % (name, ops, retained)
+            reference = baseline.get(name)
+            if reference is not None:
+                line += ' %+7.1f%%' % ((ops / reference['ops'] - 1) * 100)
+            print line
+    finally:
+        scenarios.close()
+
+    if options.save:
+        fh = open(options.save, 'w')
+        try:
+            json.dump(results, fh, indent=4, sort_keys=True)
+        finally:
+            fh.close()
+
+    regressions = compare(results, baseline, options.tolerance)
+    if regressions:
+        print 'Regressions: %s' % ', '.join(sorted(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
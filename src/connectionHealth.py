@@ -0,0 +1,198 @@
+"""
+Tracks whether a Shotgun site answers, for all the connections to it.
+
+Every request reports its outcome. After a number of consecutive failures the
+circuit opens: requests wait instead of hitting a server that is down, and a
+single lightweight probe request is sent once the backoff elapsed. The backoff
+doubles after each failed probe, up to a maximum, and is jittered so daemons
+and sites don't probe in step. As soon as a probe succeeds the circuit closes
+and the waiting requests go through. Until one of them succeeds too, the
+first failure opens the circuit again with a longer backoff, in case the
+server answers the probes but not the real requests. Once stopped, requests
+no longer wait so the daemon can shut down during an outage.
+"""
+
+import random
+import threading
+import time
+
+
+class ConnectionHealth(object):
+    """
+    A circuit breaker shared by the connections to a site.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, log, failureThreshold=5, minDelay=1.0, maxDelay=60.0, probe=None, metrics=None):
+        """
+        @param log: The logger the state changes are reported to.
+        @type log: I{logging.Logger}
+        @param failureThreshold: The number of consecutive failures opening
+            the circuit.
+        @type failureThreshold: I{int}
+        @param minDelay: The seconds to wait before the first probe.
+        @type minDelay: I{float}
+        @param maxDelay: The maximum seconds between two probes.
+        @type maxDelay: I{float}
+        @param probe: Makes a lightweight request, raising if it fails. When
+            None, the first request waiting is sent as the probe.
+        @type probe: A I{callable}
+        @param metrics: Gets the I{failures}, I{opened} and I{probes} counts
+            and the I{state} of the circuit, prefixed by I{health}.
+        @type metrics: An object with I{increment} and I{setValue} methods.
+        """
+        self._log = log
+        self._failureThreshold = max(failureThreshold, 1)
+        self._minDelay = minDelay
+        self._maxDelay = max(maxDelay, minDelay)
+        self._probe = probe
+        self._metrics = metrics
+        self._state = self.CLOSED
+        self._failures = 0
+        self._attempts = 0
+        self._openedAt = None
+        self._retryAt = None
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def getState(self):
+        return self._state
+
+    def before(self):
+        """
+        Wait until a request can be sent.
+
+        While the circuit is open, the request waits for the backoff to elapse
+        and for a probe to succeed, or for L{stop} to be called.
+        """
+        self._condition.acquire()
+        try:
+            while self._state != self.CLOSED and not self._stopped:
+                if self._state == self.OPEN and time.time() >= self._retryAt:
+                    self._setState(self.HALF_OPEN)
+                    if self._probe is None:
+                        # This request is the probe.
+                        return
+                    self._runProbe()
+                    continue
+
+                if self._state == self.OPEN:
+                    self._condition.wait(max(self._retryAt - time.time(), 0.01))
+                else:
+                    # A probe is in flight.
+                    self._condition.wait(1)
+        finally:
+            self._condition.release()
+
+    def stop(self):
+        """
+        Let the waiting and future requests through, the process is shutting
+        down.
+        """
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def _runProbe(self):
+        """
+        Send the probe, the lock being released meanwhile.
+        """
+        self._increment('probes')
+        self._condition.release()
+        try:
+            try:
+                self._probe()
+            except Exception, err:
+                error = err
+            else:
+                error = None
+        finally:
+            self._condition.acquire()
+
+        if error is None:
+            self._setState(self.CLOSED)
+        else:
+            self._open('Probe failed: %s' % error)
+
+    def recordSuccess(self):
+        self._condition.acquire()
+        try:
+            self._failures = 0
+            if self._attempts:
+                self._log.info('Connection to Shotgun recovered after %d seconds.', time.time() - self._openedAt)
+                self._attempts = 0
+            if self._state != self.CLOSED:
+                self._setState(self.CLOSED)
+        finally:
+            self._condition.release()
+
+    def recordAnswer(self):
+        """
+        The site answered a request with an error about the request itself.
+
+        This shows the site is up but is no success, the consecutive failures
+        of a retry loop hitting such errors still add up.
+        """
+        self._condition.acquire()
+        try:
+            if self._state == self.HALF_OPEN:
+                self._setState(self.CLOSED)
+        finally:
+            self._condition.release()
+
+    def recordFailure(self, error):
+        """
+        @param error: The error of the failed request.
+        @type error: I{str} or I{Exception}
+        """
+        self._condition.acquire()
+        try:
+            self._increment('failures')
+            if self._state == self.HALF_OPEN:
+                self._open(error)
+                return
+            if self._state == self.OPEN:
+                return
+
+            self._failures += 1
+            if self._failures >= self._failureThreshold or self._attempts:
+                # Past the threshold or right after a successful probe.
+                self._open(error)
+            else:
+                self._log.warning('Unable to connect to Shotgun (failure %d of %d): %s', self._failures, self._failureThreshold, error)
+        finally:
+            self._condition.release()
+
+    def _open(self, error):
+        newOutage = not self._attempts
+        if newOutage:
+            self._openedAt = time.time()
+            self._increment('opened')
+        self._attempts += 1
+
+        # Full backoff doubles on each attempt, half of it is jittered.
+        delay = min(self._minDelay * 2 ** (self._attempts - 1), self._maxDelay)
+        delay = random.uniform(delay / 2, delay)
+        self._retryAt = time.time() + delay
+
+        if newOutage:
+            self._log.error('Unable to connect to Shotgun, waiting for it to recover (next check in %.1f seconds): %s', delay, error)
+        else:
+            self._log.warning('Shotgun is still unavailable (next check in %.1f seconds): %s', delay, error)
+        self._setState(self.OPEN)
+
+    def _setState(self, state):
+        self._state = state
+        if self._metrics is not None:
+            self._metrics.setValue('health.state', state)
+        self._condition.notifyAll()
+
+    def _increment(self, name):
+        if self._metrics is not None:
+            self._metrics.increment('health.' + name)
@@ -0,0 +1,151 @@
+"""
+A Unix-domain socket to administer a running daemon.
+
+Each connection carries a single command: the client sends a line of JSON
+holding the command name and its arguments and the server answers with a line
+of JSON holding either the result of the command or an error message.
+"""
+
+import errno
+import json
+import os
+import socket
+import SocketServer
+import threading
+
+
+class ControlError(Exception):
+    pass
+
+
+class NotListeningError(ControlError):
+    """
+    No daemon listens on the control socket.
+    """
+    pass
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    timeout = 10
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            result = self.server.handler(request['command'], request.get('args', []))
+        except ControlError, err:
+            response = {'ok': False, 'error': str(err)}
+        except Exception, err:
+            self.server.log.exception('Error handling a control command.')
+            response = {'ok': False, 'error': '%s: %s' % (type(err).__name__, err)}
+        else:
+            response = {'ok': True, 'result': result}
+
+        self.wfile.write(json.dumps(response, default=str) + '\n')
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    # The process waits for the answers being sent before exiting.
+    daemon_threads = False
+
+
+class ControlServer(object):
+    """
+    Serves control commands on a Unix-domain socket from a background thread.
+    """
+
+    def __init__(self, path, handler, log):
+        """
+        @param path: The path of the socket.
+        @type path: I{str}
+        @param handler: Called with the command name and the list of
+            arguments, returns a JSON serializable result or raises
+            L{ControlError}.
+        @type handler: A function object.
+        @param log: The logger errors are reported to.
+        @type log: I{logging.Logger}
+        """
+        self._path = path
+        self._handler = handler
+        self._log = log
+        self._server = None
+        self._thread = None
+        self._inode = None
+
+    def start(self):
+        # A socket file left by a crashed daemon prevents binding.
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+        umask = os.umask(0177)
+        try:
+            self._server = _Server(self._path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self._inode = os.stat(self._path).st_ino
+
+        self._server.handler = self._handler
+        self._server.log = self._log
+        self._thread = threading.Thread(target=self._server.serve_forever, name='control')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._log.info('Listening for control commands on %s.', self._path)
+
+    def stop(self):
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+        # Another process may have taken over the path.
+        try:
+            if os.stat(self._path).st_ino == self._inode:
+                os.remove(self._path)
+        except OSError:
+            pass
+
+
+def sendCommand(path, command, args=None, timeout=30):
+    """
+    Send a command to a running daemon.
+
+    @param path: The path of the control socket.
+    @type path: I{str}
+    @param command: The name of the command.
+    @type command: I{str}
+    @param args: The arguments of the command.
+    @type args: I{list}
+
+    @return: The result of the command.
+
+    @raise NotListeningError: If no daemon listens on the socket.
+    @raise ControlError: If the daemon can't be reached or the command failed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error, err:
+            if err.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                raise NotListeningError('No daemon listens on %s: %s' % (path, err))
+            raise ControlError('Could not reach the daemon on %s: %s' % (path, err))
+
+        try:
+            sock.sendall(json.dumps({'command': command, 'args': args or []}) + '\n')
+            fh = sock.makefile('r')
+            line = fh.readline()
+            fh.close()
+        except socket.error, err:
+            raise ControlError('Could not reach the daemon on %s: %s' % (path, err))
+    finally:
+        sock.close()
+
+    if not line:
+        raise ControlError('The daemon closed the connection without answering.')
+
+    response = json.loads(line)
+    if not response['ok']:
+        raise ControlError(response['error'])
+    return response['result']
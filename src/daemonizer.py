@@ -78,13 +78,23 @@ class Daemon(object):
             fh = open(os.path.join('/var/lock/subsys', self._serviceName), 'w')
             fh.close()
     
+    def _getpid(self):
+        try:
+            pf = file(self._pidfile,'r')
+            pid = int(pf.read().strip())
+            pf.close()
+        except (IOError, ValueError):
+            pid = None
+        return pid
+    
     def _delpid(self):
-        if os.path.exists(self._pidfile):
+        # The pidfile may belong to a process that took over from this one.
+        if self._getpid() == os.getpid():
             os.remove(self._pidfile)
-        
-        subsysPath = os.path.join('/var/lock/subsys', self._serviceName)
-        if os.path.exists(subsysPath):
-            os.remove(subsysPath)
+            
+            subsysPath = os.path.join('/var/lock/subsys', self._serviceName)
+            if os.path.exists(subsysPath):
+                os.remove(subsysPath)
         
         self._cleanup()
     
@@ -93,19 +103,19 @@ class Daemon(object):
         Start the daemon
         """
         # Check for a pidfile to see if the daemon already runs
-        try:
-            pf = file(self._pidfile,'r')
-            pid = int(pf.read().strip())
-            pf.close()
-        except IOError:
-            pid = None
+        pid = self._getpid()
         
         if pid:
             message = "pidfile %s already exist. Daemon already running?\n"
             sys.stderr.write(message % self._pidfile)
             sys.exit(1)
         
-        # Start the daemon
+        self._start(daemonize)
+    
+    def _start(self, daemonize=True):
+        """
+        Start the daemon without checking for a running one.
+        """
         if daemonize:
             self._daemonize()
         
@@ -123,12 +133,7 @@ class Daemon(object):
         Stop the daemon
         """
         # Get the pid from the pidfile
-        try:
-            pf = file(self._pidfile,'r')
-            pid = int(pf.read().strip())
-            pf.close()
-        except IOError:
-            pid = None
+        pid = self._getpid()
         
         if not pid:
             message = "pidfile %s does not exist. Daemon not running?\n"
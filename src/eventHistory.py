@@ -0,0 +1,319 @@
+"""
+A local copy of the recent events of a site the plugins can query instead of
+requesting EventLogEntry entities from Shotgun.
+
+The events are saved in an SQLite database as the engine fetches them,
+indexed by entity, event type, project, user and creation time, and deleted
+once older than the retention period. Queries only see the events fetched
+since the history was enabled, see L{EventHistory.getOldestEvent}.
+
+Each event is saved as JSON, its dates and times tagged so they are read back
+as I{datetime} objects.
+"""
+
+import calendar
+import datetime
+import json
+import threading
+import time
+
+
+class HistoryError(Exception):
+    pass
+
+
+class EventHistory(object):
+    """
+    The events of a site, saved in an SQLite database in WAL mode.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS events ('
+        '    id INTEGER PRIMARY KEY,'
+        '    event_type TEXT,'
+        '    entity_type TEXT,'
+        '    entity_id INTEGER,'
+        '    project_id INTEGER,'
+        '    user_type TEXT,'
+        '    user_id INTEGER,'
+        '    attribute_name TEXT,'
+        '    created REAL,'
+        '    data TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS events_entity ON events (entity_type, entity_id, id)',
+        'CREATE INDEX IF NOT EXISTS events_type ON events (event_type, id)',
+        'CREATE INDEX IF NOT EXISTS events_project ON events (project_id, id)',
+        'CREATE INDEX IF NOT EXISTS events_user ON events (user_type, user_id, id)',
+        'CREATE INDEX IF NOT EXISTS events_created ON events (created)',
+    )
+
+    # Stored as the user_version of the database. The events of older
+    # versions were pickled, they are dropped and the history fills again.
+    VERSION = 1
+
+    # Minimum number of seconds between two deletions of the expired events.
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, path, retention=30):
+        """
+        @param path: The path of the SQLite database.
+        @type path: I{str}
+        @param retention: The number of days events are kept, 0 to keep them
+            forever.
+        @type retention: I{float}
+
+        @raise HistoryError: If the database could not be opened.
+        """
+        import sqlite3
+
+        self._sqlite3 = sqlite3
+        self._path = path
+        self._retention = retention
+        self._lastPrune = 0
+        self._lock = threading.Lock()
+        try:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.text_factory = str
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < self.VERSION:
+                self._conn.execute('DROP TABLE IF EXISTS events')
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+            self._conn.execute('PRAGMA user_version = %d' % self.VERSION)
+            self._conn.commit()
+        except sqlite3.Error, err:
+            raise HistoryError('Could not open the event history %s: %s' % (path, err))
+
+    def add(self, events):
+        """
+        Save events, the ones already saved are ignored.
+
+        @param events: The fetched events.
+        @type events: I{list} of Shotgun event dictionaries.
+
+        @raise HistoryError: If the events could not be saved.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                rows = [self._getRow(e) for e in events]
+                self._conn.executemany('INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                if self._retention > 0 and time.time() - self._lastPrune >= self.PRUNE_INTERVAL:
+                    self._prune()
+                self._conn.commit()
+            except (self._sqlite3.Error, TypeError, ValueError), err:
+                self._conn.rollback()
+                raise HistoryError('Could not save events to %s: %s' % (self._path, err))
+        finally:
+            self._lock.release()
+
+    def _getRow(self, event):
+        entity = event.get('entity') or {}
+        project = event.get('project') or {}
+        user = event.get('user') or {}
+        created = event.get('created_at')
+        if created is not None:
+            created = _getTimestamp(created)
+        data = json.dumps(event, default=_encode, separators=(',', ':'))
+        return (
+            event['id'],
+            event.get('event_type'),
+            entity.get('type'),
+            entity.get('id'),
+            project.get('id'),
+            user.get('type'),
+            user.get('id'),
+            event.get('attribute_name'),
+            created,
+            data,
+        )
+
+    def _prune(self):
+        self._conn.execute('DELETE FROM events WHERE created < ?', (time.time() - self._retention * 86400,))
+        self._lastPrune = time.time()
+
+    def find(self, entity=None, eventTypes=None, project=None, user=None, attributeName=None,
+             since=None, until=None, limit=None, order='desc'):
+        """
+        Find saved events.
+
+        @param entity: The entity the events are about.
+        @type entity: A Shotgun entity dictionary.
+        @param eventTypes: The event types, patterns such as I{Shotgun_Task_*}
+            are accepted.
+        @type eventTypes: I{str} or I{list} of I{str}
+        @param project: The project of the events.
+        @type project: A Shotgun entity dictionary.
+        @param user: The user that triggered the events.
+        @type user: A Shotgun entity dictionary.
+        @param attributeName: The changed field.
+        @type attributeName: I{str}
+        @param since: Only events created at or after this time.
+        @type since: I{datetime.datetime}
+        @param until: Only events created before this time.
+        @type until: I{datetime.datetime}
+        @param limit: The maximum number of events returned.
+        @type limit: I{int}
+        @param order: I{desc} for the most recent events first or I{asc}.
+        @type order: I{str}
+
+        @return: The events, by id.
+        @rtype: I{list} of Shotgun event dictionaries.
+
+        @raise ValueError: If the order is unknown.
+        @raise HistoryError: If the database could not be read.
+        """
+        if order not in ('asc', 'desc'):
+            raise ValueError('Unknown order %s, use asc or desc.' % order)
+
+        clauses = []
+        params = []
+        if entity is not None:
+            clauses.append('entity_type = ? AND entity_id = ?')
+            params.extend([entity['type'], entity['id']])
+        if eventTypes is not None:
+            if isinstance(eventTypes, basestring):
+                eventTypes = [eventTypes]
+            clauses.append('(%s)' % ' OR '.join(['event_type GLOB ?'] * len(eventTypes)))
+            params.extend(eventTypes)
+        if project is not None:
+            clauses.append('project_id = ?')
+            params.append(project['id'])
+        if user is not None:
+            clauses.append('user_type = ? AND user_id = ?')
+            params.extend([user['type'], user['id']])
+        if attributeName is not None:
+            clauses.append('attribute_name = ?')
+            params.append(attributeName)
+        if since is not None:
+            clauses.append('created >= ?')
+            params.append(_getTimestamp(since))
+        if until is not None:
+            clauses.append('created < ?')
+            params.append(_getTimestamp(until))
+
+        query = 'SELECT data FROM events'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY id ' + order
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+
+        self._lock.acquire()
+        try:
+            try:
+                return [_decode(json.loads(r[0])) for r in self._conn.execute(query, params)]
+            except (self._sqlite3.Error, ValueError), err:
+                raise HistoryError('Could not read events from %s: %s' % (self._path, err))
+        finally:
+            self._lock.release()
+
+    def findLast(self, entity, attributeName=None, eventTypes=None):
+        """
+        Find the most recent event about an entity, for example to know who
+        last changed a field.
+
+        @return: The event or None if none was saved.
+        @rtype: A Shotgun event dictionary.
+        """
+        events = self.find(entity=entity, eventTypes=eventTypes, attributeName=attributeName, limit=1)
+        return events and events[0] or None
+
+    def getOldestEvent(self):
+        """
+        Get the oldest saved event, the history is only complete after it.
+
+        @return: The event or None if none was saved.
+        @rtype: A Shotgun event dictionary.
+        """
+        events = self.find(limit=1, order='asc')
+        return events and events[0] or None
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._conn.close()
+        finally:
+            self._lock.release()
+
+
+def _getTimestamp(value):
+    """
+    Convert a datetime to seconds since the epoch, naive datetimes are in the
+    local time.
+    """
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        seconds = calendar.timegm(value.utctimetuple())
+    else:
+        seconds = time.mktime(value.timetuple())
+    return seconds + value.microsecond / 1000000.0
+
+
+class _FixedOffset(datetime.tzinfo):
+    """
+    The UTC offset of a datetime read back from the history.
+    """
+
+    def __init__(self, minutes):
+        self._offset = datetime.timedelta(minutes=minutes)
+
+    def utcoffset(self, value):
+        return self._offset
+
+    def dst(self, value):
+        return datetime.timedelta(0)
+
+    def tzname(self, value):
+        return None
+
+
+def _encode(value):
+    """
+    Tag the values JSON has no type for, see L{_decode}.
+    """
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    raise TypeError('%r can not be saved in the event history.' % (value,))
+
+
+def _decode(value):
+    """
+    Turn a decoded JSON value back into the one of the event, strings
+    encoded in UTF-8 as Shotgun returns them.
+    """
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if '__datetime__' in value:
+                return _parseDatetime(value['__datetime__'])
+            if '__date__' in value:
+                return datetime.datetime.strptime(value['__date__'], '%Y-%m-%d').date()
+        return dict([(_decode(k), _decode(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _parseDatetime(text):
+    """
+    Parse the I{isoformat} of a datetime, with or without microseconds and
+    UTC offset.
+    """
+    offset = None
+    if text[-6:-5] in ('+', '-') and text[-3:-2] == ':':
+        offset = int(text[-5:-3]) * 60 + int(text[-2:])
+        if text[-6] == '-':
+            offset = -offset
+        text = text[:-6]
+
+    if '.' in text:
+        value = datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f')
+    else:
+        value = datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S')
+    if offset is not None:
+        value = value.replace(tzinfo=_FixedOffset(offset))
+    return value
@@ -0,0 +1,367 @@
+"""
+Republishes the events fetched by the daemon to local subscribers so other
+tools don't need to poll Shotgun themselves.
+
+A subscriber connects to the Unix-domain socket, or TCP port, and sends a line
+of JSON with these optional keys:
+
+    - site: The name of the site, required when the daemon has several.
+    - after: The id of the last event the subscriber got, to resume from.
+    - event_types: Patterns of the event types to receive
+      (I{Shotgun_Task_*}).
+
+The server answers with a line of JSON holding either I{ok} and the ids of the
+oldest and most recent events it can serve, or an error message. It then
+writes a line of JSON per event, as the daemon fetches them.
+
+Each subscriber is written to at the pace it reads. A slow subscriber never
+slows the daemon down, it is sent an error line and disconnected once it falls
+out of the recent events kept in memory, and can resume from its last id. A
+subscriber resuming from an id older than the events kept is sent an error
+line, it must fetch the events it missed from Shotgun first.
+"""
+
+import collections
+import datetime
+import errno
+import fnmatch
+import json
+import os
+import socket
+import SocketServer
+import threading
+import time
+
+
+class EventStreamError(Exception):
+    pass
+
+
+class Channel(object):
+    """
+    The recent events of a site, in the order they were fetched.
+
+    Events are serialized once when published and each entry gets a sequence
+    number subscribers use as their position.
+    """
+
+    def __init__(self, size):
+        """
+        @param size: The number of events kept.
+        @type size: I{int}
+        """
+        self._entries = collections.deque(maxlen=size)
+        self._next = 0
+        self._droppedId = None
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def publish(self, events):
+        """
+        @param events: The events to send to the subscribers.
+        @type events: I{list} of Shotgun event dictionaries.
+        """
+        entries = [(e['id'], e.get('event_type'), json.dumps(e, default=_jsonDefault)) for e in events]
+        if not entries:
+            return
+
+        self._condition.acquire()
+        try:
+            for entry in entries:
+                if len(self._entries) == self._entries.maxlen:
+                    self._droppedId = max(self._droppedId, self._entries[0][0])
+                self._entries.append(entry)
+            self._next += len(entries)
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def close(self):
+        self._condition.acquire()
+        try:
+            self._closed = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def isClosed(self):
+        return self._closed
+
+    def getBounds(self):
+        """
+        @return: The ids of the oldest and most recent events kept, None when
+            no event was published yet.
+        @rtype: I{tuple}
+        """
+        self._condition.acquire()
+        try:
+            if not self._entries:
+                return None, None
+            return min([e[0] for e in self._entries]), max([e[0] for e in self._entries])
+        finally:
+            self._condition.release()
+
+    def find(self, afterId=None):
+        """
+        Get the position to serve a subscriber from.
+
+        @param afterId: The id of the last event the subscriber got, or None
+            to only get the next events.
+        @type afterId: I{int}
+
+        @return: A position for L{read}.
+        @rtype: I{int}
+
+        @raise EventStreamError: If events following the id may not be kept
+            anymore.
+        """
+        self._condition.acquire()
+        try:
+            position = self._next
+            if afterId is not None and self._entries:
+                # Event ids have holes, the events following the id are only
+                # known to be kept if it is right before the oldest event
+                # kept or past the events dropped.
+                oldestId = min([e[0] for e in self._entries])
+                if afterId < oldestId - 1 and (self._droppedId is None or afterId < self._droppedId):
+                    raise EventStreamError('Events after %d are no longer buffered, the oldest is %d.' % (afterId, oldestId))
+
+                # Events found late by the gap resolver are not in id order,
+                # serve everything past the last event the subscriber got.
+                for entry in reversed(self._entries):
+                    if entry[0] <= afterId:
+                        break
+                    position -= 1
+            return position
+        finally:
+            self._condition.release()
+
+    def read(self, position, timeout):
+        """
+        Wait for the events following a position.
+
+        @param position: The position of the next event to read.
+        @type position: I{int}
+        @param timeout: The maximum number of seconds to wait.
+        @type timeout: I{float}
+
+        @return: The ids, types and serialized events, and the position
+            following them.
+        @rtype: I{tuple}
+
+        @raise EventStreamError: If the events at the position were dropped.
+        """
+        self._condition.acquire()
+        try:
+            if position >= self._next and not self._closed:
+                self._condition.wait(timeout)
+
+            first = self._next - len(self._entries)
+            if position < first:
+                raise EventStreamError('Too slow, %d events were dropped.' % (first - position))
+
+            entries = list(self._entries)[position - first:]
+            return entries, self._next
+        finally:
+            self._condition.release()
+
+
+class _SubscriberHandler(SocketServer.StreamRequestHandler):
+    # Time given to a subscriber to send its request, or to read an event.
+    timeout = 60
+
+    def handle(self):
+        stream = self.server.stream
+        try:
+            channel, afterId, patterns = stream.parseRequest(self.rfile.readline())
+            position = channel.find(afterId)
+        except (ValueError, TypeError, EventStreamError), err:
+            self._send([json.dumps({'ok': False, 'error': str(err)})])
+            return
+
+        oldestId, headId = channel.getBounds()
+        if not self._send([json.dumps({'ok': True, 'oldest': oldestId, 'head': headId})]):
+            return
+
+        while not channel.isClosed():
+            try:
+                entries, position = channel.read(position, 1)
+            except EventStreamError, err:
+                self._send([json.dumps({'ok': False, 'error': str(err)})])
+                return
+
+            lines = []
+            for eventId, eventType, line in entries:
+                if patterns is None or [p for p in patterns if fnmatch.fnmatchcase(eventType or '', p)]:
+                    lines.append(line)
+            if lines and not self._send(lines):
+                return
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            # The subscriber is gone, the unsent events are dropped.
+            pass
+
+    def _send(self, lines):
+        """
+        @return: False if the subscriber is gone.
+        @rtype: I{bool}
+        """
+        try:
+            self.wfile.write('\n'.join(lines) + '\n')
+            self.wfile.flush()
+        except socket.error:
+            return False
+        return True
+
+
+class _ServerMixIn(SocketServer.ThreadingMixIn):
+    daemon_threads = True
+
+    def handle_error(self, request, clientAddress):
+        self.stream.logError('Error serving an event stream subscriber.')
+
+
+class _UnixServer(_ServerMixIn, SocketServer.UnixStreamServer):
+    pass
+
+
+class _TCPServer(_ServerMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+
+class EventStreamServer(object):
+    """
+    Serves the events of the sites to subscribers from a background thread.
+    """
+
+    # Seconds to wait for the address to be freed by a daemon handing over.
+    BIND_TIMEOUT = 10
+
+    def __init__(self, address, siteNames, bufferSize, log):
+        """
+        @param address: The path of a Unix-domain socket or a I{host:port}
+            TCP address.
+        @type address: I{str}
+        @param siteNames: The names of the sites whose events are published.
+        @type siteNames: I{list} of I{str}
+        @param bufferSize: The number of recent events kept per site.
+        @type bufferSize: I{int}
+        @param log: The logger errors are reported to.
+        @type log: I{logging.Logger}
+        """
+        self._address = address
+        self._log = log
+        self._channels = dict([(name, Channel(bufferSize)) for name in siteNames])
+        self._server = None
+        self._thread = None
+        self._inode = None
+
+    def isTCP(self):
+        return ':' in self._address and not self._address.startswith('/')
+
+    def start(self):
+        if self.isTCP():
+            host, port = self._address.rsplit(':', 1)
+            address = (host, int(port))
+            serverClass = _TCPServer
+        else:
+            # A socket file left by a crashed daemon prevents binding.
+            if os.path.exists(self._address):
+                os.remove(self._address)
+            address = self._address
+            serverClass = _UnixServer
+
+        start = time.time()
+        while True:
+            try:
+                self._server = serverClass(address, _SubscriberHandler)
+                break
+            except socket.error, err:
+                # The daemon handing over may still listen for a moment.
+                if err.errno != errno.EADDRINUSE or time.time() - start > self.BIND_TIMEOUT:
+                    raise
+                time.sleep(0.5)
+
+        if not self.isTCP():
+            self._inode = os.stat(self._address).st_ino
+
+        self._server.stream = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='eventStream')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._log.info('Publishing events on %s.', self._address)
+
+    def stop(self):
+        if self._server is None:
+            return
+
+        for channel in self._channels.values():
+            channel.close()
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+        if not self.isTCP():
+            # Another process may have taken over the path.
+            try:
+                if os.stat(self._address).st_ino == self._inode:
+                    os.remove(self._address)
+            except OSError:
+                pass
+
+    def logError(self, message):
+        self._log.exception(message)
+
+    def publish(self, siteName, events):
+        """
+        @param siteName: The name of the site the events were fetched from.
+        @type siteName: I{str}
+        @param events: The new events.
+        @type events: I{list} of Shotgun event dictionaries.
+        """
+        self._channels[siteName].publish(events)
+
+    def parseRequest(self, line):
+        """
+        @param line: The request line of a subscriber.
+        @type line: I{str}
+
+        @return: The channel, the id to resume after and the event type
+            patterns.
+        @rtype: I{tuple}
+
+        @raise EventStreamError: If the request is invalid.
+        """
+        request = json.loads(line or '{}')
+        if not isinstance(request, dict):
+            raise EventStreamError('The request must be a JSON object.')
+
+        if 'site' in request:
+            channel = self._channels.get(request['site'])
+            if channel is None:
+                raise EventStreamError('Unknown site %s.' % request['site'])
+        elif len(self._channels) == 1:
+            channel = self._channels.values()[0]
+        else:
+            raise EventStreamError('A site is required, one of %s.' % ', '.join(sorted(self._channels)))
+
+        afterId = request.get('after')
+        if afterId is not None:
+            afterId = int(afterId)
+
+        patterns = request.get('event_types')
+        if patterns is not None:
+            if isinstance(patterns, basestring):
+                patterns = [patterns]
+            patterns = [str(p) for p in patterns]
+
+        return channel, afterId, patterns
+
+
+def _jsonDefault(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
@@ -5,12 +5,21 @@ Conversely, this example does not make any updates to Cut In or Cut Out values i
 is modified. You can modify that logic and/or the field names to match your specific workflow.
 """
 
+FIELDS = ['code','sg_cut_in','sg_cut_out','sg_cut_duration']
+
+
 def registerCallbacks(reg):
     matchEvents = {
         'Shotgun_Shot_Change': ['sg_cut_in','sg_cut_out'],
     }
     
-    reg.registerCallback('$DEMO_SCRIPT_NAME$', '$DEMO_API_KEY$', calculateCutDuration, matchEvents, None)
+    # Editing the cut in and cut out together only needs a single update.
+    coalesce = {'window': 5}
+
+    # The Shots of a whole page of events are read with a single request.
+    prefetch = {'Shot': FIELDS}
+
+    reg.registerCallback('$DEMO_SCRIPT_NAME$', '$DEMO_API_KEY$', calculateCutDuration, matchEvents, None, coalesce, prefetch=prefetch)
 
 
 def calculateCutDuration(sg, logger, event, args):
@@ -19,10 +28,11 @@ def calculateCutDuration(sg, logger, event, args):
     if 'new_value' not in event['meta']:
         return
     
-    # lookup the cut values for this Shot
-    filters = [['id', 'is', event['entity']['id']]]
-    fields = ['code','sg_cut_in','sg_cut_out','sg_cut_duration']
-    shot = sg.find_one("Shot", filters, fields)
+    # the cut values for this Shot were prefetched, unless the request failed
+    shot = event.get('entity_data')
+    if 'entity_data' not in event:
+        filters = [['id', 'is', event['entity']['id']]]
+        shot = sg.find_one("Shot", filters, FIELDS)
     if shot is None:
         return
     
@@ -15,6 +15,9 @@ sequentially by each callback and will keep incrementing across event ids.
 The second counter (rotating) will be incremented by each successive callback
 but will be reset at each new event.
 
+Global variables are reset each time the plugin file is reloaded. To keep data
+across reloads, use the store returned by reg.getStore() instead.
+
 
 Try me
 ------
@@ -4,42 +4,51 @@ When a Task status is flipped to 'fin' (Final), lookup each downstream Task that
 to 'rdy' (Ready To Start)
 
 You can modify the status values in the logic to match your workflow.
+
+Events are processed in batches so the downstream Tasks of many finalled Tasks
+are looked up with a single query.
 """
 
 def registerCallbacks(reg):
     matchEvents = {
         'Shotgun_Task_Change': ['sg_status_list'],
     }
-    
-    reg.registerCallback('$DEMO_SCRIPT_NAME$', '$DEMO_API_KEY$', flipDownstreamTasks, matchEvents, None)
+
+    # Only the Tasks flipped to 'fin' are handed to the callback.
+    predicates = {
+        'new_value': 'fin',
+    }
+
+    reg.registerBatchCallback('$DEMO_SCRIPT_NAME$', '$DEMO_API_KEY$', flipDownstreamTasks, matchEvents, None, batchSize=50, predicates=predicates)
 
 
-def flipDownstreamTasks(sg, logger, event, args):
+def flipDownstreamTasks(sg, logger, events, args):
     """Flip downstream Tasks to 'rdy' if all of their upstream Tasks are 'fin'"""
-    
-    # we only care about Tasks that have been finalled
-    if 'new_value' not in event['meta'] or event['meta']['new_value'] != 'fin':
+
+    # the predicates only let Tasks that have been finalled through
+    finalled = [e['entity'] for e in events if e['entity']]
+    if not finalled:
         return
-    
+
     # downtream tasks that are currently wtg
     ds_filters = [
-        ['upstream_tasks', 'is', event['entity']],
+        ['upstream_tasks', 'in', finalled],
         ['sg_status_list', 'is', 'wtg'],
         ]
     fields = ['upstream_tasks']
-    
+
     for ds_task in sg.find("Task", ds_filters, fields):
         change_status = True
         # don't change status unless *all* upstream tasks are fin
         if len(ds_task["upstream_tasks"]) > 1:
-            logger.debug("Task #%d has multiple upstream Tasks", event['entity']['id'])
+            logger.debug("Task #%d has multiple upstream Tasks", ds_task['id'])
             us_filters = [
                 ['downstream_tasks', 'is', ds_task],
                 ['sg_status_list', 'is_not', 'fin'],
                 ]
-            if len(sg.find("Task", filters)) > 0:
+            if len(sg.find("Task", us_filters)) > 0:
                 change_status = False
-        
+
         if change_status:
             sg.update("Task",ds_task['id'], data={'sg_status_list' : 'rdy'})
             logger.info("Set Task #%s to 'rdy'", ds_task['id'])
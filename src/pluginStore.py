@@ -0,0 +1,241 @@
+"""
+Key-value stores the plugins get from the engine to keep data across reloads.
+
+The stores live in the engine so reloading a plugin file keeps their content.
+When the engine is configured with a store file, the content is also saved in
+an SQLite database and survives restarts.
+"""
+
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class StoreError(Exception):
+    pass
+
+
+class Store(object):
+    """
+    An in-memory dict of keys to values in a namespace.
+
+    Changed keys are written to the backend, if any, when the engine flushes
+    the stores.
+    """
+
+    # Marks the deleted keys in the changes.
+    DELETED = object()
+
+    def __init__(self, namespace, data=None):
+        self._namespace = namespace
+        self._data = data or {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def getNamespace(self):
+        return self._namespace
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        """
+        @param key: The key.
+        @type key: I{str}
+        @param value: Any value that can be pickled if the store is saved.
+        """
+        self._lock.acquire()
+        try:
+            self._data[key] = value
+            self._dirty.add(key)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                del(self._data[key])
+                self._dirty.add(key)
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        return self._data.keys()
+
+    def clear(self):
+        for key in self.keys():
+            self.delete(key)
+
+    def getChanges(self):
+        """
+        Get the changes since the last call.
+
+        @return: A dict of changed keys to their values, or to the
+            L{Store.DELETED} marker.
+        @rtype: I{dict}
+        """
+        self._lock.acquire()
+        try:
+            changes = dict([(k, self._data.get(k, self.DELETED)) for k in self._dirty])
+            self._dirty = set()
+        finally:
+            self._lock.release()
+        return changes
+
+    def restoreChanges(self, changes):
+        """
+        Mark the keys of changes that could not be saved as changed again, so
+        the next flush saves their current value.
+
+        @param changes: The changes from L{getChanges}.
+        @type changes: I{dict}
+        """
+        self._lock.acquire()
+        try:
+            self._dirty.update(changes)
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        self.delete(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteBackend(object):
+    """
+    Saves the stores in an SQLite database in WAL mode, one row per key.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS store ('
+        '    namespace TEXT NOT NULL,'
+        '    key TEXT NOT NULL,'
+        '    value BLOB NOT NULL,'
+        '    PRIMARY KEY (namespace, key))'
+    )
+
+    def __init__(self, path):
+        """
+        @raise StoreError: If the database could not be opened.
+        """
+        import sqlite3
+
+        self._sqlite3 = sqlite3
+        self._path = path
+        try:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.text_factory = str
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(self.SCHEMA)
+            self._conn.commit()
+        except sqlite3.Error, err:
+            raise StoreError('Could not open the plugin stores %s: %s' % (path, err))
+
+    def load(self, namespace):
+        data = {}
+        for key, value in self._conn.execute('SELECT key, value FROM store WHERE namespace = ?', (namespace,)):
+            data[key] = pickle.loads(str(value))
+        return data
+
+    def save(self, namespace, changes):
+        conn = self._conn
+        try:
+            for key, value in changes.items():
+                if value is Store.DELETED:
+                    conn.execute('DELETE FROM store WHERE namespace = ? AND key = ?', (namespace, key))
+                else:
+                    blob = self._sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                    conn.execute('INSERT OR REPLACE INTO store (namespace, key, value) VALUES (?, ?, ?)', (namespace, key, blob))
+            conn.commit()
+        except (self._sqlite3.Error, pickle.PicklingError, TypeError), err:
+            conn.rollback()
+            raise StoreError('Could not save the %s store to %s: %s' % (namespace, self._path, err))
+
+    def close(self):
+        self._conn.close()
+
+
+class StoreRegistry(object):
+    """
+    The stores of the engine, by namespace.
+    """
+
+    def __init__(self, path=None):
+        """
+        @param path: The SQLite database the stores are saved to. The stores
+            are only kept in memory if None.
+        @type path: I{str}
+
+        @raise StoreError: If the database could not be opened.
+        """
+        self._backend = None
+        if path:
+            self._backend = SqliteBackend(path)
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def getStore(self, namespace):
+        """
+        Get the store of a namespace, loading it from the backend the first
+        time.
+
+        @rtype: L{Store}
+        """
+        self._lock.acquire()
+        try:
+            store = self._stores.get(namespace)
+            if store is None:
+                data = None
+                if self._backend is not None:
+                    data = self._backend.load(namespace)
+                store = self._stores[namespace] = Store(namespace, data)
+            return store
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        Save the changed keys of all the stores.
+
+        The changes of a store that could not be saved are kept for the next
+        flush.
+
+        @raise StoreError: If a store could not be saved, the others are.
+        """
+        if self._backend is None:
+            return
+
+        errors = []
+        for store in self._stores.values():
+            changes = store.getChanges()
+            if changes:
+                try:
+                    self._backend.save(store.getNamespace(), changes)
+                except StoreError, err:
+                    store.restoreChanges(changes)
+                    errors.append(str(err))
+
+        if errors:
+            raise StoreError('\n'.join(errors))
+
+    def close(self):
+        if self._backend is not None:
+            self._backend.close()
@@ -0,0 +1,278 @@
+"""
+Limits the requests the daemon makes to a Shotgun site.
+
+Requests take a token from a bucket shared by the whole site and from the
+bucket of the plugin making them, then wait for one of the request slots. The
+number of slots adapts to the response times and errors of the site: it grows
+by one per round trip while requests are fast and is cut when they are slow or
+fail.
+
+The engine's own event fetches never wait for tokens, they are counted in the
+site budget and get the next free slot before the plugins' requests.
+"""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Hands out I{rate} tokens per second, up to I{burst} at once.
+
+    Tokens are reserved ahead of time: the bucket goes into debt and the
+    caller is told how long to wait before using its token, so concurrent
+    callers are served in order without polling.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        @param rate: The number of tokens added per second.
+        @type rate: I{float}
+        @param burst: The maximum number of tokens. Defaults to a second worth
+            of tokens.
+        @type burst: I{float}
+        """
+        self._rate = float(rate)
+        self._burst = float(burst or max(rate, 1))
+        self._tokens = self._burst
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def getRate(self):
+        return self._rate
+
+    def reserve(self):
+        """
+        Take a token.
+
+        @return: The number of seconds to wait before using it.
+        @rtype: I{float}
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(self._burst, self._tokens + (now - self._time) * self._rate)
+            self._time = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+        finally:
+            self._lock.release()
+
+
+class AdaptiveConcurrency(object):
+    """
+    Request slots whose number adapts to the health of the site (additive
+    increase, multiplicative decrease).
+
+    High priority requests are given the free slots before the others.
+    """
+
+    # Weight of the last response time in the moving average.
+    SMOOTHING = 0.2
+
+    # Minimum number of seconds between two cuts of the limit.
+    COOLDOWN = 1.0
+
+    def __init__(self, maximum, latencyTarget, minimum=1):
+        """
+        @param maximum: The maximum number of concurrent requests.
+        @type maximum: I{int}
+        @param latencyTarget: The response time, in seconds, above which the
+            limit is cut.
+        @type latencyTarget: I{float}
+        @param minimum: The minimum number of concurrent requests.
+        @type minimum: I{int}
+        """
+        self._minimum = minimum
+        self._maximum = maximum
+        self._latencyTarget = latencyTarget
+        self._limit = float(maximum)
+        self._inFlight = 0
+        self._priorityWaiting = 0
+        self._latency = None
+        self._lastCut = 0
+        self._condition = threading.Condition()
+
+    def getLimit(self):
+        return int(self._limit)
+
+    def getInFlight(self):
+        return self._inFlight
+
+    def getLatency(self):
+        """
+        @return: The moving average of the response times, in seconds.
+        @rtype: I{float}
+        """
+        return self._latency
+
+    def acquire(self, priority=False):
+        """
+        Wait for a free slot.
+
+        @param priority: Whether the request goes before the waiting ones.
+        @type priority: I{bool}
+        """
+        self._condition.acquire()
+        try:
+            if priority:
+                self._priorityWaiting += 1
+                try:
+                    while self._inFlight >= int(self._limit):
+                        self._condition.wait()
+                finally:
+                    self._priorityWaiting -= 1
+            else:
+                while self._inFlight >= int(self._limit) or self._priorityWaiting:
+                    self._condition.wait()
+            self._inFlight += 1
+        finally:
+            self._condition.release()
+
+    def release(self, elapsed, failed=False):
+        """
+        Free a slot and adjust the limit.
+
+        @param elapsed: The response time of the request, in seconds.
+        @type elapsed: I{float}
+        @param failed: Whether the site failed to answer.
+        @type failed: I{bool}
+        """
+        self._condition.acquire()
+        try:
+            self._inFlight -= 1
+            if self._latency is None:
+                self._latency = elapsed
+            else:
+                self._latency += self.SMOOTHING * (elapsed - self._latency)
+
+            now = time.time()
+            if failed or self._latency > self._latencyTarget:
+                if now - self._lastCut >= self.COOLDOWN:
+                    factor = failed and 0.5 or 0.9
+                    self._limit = max(self._minimum, self._limit * factor)
+                    self._lastCut = now
+            elif self._inFlight + 1 >= int(self._limit):
+                # The limit was reached, there is room for more.
+                self._limit = min(self._maximum, self._limit + 1.0 / self._limit)
+
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+
+class RateLimiter(object):
+    """
+    The budgets of the requests made to a site.
+    """
+
+    def __init__(self, rate=0, pluginRate=0, maxConcurrency=0, latencyTarget=2.0):
+        """
+        @param rate: The requests per second of the site, 0 for no limit.
+        @type rate: I{float}
+        @param pluginRate: The default requests per second of each plugin, 0
+            for no limit.
+        @type pluginRate: I{float}
+        @param maxConcurrency: The maximum number of concurrent requests, 0
+            for no limit.
+        @type maxConcurrency: I{int}
+        @param latencyTarget: The response time, in seconds, above which
+            fewer concurrent requests are made.
+        @type latencyTarget: I{float}
+        """
+        self._bucket = None
+        if rate > 0:
+            self._bucket = TokenBucket(rate)
+        self._pluginRate = pluginRate
+        self._pluginRates = {}
+        self._pluginBuckets = {}
+        self._concurrency = None
+        if maxConcurrency > 0:
+            self._concurrency = AdaptiveConcurrency(maxConcurrency, latencyTarget)
+        self._lock = threading.Lock()
+
+    def setPluginRate(self, key, rate):
+        """
+        Override the default budget of a plugin.
+
+        @param key: The plugin.
+        @param rate: The requests per second, 0 for no limit or None for the
+            default budget.
+        @type rate: I{float}
+        """
+        self._lock.acquire()
+        try:
+            if rate is None:
+                self._pluginRates.pop(key, None)
+            else:
+                self._pluginRates[key] = rate
+            self._pluginBuckets.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def _getPluginBucket(self, key):
+        self._lock.acquire()
+        try:
+            if key not in self._pluginBuckets:
+                rate = self._pluginRates.get(key, self._pluginRate)
+                self._pluginBuckets[key] = rate > 0 and TokenBucket(rate) or None
+            return self._pluginBuckets[key]
+        finally:
+            self._lock.release()
+
+    def acquire(self, key=None):
+        """
+        Wait until a request can be made.
+
+        @param key: The plugin making the request or None for the engine.
+
+        @return: The number of seconds waited.
+        @rtype: I{float}
+        """
+        start = time.time()
+
+        if key is not None:
+            delay = 0.0
+            pluginBucket = self._getPluginBucket(key)
+            if pluginBucket is not None:
+                delay = pluginBucket.reserve()
+            if self._bucket is not None:
+                delay = max(delay, self._bucket.reserve())
+            if delay > 0:
+                time.sleep(delay)
+        elif self._bucket is not None:
+            # The engine is counted in the budget but never waits for it.
+            self._bucket.reserve()
+
+        if self._concurrency is not None:
+            self._concurrency.acquire(key is None)
+
+        return time.time() - start
+
+    def release(self, elapsed, failed=False):
+        """
+        Tell the limiter a request is done.
+
+        @param elapsed: The response time of the request, in seconds.
+        @type elapsed: I{float}
+        @param failed: Whether the site failed to answer.
+        @type failed: I{bool}
+        """
+        if self._concurrency is not None:
+            self._concurrency.release(elapsed, failed)
+
+    def getStats(self):
+        """
+        @return: The current concurrency limit, requests in flight and
+            average response time, when concurrency is limited.
+        @rtype: I{dict}
+        """
+        if self._concurrency is None:
+            return {}
+        return {
+            'api.concurrency': self._concurrency.getLimit(),
+            'api.inflight': self._concurrency.getInFlight(),
+            'api.latency': self._concurrency.getLatency(),
+        }
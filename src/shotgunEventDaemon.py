@@ -26,25 +26,35 @@ http://shotgunsoftware.github.com/shotgunEvents
 __version__ = '0.9'
 __version_info__ = (0, 9)
 
+import bisect
 import ConfigParser
 import datetime
+import errno
 import imp
+import json
 import logging
 import logging.handlers
 import os
 import pprint
+import Queue
+import signal
 import socket
 import sys
+import threading
 import time
 import types
 import traceback
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
+import control
+import connectionHealth
 import daemonizer
+import eventHistory
+import eventStream
+import pluginStore
+import rateLimit
+import stateStore
+import timers
+import tracing
 import shotgun_api3 as sg
 
 
@@ -117,21 +127,259 @@ class Config(ConfigParser.ConfigParser):
         ConfigParser.ConfigParser.__init__(self)
         self.read(path)
 
-    def getShotgunURL(self):
-        return self.get('shotgun', 'server')
+    def getSiteNames(self):
+        """
+        Get the names of the Shotgun sites defined by [shotgun:<site>]
+        sections.
+
+        @return: The site names or an empty list if only the [shotgun] section
+            is used.
+        @rtype: I{list} of I{str}
+        """
+        return [s.split(':', 1)[1].strip() for s in self.sections() if s.startswith('shotgun:')]
+
+    def getSiteOption(self, site, option):
+        """
+        Get an option of a site's section, falling back on the [shotgun]
+        section.
+
+        @param site: The site name or None for the [shotgun] section.
+        @type site: I{str}
+        """
+        if site is not None and self.has_option('shotgun:' + site, option):
+            return self.get('shotgun:' + site, option)
+        return self.get('shotgun', option)
+
+    def getShotgunURL(self, site=None):
+        return self.getSiteOption(site, 'server')
+
+    def getEngineScriptName(self, site=None):
+        return self.getSiteOption(site, 'name')
+
+    def getEngineScriptKey(self, site=None):
+        return self.getSiteOption(site, 'key')
+
+    def getUseSessionUuid(self, site=None):
+        return self.getSiteOption(site, 'use_session_uuid').lower() in ('1', 'yes', 'true', 'on')
+
+    def getEventIdFile(self, site=None):
+        if site is not None and self.has_option('shotgun:' + site, 'eventIdFile'):
+            return self.get('shotgun:' + site, 'eventIdFile')
+
+        eventIdFile = self.get('daemon', 'eventIdFile')
+        if eventIdFile and site is not None:
+            return self._getSiteFile(eventIdFile, site)
+        return eventIdFile
+
+    def _getSiteFile(self, path, site):
+        """
+        Suffix a file path with the name of a site.
+
+        A daemon whose [shotgun] section was renamed [shotgun:<site>] keeps
+        using its unsuffixed file, as long as it has a single site and no
+        suffixed file exists, so the plugins don't lose their state.
+
+        @rtype: I{str}
+        """
+        sitePath = '%s.%s' % (path, site)
+        if not os.path.exists(sitePath) and os.path.exists(path) and len(self.getSiteNames()) == 1:
+            return path
+        return sitePath
+
+    def getStateBackend(self):
+        if self.has_option('daemon', 'stateBackend'):
+            return self.get('daemon', 'stateBackend')
+        return 'pickle'
+
+    def getStateFile(self, site=None):
+        if site is not None and self.has_option('shotgun:' + site, 'stateFile'):
+            return self.get('shotgun:' + site, 'stateFile')
+
+        if self.has_option('daemon', 'stateFile'):
+            stateFile = self.get('daemon', 'stateFile')
+        elif site is not None and self.has_option('shotgun:' + site, 'eventIdFile'):
+            return self._getDefaultStateFile(self.get('shotgun:' + site, 'eventIdFile'))
+        else:
+            stateFile = self._getDefaultStateFile(self.get('daemon', 'eventIdFile'))
+
+        if stateFile and site is not None:
+            return self._getSiteFile(stateFile, site)
+        return stateFile
+
+    def _getDefaultStateFile(self, eventIdFile):
+        # The site suffix goes after the extension.
+        if eventIdFile and self.getStateBackend() == 'sqlite':
+            return os.path.splitext(eventIdFile)[0] + '.sqlite'
+        return eventIdFile
+
+    def getPluginStoreFile(self):
+        if self.has_option('daemon', 'pluginStoreFile'):
+            return self.get('daemon', 'pluginStoreFile') or None
+        return None
+
+    def getEventHistoryFile(self, site=None):
+        """
+        @return: The path of the database the events are copied to or None if
+            they are not.
+        @rtype: I{str}
+        """
+        if site is not None and self.has_option('shotgun:' + site, 'eventHistoryFile'):
+            return self.get('shotgun:' + site, 'eventHistoryFile') or None
+
+        if self.has_option('daemon', 'eventHistoryFile'):
+            historyFile = self.get('daemon', 'eventHistoryFile')
+            if historyFile and site is not None:
+                return '%s.%s' % (historyFile, site)
+            return historyFile or None
+        return None
+
+    def getEventHistoryRetention(self):
+        if self.has_option('daemon', 'event_history_retention'):
+            return self.getfloat('daemon', 'event_history_retention')
+        return 30
+
+    def getLedgerFile(self, site=None):
+        stateFile = self.getStateFile(site)
+        if stateFile:
+            return stateFile + '.ledger'
+        return None
+
+    def getCheckpointEvents(self):
+        if self.has_option('daemon', 'checkpoint_events'):
+            return max(self.getint('daemon', 'checkpoint_events'), 1)
+        return 1
+
+    def getMaxEventBatchSize(self):
+        if self.has_option('daemon', 'max_event_batch_size'):
+            return self.getint('daemon', 'max_event_batch_size')
+        return 500
 
-    def getEngineScriptName(self):
-        return self.get('shotgun', 'name')
+    def getEventWindowSize(self):
+        if self.has_option('daemon', 'event_window_size'):
+            return self.getint('daemon', 'event_window_size')
+        return 10000
 
-    def getEngineScriptKey(self):
-        return self.get('shotgun', 'key')
+    def getPrefetchDepth(self):
+        if self.has_option('daemon', 'prefetch_depth'):
+            return self.getint('daemon', 'prefetch_depth')
+        return 2
+
+    def getLaneTimeSlice(self):
+        if self.has_option('daemon', 'lane_time_slice'):
+            return self.getfloat('daemon', 'lane_time_slice')
+        return 1.0
+
+    def getConnRetryMinSleep(self):
+        if self.has_option('daemon', 'conn_retry_min_sleep'):
+            return self.getfloat('daemon', 'conn_retry_min_sleep')
+        return 1.0
+
+    def getTimerWorkers(self):
+        if self.has_option('daemon', 'timer_workers'):
+            return self.getint('daemon', 'timer_workers')
+        return 2
+
+    def getCatchUpThreshold(self):
+        if self.has_option('daemon', 'catchup_threshold'):
+            return self.getint('daemon', 'catchup_threshold')
+        return 10000
+
+    def getCatchUpRate(self):
+        if self.has_option('daemon', 'catchup_rate'):
+            return self.getfloat('daemon', 'catchup_rate')
+        return 0
+
+    def getCatchUpConnections(self):
+        if self.has_option('daemon', 'catchup_connections'):
+            return self.getint('daemon', 'catchup_connections')
+        return 4
+
+    def getCatchUpBuffer(self):
+        if self.has_option('daemon', 'catchup_buffer'):
+            return self.getint('daemon', 'catchup_buffer')
+        return 20000
+
+    def getGapCheckInterval(self):
+        if self.has_option('daemon', 'gap_check_interval'):
+            return self.getint('daemon', 'gap_check_interval')
+        return 5
+
+    def getGapChunkSize(self):
+        if self.has_option('daemon', 'gap_chunk_size'):
+            return self.getint('daemon', 'gap_chunk_size')
+        return 100
+
+    def getBacklogTimeouts(self):
+        """
+        @return: The minimum and maximum number of seconds to wait for a
+            skipped event id before giving up on it.
+        @rtype: I{tuple}
+        """
+        minimum = 30
+        maximum = 300
+        if self.has_option('daemon', 'backlog_min_timeout'):
+            minimum = self.getint('daemon', 'backlog_min_timeout')
+        if self.has_option('daemon', 'backlog_max_timeout'):
+            maximum = self.getint('daemon', 'backlog_max_timeout')
+        return minimum, maximum
+
+    def getApiRateLimit(self):
+        if self.has_option('daemon', 'api_rate_limit'):
+            return self.getfloat('daemon', 'api_rate_limit')
+        return 0
+
+    def getApiPluginRateLimit(self):
+        if self.has_option('daemon', 'api_plugin_rate_limit'):
+            return self.getfloat('daemon', 'api_plugin_rate_limit')
+        return 0
+
+    def getApiMaxConcurrency(self):
+        if self.has_option('daemon', 'api_max_concurrency'):
+            return self.getint('daemon', 'api_max_concurrency')
+        return 0
+
+    def getApiLatencyTarget(self):
+        if self.has_option('daemon', 'api_latency_target'):
+            return self.getfloat('daemon', 'api_latency_target')
+        return 2.0
+
+    def getTraceFile(self):
+        if self.has_option('daemon', 'traceFile'):
+            return self.get('daemon', 'traceFile')
+        return None
 
-    def getEventIdFile(self):
-        return self.get('daemon', 'eventIdFile')
+    def getTraceSampleRate(self):
+        if self.has_option('daemon', 'trace_sample_rate'):
+            return self.getfloat('daemon', 'trace_sample_rate')
+        return 0.01
 
     def getEnginePIDFile(self):
         return self.get('daemon', 'pidFile')
 
+    def getControlSocket(self):
+        """
+        @return: The path of the control socket or None if it is disabled.
+        @rtype: I{str}
+        """
+        if self.has_option('daemon', 'controlSocket'):
+            return self.get('daemon', 'controlSocket') or None
+        return os.path.splitext(self.getEnginePIDFile())[0] + '.sock'
+
+    def getEventStreamAddress(self):
+        """
+        @return: The Unix socket path or I{host:port} address the events are
+            published on, or None if they are not.
+        @rtype: I{str}
+        """
+        if self.has_option('daemon', 'eventStreamSocket'):
+            return self.get('daemon', 'eventStreamSocket') or None
+        return None
+
+    def getEventStreamBuffer(self):
+        if self.has_option('daemon', 'event_stream_buffer'):
+            return self.getint('daemon', 'event_stream_buffer')
+        return 10000
+
     def getPluginPaths(self):
         return [s.strip() for s in self.get('plugins', 'paths').split(',')]
 
@@ -189,28 +437,37 @@ class Config(ConfigParser.ConfigParser):
 class Engine(daemonizer.Daemon):
     """
     The engine holds the main loop of event processing.
+
+    Events are processed for one or several Shotgun sites. The plugin files
+    are loaded once and shared by the sites they apply to.
     """
 
+    HANDOFF_TIMEOUT = 120
+    # Seconds to wait for a daemon that failed to hand over to exit.
+    EXIT_TIMEOUT = 300
+
     def __init__(self, configPath):
         """
         """
         self._continue = True
-        self._eventIdData = {}
+        self._pluginModules = {}
+        self._startTime = time.time()
+        self._controlServer = None
+        self._eventStream = None
+        self._handoffPath = None
+        self._handoffPid = None
+        self._draining = False
+        self._wakeup = threading.Event()
+
+        # Held while events are dispatched and by the control commands that
+        # change the plugins.
+        self.lock = threading.RLock()
 
         # Read/parse the config
         self.config = Config(configPath)
 
         # Get config values
-        self._pluginCollections = [PluginCollection(self, s) for s in self.config.getPluginPaths()]
-        self._sg = sg.Shotgun(
-            self.config.getShotgunURL(),
-            self.config.getEngineScriptName(),
-            self.config.getEngineScriptKey()
-        )
-        self._max_conn_retries = self.config.getint('daemon', 'max_conn_retries')
-        self._conn_retry_sleep = self.config.getint('daemon', 'conn_retry_sleep')
         self._fetch_interval = self.config.getint('daemon', 'fetch_interval')
-        self._use_session_uuid = self.config.getboolean('shotgun', 'use_session_uuid')
 
         # Setup the logger for the main engine
         if self.config.getLogMode() == 0:
@@ -232,6 +489,28 @@ class Engine(daemonizer.Daemon):
 
         self.log.setLevel(self.config.getLogLevel())
 
+        # Tracing of sampled events, if configured.
+        self.tracer = None
+        traceFile = self.config.getTraceFile()
+        if traceFile:
+            self.tracer = tracing.Tracer(traceFile, self.config.getTraceSampleRate(), 'shotgunEventDaemon', __version__)
+
+        # Key-value stores of the plugins, kept across reloads.
+        try:
+            self._pluginStores = pluginStore.StoreRegistry(self.config.getPluginStoreFile())
+        except pluginStore.StoreError, err:
+            self.log.error('The plugin stores are only kept in memory.\n\n%s', err)
+            self._pluginStores = pluginStore.StoreRegistry()
+
+        # Periodic work of the plugins, run away from event dispatch.
+        self._timers = timers.TimerWheel(self.log, self.config.getTimerWorkers())
+
+        siteNames = self.config.getSiteNames()
+        if siteNames:
+            self._sites = [Site(self, name) for name in siteNames]
+        else:
+            self._sites = [Site(self, None)]
+
         super(Engine, self).__init__('shotgunEvent', self.config.getEnginePIDFile())
 
     def start(self, daemonize=True):
@@ -243,6 +522,25 @@ class Engine(daemonizer.Daemon):
 
         super(Engine, self).start(daemonize)
 
+    def restart(self, daemonize=True):
+        """
+        Restart the daemon.
+
+        When the running daemon can be reached on its control socket, this
+        process loads its plugins first and then takes over, the running
+        daemon only stops dispatching for the time it takes to hand over the
+        state of its plugins.
+        """
+        path = self.config.getControlSocket()
+        if not path or not os.path.exists(path):
+            super(Engine, self).restart(daemonize)
+            return
+
+        self._handoffPath = path
+        # The pidfile is rewritten once started.
+        self._handoffPid = self._getpid()
+        self._start(daemonize)
+
     def setEmailsOnLogger(self, logger, emails):
         # Configure the logger for email output
         _removeHandlersFromLogger(logger, logging.handlers.SMTPHandler)
@@ -266,6 +564,55 @@ class Engine(daemonizer.Daemon):
 
         _addMailHandlerToLogger(logger, smtpServer, fromAddr, toAddrs, emailSubject, username, password)
 
+    def getSites(self):
+        return list(self._sites)
+
+    def getUptime(self):
+        return time.time() - self._startTime
+
+    def loadPluginModule(self, name, path, mtime, force=False):
+        """
+        Load the source of a plugin file, once for all the sites.
+
+        @param name: The name of the plugin.
+        @type name: I{str}
+        @param path: The path of the plugin file.
+        @type path: I{str}
+        @param mtime: The modification time of the file on disk.
+        @type mtime: I{float}
+        @param force: Load the source even if it did not change.
+        @type force: I{bool}
+
+        @return: The loaded module.
+        """
+        cached = self._pluginModules.get(path)
+        if not force and cached is not None and cached[0] >= mtime:
+            return cached[1]
+
+        module = imp.load_source(name, path)
+        self._pluginModules[path] = (mtime, module)
+        return module
+
+    def getPluginStore(self, namespace):
+        """
+        @return: The key-value store of a namespace.
+        @rtype: L{pluginStore.Store}
+        """
+        return self._pluginStores.getStore(namespace)
+
+    def addTimer(self, timer):
+        """
+        @param timer: A timer of a plugin to run until it is cancelled.
+        @type timer: L{timers.Timer}
+        """
+        self._timers.add(timer)
+
+    def _flushPluginStores(self):
+        try:
+            self._pluginStores.flush()
+        except pluginStore.StoreError, err:
+            self.log.error('Can not save the plugin stores.\n\n%s', err)
+
     def _run(self):
         """
         Start the processing of events.
@@ -280,80 +627,166 @@ class Engine(daemonizer.Daemon):
         self.log.info('Using Shotgun version %s' % sg.__version__)
 
         try:
-            for collection in self._pluginCollections:
-                collection.load()
+            for site in self._sites:
+                site.loadPlugins()
 
-            self._loadEventIdData()
+            if self._handoffPath is None or not self._takeOver():
+                for site in self._sites:
+                    site.loadEventIdData()
 
+            self._startControlServer()
+            self._startEventStream()
+            self._timers.start()
             self._mainLoop()
         except KeyboardInterrupt, err:
             self.log.warning('Keyboard interrupt. Cleaning up...')
         except Exception, err:
             self.log.critical('Crash!!!!! Unexpected error (%s) in main loop.\n\n%s', type(err), traceback.format_exc(err))
 
-    def _loadEventIdData(self):
+        self._timers.stop()
+
+        for site in self._sites:
+            site.stop()
+
+        if self._controlServer is not None:
+            self._controlServer.stop()
+
+        if self._eventStream is not None:
+            self._eventStream.stop()
+
+        self._flushPluginStores()
+        self._pluginStores.close()
+
+    def _takeOver(self):
         """
-        Load the last processed event id from the disk
+        Get the state of the plugins from the running daemon, which stops.
 
-        If no event has ever been processed or if the eventIdFile has been
-        deleted from disk, no id will be recoverable. In this case, we will try
-        contacting Shotgun to get the latest event's id and we'll start
-        processing from there.
+        When the running daemon answers but the hand over fails, it is
+        stopped and this process waits for it to exit before loading the
+        state from disk, so two daemons never dispatch events together.
+
+        @return: True if the state was handed over.
+        @rtype: I{bool}
+
+        @raise control.ControlError: If the hand over failed and the running
+            daemon could not be stopped.
+        """
+        self.log.info('Taking over from the daemon listening on %s.', self._handoffPath)
+        try:
+            states = control.sendCommand(self._handoffPath, 'handoff', timeout=self.HANDOFF_TIMEOUT)
+        except control.NotListeningError, err:
+            self.log.warning('No daemon to take over from, loading the state from disk: %s', err)
+            return False
+        except control.ControlError, err:
+            self.log.error('Could not take over from the running daemon: %s', err)
+            self._waitForPrevious()
+            return False
+
+        for site in self._sites:
+            site.importState(states.get(site.getName() or '', {}))
+        self.log.info('Took over from process %s.', states.get('pid'))
+        return True
+
+    def _waitForPrevious(self):
         """
-        eventIdFile = self.config.getEventIdFile()
+        Stop the daemon that failed to hand over and wait for it to exit.
 
-        if eventIdFile and os.path.exists(eventIdFile):
-            try:
-                fh = open(eventIdFile)
-                try:
-                    self._eventIdData = pickle.load(fh)
+        It finishes the event it is dispatching and saves its state first.
 
-                    # Provide event id info to the plugin collections. Once
-                    # they've figured out what to do with it, ask them for their
-                    # last processed id.
-                    for collection in self._pluginCollections:
-                        state = self._eventIdData.get(collection.path)
-                        if state:
-                            collection.setState(state)
-                except pickle.UnpicklingError:
-                    fh.close()
-
-                    # Backwards compatibility:
-                    # Reopen the file to try to read an old-style int
-                    fh = open(eventIdFile)
-                    line = fh.readline().strip()
-                    if line.isdigit():
-                        # The _loadEventIdData got an old-style id file containing a single
-                        # int which is the last id properly processed.
-                        lastEventId = int(line)
-                        self.log.debug('Read last event id (%d) from file.', lastEventId)
-                        for collection in self._pluginCollections:
-                            collection.setState(lastEventId)
-                fh.close()
-            except OSError, err:
-                raise EventDaemonError('Could not load event id from file.\n\n%s' % traceback.format_exc(err))
-        else:
-            # No id file?
-            # Get the event data from the database.
-            conn_attempts = 0
-            lastEventId = None
-            while lastEventId is None:
-                order = [{'column':'id', 'direction':'desc'}]
-                try:
-                    result = self._sg.find_one("EventLogEntry", filters=[], fields=['id'], order=order)
-                except (sg.ProtocolError, sg.ResponseError, socket.err), err:
-                    conn_attempts = self._checkConnectionAttempts(conn_attempts, str(err))
-                except Exception, err:
-                    msg = "Unknown error: %s" % str(err)
-                    conn_attempts = self._checkConnectionAttempts(conn_attempts, msg)
-                else:
-                    lastEventId = result['id']
-                    self.log.info('Last event id (%d) from the Shotgun database.', lastEventId)
+        @raise control.ControlError: If the process of the daemon is unknown
+            or did not exit within L{EXIT_TIMEOUT} seconds.
+        """
+        pid = self._handoffPid
+        if not pid or pid == os.getpid():
+            raise control.ControlError('The process of the running daemon is unknown, stop it before starting a new one.')
 
-                    for collection in self._pluginCollections:
-                        collection.setState(lastEventId)
+        self.log.warning('Stopping process %d and loading the state from disk once it exited.', pid)
+        deadline = time.time() + self.EXIT_TIMEOUT
+        try:
+            os.kill(pid, signal.SIGTERM)
+            while time.time() < deadline:
+                os.kill(pid, 0)
+                time.sleep(0.5)
+        except OSError, err:
+            if err.errno != errno.ESRCH:
+                raise control.ControlError('Could not stop process %d: %s' % (pid, err))
+            self.log.info('Process %d exited.', pid)
+            return
+        raise control.ControlError('Process %d did not exit within %d seconds, stop it before starting a new one.' % (pid, self.EXIT_TIMEOUT))
 
-            self._saveEventIdData()
+    def handOff(self):
+        """
+        Stop dispatching events and hand the state of the plugins over to a
+        process taking over.
+
+        The event being dispatched is finished and the state saved one last
+        time. The main loop stops without waiting for the fetch interval.
+
+        @return: The state of each site, keyed by site name.
+        @rtype: I{dict}
+        """
+        self._draining = True
+        # The event being dispatched may be waiting for the site to recover
+        # while holding the lock.
+        self._stopWaiting()
+        self.lock.acquire()
+        try:
+            self.log.info('Handing over to a new process.')
+            states = {'pid': os.getpid()}
+            for site in self._sites:
+                site.saveEventIdData()
+                states[site.getName() or ''] = site.exportState()
+            self._continue = False
+            self._wakeup.set()
+            return states
+        finally:
+            self.lock.release()
+
+    def isDraining(self):
+        return self._draining
+
+    def wakeUp(self):
+        """
+        Interrupt the wait between two passes of the main loop.
+        """
+        self._wakeup.set()
+
+    def _startControlServer(self):
+        path = self.config.getControlSocket()
+        if not path:
+            return
+
+        self._controlServer = control.ControlServer(path, Controller(self).handle, self.log)
+        try:
+            self._controlServer.start()
+        except (OSError, socket.error), err:
+            self.log.error('Could not listen for control commands on %s: %s', path, err)
+            self._controlServer = None
+
+    def _startEventStream(self):
+        address = self.config.getEventStreamAddress()
+        if not address:
+            return
+
+        siteNames = [site.getName() or '' for site in self._sites]
+        self._eventStream = eventStream.EventStreamServer(address, siteNames, self.config.getEventStreamBuffer(), self.log)
+        try:
+            self._eventStream.start()
+        except (OSError, socket.error, ValueError), err:
+            self.log.error('Could not publish events on %s: %s', address, err)
+            self._eventStream = None
+
+    def publishEvents(self, site, events):
+        """
+        Send new events to the subscribers of the event stream.
+
+        @param site: The site the events were fetched from.
+        @type site: L{Site}
+        @param events: The new events.
+        @type events: I{list} of Shotgun event dictionaries.
+        """
+        if self._eventStream is not None and events:
+            self._eventStream.publish(site.getName() or '', events)
 
     def _mainLoop(self):
         """
@@ -361,7 +794,11 @@ class Engine(daemonizer.Daemon):
 
         General behavior:
         - Load plugins from disk - see L{load} method.
-        - Get new events from Shotgun
+        - Get new events from all Shotgun sites concurrently, only the ids
+          never seen before are requested, the others are served from the
+          event window
+        - For each site:
+        - Let each plugin look at the new events as a whole (coalescing)
         - Loop through events
         - Loop through each plugin
         - Loop through each callback
@@ -380,183 +817,819 @@ class Engine(daemonizer.Daemon):
         self.log.debug('Starting the event processing loop.')
         while self._continue:
             # Process events
-            for event in self._getNewEvents():
-                for collection in self._pluginCollections:
-                    collection.process(event)
-                self._saveEventIdData()
-
-            time.sleep(self._fetch_interval)
-
-            # Reload plugins
-            for collection in self._pluginCollections:
-                collection.load()
-                
-            # Make sure that newly loaded events have proper state.
-            self._loadEventIdData()
+            self._fetchEvents()
+            for site in self._sites:
+                site.processEvents()
+            self._flushPluginStores()
+
+            # Don't wait if there are more events waiting on a server.
+            if not [site for site in self._sites if site.hasMoreEvents()]:
+                self._wakeup.wait(self._fetch_interval)
+                self._wakeup.clear()
+
+            # Reload plugins, newly loaded plugins get their state from their
+            # collection.
+            self.lock.acquire()
+            try:
+                for site in self._sites:
+                    site.loadPlugins()
+            finally:
+                self.lock.release()
 
         self.log.debug('Shuting down event processing loop.')
 
-    def _cleanup(self):
-        self._continue = False
-
-    def _getNewEvents(self):
+    def _fetchEvents(self):
         """
-        Fetch new events from Shotgun.
-
-        @return: Recent events that need to be processed by the engine.
-        @rtype: I{list} of Shotgun event dictionaries.
+        Fetch new events for all the sites, concurrently when there are more
+        than one.
         """
-        nextEventId = None
-        for newId in [coll.getNextUnprocessedEventId() for coll in self._pluginCollections]:
-            if newId is not None and (nextEventId is None or newId < nextEventId):
-                nextEventId = newId
+        if len(self._sites) == 1:
+            self._sites[0].fetchEvents()
+            return
 
-        if nextEventId is not None:
-            filters = [['id', 'greater_than', nextEventId - 1]]
-            fields = ['id', 'event_type', 'attribute_name', 'meta', 'entity', 'user', 'project', 'session_uuid']
-            order = [{'column':'id', 'direction':'asc'}]
-    
-            conn_attempts = 0
-            while True:
-                try:
-                    return self._sg.find("EventLogEntry", filters=filters, fields=fields, order=order, filter_operator='all')
-                except (sg.ProtocolError, sg.ResponseError, socket.error), err:
-                    conn_attempts = self._checkConnectionAttempts(conn_attempts, str(err))
-                except Exception, err:
-                    msg = "Unknown error: %s" % str(err)
-                    conn_attempts = self._checkConnectionAttempts(conn_attempts, msg)
+        errors = []
+        def fetch(site):
+            try:
+                site.fetchEvents()
+            except:
+                errors.append(sys.exc_info())
 
-        return []
+        threads = [threading.Thread(target=fetch, args=(site,), name='fetch-%s' % site.getName()) for site in self._sites]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-    def _saveEventIdData(self):
-        """
-        Save an event Id to persistant storage.
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
 
-        Next time the engine is started it will try to read the event id from
-        this location to know at which event it should start processing.
+    def _stopWaiting(self):
         """
-        eventIdFile = self.config.getEventIdFile()
-
-        if eventIdFile is not None:
-            for collection in self._pluginCollections:
-                self._eventIdData[collection.path] = collection.getState()
+        Stop the requests from waiting for the sites to recover.
+        """
+        for site in self._sites:
+            site.health.stop()
 
-            for colPath, state in self._eventIdData.items():
-                if state:
-                    try:
-                        fh = open(eventIdFile, 'w')
-                        pickle.dump(self._eventIdData, fh)
-                        fh.close()
-                    except OSError, err:
-                        self.log.error('Can not write event id data to %s.\n\n%s', eventIdFile, traceback.format_exc(err))
-                    break
-            else:
-                self.log.warning('No state was found. Not saving to disk.')
-
-    def _checkConnectionAttempts(self, conn_attempts, msg):
-        conn_attempts += 1
-        if conn_attempts == self._max_conn_retries:
-            self.log.error('Unable to connect to Shotgun (attempt %s of %s): %s', conn_attempts, self._max_conn_retries, msg)
-            conn_attempts = 0
-            time.sleep(self._conn_retry_sleep)
-        else:
-            self.log.warning('Unable to connect to Shotgun (attempt %s of %s): %s', conn_attempts, self._max_conn_retries, msg)
-        return conn_attempts
+    def _cleanup(self):
+        self._continue = False
+        self._draining = True
+        self._stopWaiting()
+        self._wakeup.set()
 
 
-class PluginCollection(object):
+class Site(object):
     """
-    A group of plugin files in a location on the disk.
+    A Shotgun site the engine processes events for.
+
+    Each site has its own connection, event fetcher, plugin state and state
+    store.
     """
-    def __init__(self, engine, path):
-        if not os.path.isdir(path):
-            raise ValueError('Invalid path: %s' % path)
 
-        self._engine = engine
-        self.path = path
-        self._plugins = {}
-        self._stateData = {}
+    # Share of the time slice of the lanes below the high priority one.
+    LANE_WEIGHTS = {'normal': 3, 'low': 1}
 
-    def setState(self, state):
-        if isinstance(state, int):
-            for plugin in self:
-                plugin.setState(state)
-                self._stateData[plugin.getName()] = plugin.getState()
+    def __init__(self, engine, name):
+        """
+        @param engine: The engine processing events for this site.
+        @type engine: L{Engine}
+        @param name: The name of the site, as in its [shotgun:<name>] config
+            section, or None when the [shotgun] section is used.
+        @type name: I{str}
+        """
+        self._engine = engine
+        self._name = name
+        self._stateStore = None
+        self._ledger = None
+        self._history = None
+        self._historyFailed = False
+        self._events = []
+        self._scriptNames = frozenset()
+        self._checkpointEvents = engine.config.getCheckpointEvents()
+        self._sinceCheckpoint = 0
+        self._laneTimeSlice = engine.config.getLaneTimeSlice()
+        self._lanesBehind = False
+        self.config = engine.config
+        self.metrics = Metrics()
+
+        if name is None:
+            self.log = engine.log
         else:
-            self._stateData = state
-            for plugin in self:
-                pluginState = self._stateData.get(plugin.getName())
-                if pluginState:
-                    plugin.setState(pluginState)
+            self.log = logging.getLogger('engine.' + name)
+
+        # The budget of the requests made to the site, if limited.
+        self.limiter = None
+        rate = self.config.getApiRateLimit()
+        pluginRate = self.config.getApiPluginRateLimit()
+        maxConcurrency = self.config.getApiMaxConcurrency()
+        if rate > 0 or pluginRate > 0 or maxConcurrency > 0:
+            self.limiter = rateLimit.RateLimiter(rate, pluginRate, maxConcurrency, self.config.getApiLatencyTarget())
+
+        # Whether the site answers, reported to by all the connections. The
+        # server is probed with a request for its version while it is down.
+        probeConnection = sg.Shotgun(self.getShotgunURL(), self.config.getEngineScriptName(name), self.config.getEngineScriptKey(name))
+        self.health = connectionHealth.ConnectionHealth(
+            self.log,
+            self.config.getint('daemon', 'max_conn_retries'),
+            self.config.getConnRetryMinSleep(),
+            self.config.getint('daemon', 'conn_retry_sleep'),
+            lambda: probeConnection.info(),
+            self.metrics
+        )
 
-    def getState(self):
-        for plugin in self:
-            self._stateData[plugin.getName()] = plugin.getState()
-        return self._stateData
+        self._pluginCollections = [PluginCollection(engine, self, s) for s in self.config.getPluginPaths()]
+        self._sg = self.connect(
+            self.config.getEngineScriptName(name),
+            self.config.getEngineScriptKey(name)
+        )
+        self._use_session_uuid = self.config.getUseSessionUuid(name)
+        self._fetcher = EventFetcher(self, self._sg, self.config.getMaxEventBatchSize(), self.config.getEventWindowSize())
+        self._prefetchSize = self.config.getMaxEventBatchSize()
+        prefetchDepth = self.config.getPrefetchDepth()
+        if prefetchDepth > 0:
+            # The prefetching thread gets its own connection.
+            prefetchConnection = self.connect(
+                self.config.getEngineScriptName(name),
+                self.config.getEngineScriptKey(name)
+            )
+            fetchInterval = self.config.getint('daemon', 'fetch_interval')
+            self._fetcher.setPrefetcher(EventPrefetcher(self, self._fetcher, prefetchConnection, prefetchDepth, fetchInterval))
+        self._gapResolver = GapResolver(
+            self,
+            self._fetcher,
+            self.config.getGapCheckInterval(),
+            self.config.getGapChunkSize(),
+            self.config.getBacklogTimeouts()
+        )
+        self._fetcher.setGapResolver(self._gapResolver)
+
+        self._catchUp = None
+        catchUpThreshold = self.config.getCatchUpThreshold()
+        if catchUpThreshold > 0:
+            # History is paged on its own connection.
+            catchUpFetcher = EventFetcher(self, self.connect(
+                self.config.getEngineScriptName(name),
+                self.config.getEngineScriptKey(name)
+            ), self.config.getMaxEventBatchSize(), 0)
+            downloader = None
+            connectionCount = self.config.getCatchUpConnections()
+            if connectionCount > 1:
+                connections = [self.connect(
+                    self.config.getEngineScriptName(name),
+                    self.config.getEngineScriptKey(name)
+                ) for i in range(connectionCount)]
+                downloader = HistoryDownloader(self, catchUpFetcher, connections, self.config.getCatchUpBuffer(), self.config.getint('daemon', 'conn_retry_sleep'))
+            self._catchUp = CatchUpWorker(engine, self, catchUpFetcher, catchUpThreshold, self.config.getCatchUpRate(), downloader)
 
-    def getNextUnprocessedEventId(self):
-        eId = None
-        for plugin in self:
-            if not plugin.isActive():
-                continue
+    def getName(self):
+        """
+        @return: The name of the site or None for the [shotgun] section.
+        @rtype: I{str}
+        """
+        return self._name
 
-            newId = plugin.getNextUnprocessedEventId()
-            if newId is not None and (eId is None or newId < eId):
-                eId = newId
-        return eId
+    def getShotgunURL(self):
+        return self.config.getShotgunURL(self._name)
 
-    def process(self, event):
-        for plugin in self:
-            if plugin.isActive():
-                plugin.process(event)
-            else:
-                plugin.logger.debug('Skipping: inactive.')
+    def usesSessionUuid(self):
+        return self._use_session_uuid
 
-    def load(self):
+    def getTracer(self):
+        return self._engine.tracer
+
+    def connect(self, sgScriptName, sgScriptKey, plugin=None):
         """
-        Load plugins from disk.
+        Get a connection to the site that reports to the health of the site,
+        instrumented when events are traced and limited when the requests to
+        the site are.
 
-        General behavior:
-        - Loop on all paths.
-        - Find all valid .py plugin files.
-        - Loop on all plugin files.
-        - For any new plugins, load them, otherwise, refresh them.
+        @param plugin: The plugin the connection is for or None for the
+            engine's own connections.
+        @type plugin: L{Plugin}
         """
-        newPlugins = {}
+        global sg
+        sgConnection = sg.Shotgun(self.getShotgunURL(), sgScriptName, sgScriptKey)
+        tracer = plugin is not None and self._engine.tracer or None
+        return ShotgunProxy(sgConnection, tracer, self.limiter, self, plugin and plugin.getName(), self.health)
 
-        for basename in os.listdir(self.path):
-            if not basename.endswith('.py') or basename.startswith('.'):
-                continue
+    def getPlugins(self):
+        plugins = []
+        for collection in self._pluginCollections:
+            plugins.extend(collection)
+        return plugins
 
-            if basename in self._plugins:
-                newPlugins[basename] = self._plugins[basename]
-            else:
-                newPlugins[basename] = Plugin(self._engine, os.path.join(self.path, basename))
+    def getHeadEventId(self):
+        """
+        @return: The id of the most recent event fetched.
+        @rtype: I{int}
+        """
+        return self._fetcher.getHeadId()
 
-            newPlugins[basename].load()
+    def getLiveStartEventId(self):
+        """
+        @return: The id of the oldest event the live lanes can be served.
+        @rtype: I{int}
+        """
+        return self._fetcher.getStartId()
 
-        self._plugins = newPlugins
+    def isCatchingUp(self, plugin):
+        """
+        Is a plugin served by the catch-up worker instead of the live lanes.
 
-    def __iter__(self):
-        for basename in sorted(self._plugins.keys()):
-            yield self._plugins[basename]
+        @rtype: I{bool}
+        """
+        return self._catchUp is not None and self._catchUp.isCatchingUp(plugin)
 
+    def loadPlugins(self):
+        for collection in self._pluginCollections:
+            collection.load()
 
-class Plugin(object):
-    """
-    The plugin class represents a file on disk which contains one or more
-    callbacks.
-    """
-    def __init__(self, engine, path):
+        scriptNames = set([self.config.getEngineScriptName(self._name)])
+        for plugin in self.getPlugins():
+            scriptNames.update(plugin.getScriptNames())
+        if scriptNames != self._scriptNames:
+            self._scriptNames = frozenset(scriptNames)
+
+    def getScriptNames(self):
+        """
+        Get the names of the API scripts the daemon connects to this site
+        with. The same set is returned until it changes.
+
+        @rtype: I{frozenset} of I{str}
+        """
+        return self._scriptNames
+
+    def wakeUp(self):
+        self._engine.wakeUp()
+
+    def stop(self):
+        """
+        Stop the background activity of the site.
+        """
+        self._fetcher.stop()
+        if self._catchUp is not None:
+            self._catchUp.stop()
+        if self._ledger is not None:
+            self._ledger.close()
+        if self._history is not None:
+            self._history.close()
+
+    def _getStateStore(self):
+        """
+        Get the store used to persist the state of the plugins.
+
+        @return: The state store or None if no state should be persisted.
+        @rtype: L{stateStore.StateStore}
+        """
+        if self._stateStore is None:
+            stateFile = self.config.getStateFile(self._name)
+            if stateFile and self._name is not None and stateFile == self.config.getStateFile():
+                self.log.warning('Using the state file %s of the [shotgun] section for site %s, rename it %s.%s to stop this fallback.', stateFile, self._name, stateFile, self._name)
+            if stateFile:
+                backend = self.config.getStateBackend()
+                self._stateStore = stateStore.getStateStore(backend, stateFile, self.config.getEventIdFile(self._name))
+        return self._stateStore
+
+    def getLedger(self):
+        """
+        Get the ledger of the events completed by non-idempotent callbacks.
+
+        @return: The ledger or None if no state is persisted.
+        @rtype: L{stateStore.CompletionLedger}
+        """
+        if self._ledger is None:
+            ledgerFile = self.config.getLedgerFile(self._name)
+            if ledgerFile:
+                self._ledger = stateStore.CompletionLedger(ledgerFile)
+        return self._ledger
+
+    def getEventHistory(self):
+        """
+        Get the local copy of the events of the site.
+
+        @return: The history or None if it is disabled or could not be
+            opened.
+        @rtype: L{eventHistory.EventHistory}
+        """
+        if self._history is None and not self._historyFailed:
+            historyFile = self.config.getEventHistoryFile(self._name)
+            if historyFile:
+                try:
+                    self._history = eventHistory.EventHistory(historyFile, self.config.getEventHistoryRetention())
+                except eventHistory.HistoryError, err:
+                    self.log.error('The event history is disabled.\n\n%s', err)
+                    self._historyFailed = True
+        return self._history
+
+    def loadEventIdData(self):
+        """
+        Load the last processed event id from the disk
+
+        If no event has ever been processed or if the eventIdFile has been
+        deleted from disk, no id will be recoverable. In this case, we will try
+        contacting Shotgun to get the latest event's id and we'll start
+        processing from there.
+
+        The state is only read from disk on startup, plugins loaded afterwards
+        get their state from the plugin collections.
+        """
+        store = self._getStateStore()
+
+        state = None
+        if store is not None:
+            try:
+                state = store.load()
+            except (OSError, IOError, stateStore.StateStoreError), err:
+                raise EventDaemonError('Could not load event id from file.\n\n%s' % traceback.format_exc(err))
+
+        if isinstance(state, int):
+            # The loadEventIdData got an old-style id file containing a single
+            # int which is the last id properly processed.
+            self.log.debug('Read last event id (%d) from file.', state)
+            for collection in self._pluginCollections:
+                collection.setState(state)
+        elif state is not None:
+            # Provide event id info to the plugin collections. Once
+            # they've figured out what to do with it, ask them for their
+            # last processed id.
+            for collection in self._pluginCollections:
+                collectionState = state.get(collection.path)
+                if collectionState:
+                    collection.setState(collectionState)
+        else:
+            # No id file?
+            # Get the event data from the database.
+            lastEventId = None
+            while lastEventId is None:
+                order = [{'column':'id', 'direction':'desc'}]
+                try:
+                    result = self._sg.find_one("EventLogEntry", filters=[], fields=['id'], order=order)
+                except (sg.ProtocolError, sg.ResponseError, socket.error), err:
+                    # Reported to the health of the site, which delays the
+                    # next attempt.
+                    pass
+                except Exception, err:
+                    self.health.recordFailure("Unknown error: %s" % str(err))
+                else:
+                    lastEventId = result['id']
+                    self.log.info('Last event id (%d) from the Shotgun database.', lastEventId)
+
+                    for collection in self._pluginCollections:
+                        collection.setState(lastEventId)
+
+            self.saveEventIdData()
+
+    def exportState(self):
+        """
+        Get the state of the plugins in a form that can be sent as JSON.
+
+        @return: A dict of collection paths to dicts of plugin names to last
+            event id and list of (backlog id, expiration timestamp) pairs.
+        @rtype: I{dict}
+        """
+        state = {}
+        for collection in self._pluginCollections:
+            collectionState = {}
+            for pluginName, (lastEventId, backlog) in collection.getState().items():
+                backlog = [(k, time.mktime(v.timetuple())) for k, v in backlog.items()]
+                collectionState[pluginName] = (lastEventId, backlog)
+            state[collection.path] = collectionState
+        return state
+
+    def importState(self, state):
+        """
+        Set the state of the plugins from L{exportState}'s output.
+
+        @type state: I{dict}
+        """
+        for collection in self._pluginCollections:
+            collectionState = {}
+            for pluginName, (lastEventId, backlog) in state.get(collection.path, {}).items():
+                backlog = dict([(k, datetime.datetime.fromtimestamp(v)) for k, v in backlog])
+                collectionState[str(pluginName)] = (lastEventId, backlog)
+            if collectionState:
+                collection.setState(collectionState)
+
+    def fetchEvents(self):
+        """
+        Fetch the events to process next, see L{processEvents}.
+        """
+        self._events = self._getNewEvents()
+
+    def processEvents(self):
+        """
+        Dispatch the last fetched events to the plugins, one priority lane
+        after the other.
+
+        The high priority plugins get all the events first. When plugins of
+        several priorities are loaded, the lower lanes then share a time slice
+        in proportion to their weights, a lane gets the time the lanes before
+        it did not use. A lane out of time stops where it is and its plugins
+        resume from their own cursor on the next pass, which starts right
+        away with the new events of the high priority plugins.
+        """
+        events, self._events = self._events, []
+        lock = self._engine.lock
+
+        lock.acquire()
+        try:
+            for collection in self._pluginCollections:
+                collection.prepare(events)
+            lanes = self._getLanes()
+        finally:
+            lock.release()
+
+        totalWeight = sum([self.LANE_WEIGHTS.get(p, 0) for p, plugins in lanes])
+        weight = 0
+        used = 0.0
+        traces = {}
+        self._lanesBehind = False
+        self._sinceCheckpoint = 0
+        for i, (priority, plugins) in enumerate(lanes):
+            budget = None
+            if len(lanes) > 1 and priority in self.LANE_WEIGHTS:
+                weight += self.LANE_WEIGHTS[priority]
+                budget = self._laneTimeSlice * weight / totalWeight - used
+
+            start = time.time()
+            completed = self._dispatchLane(events, plugins, budget, traces, i == len(lanes) - 1)
+            elapsed = time.time() - start
+            if budget is not None:
+                used += elapsed
+            self.metrics.increment('lanes.%s.seconds' % priority, elapsed)
+            if not completed:
+                self.metrics.increment('lanes.%s.interrupted' % priority)
+                self._lanesBehind = True
+            if self._engine.isDraining():
+                break
+
+        if self._catchUp is not None and not self._engine.isDraining():
+            self._catchUp.run(self._laneTimeSlice)
+
+        lock.acquire()
+        try:
+            tracer = self._engine.tracer
+            for trace in traces.values():
+                # The events the last lane did not reach.
+                tracer.resumeDispatch(trace)
+                tracer.finishDispatch()
+            if self._sinceCheckpoint:
+                self.saveEventIdData()
+        finally:
+            lock.release()
+        self.metrics.increment('events.dispatched', len(events))
+
+        self._fetcher.evict(self._getActivePlugins())
+
+    def _getLanes(self):
+        """
+        @return: The priorities of the active plugins with their plugins, in
+            order of priority.
+        @rtype: I{list} of I{tuple}
+        """
+        lanes = []
+        for priority in Plugin.PRIORITIES:
+            plugins = [p for p in self._getActivePlugins() if p.getPriority() == priority]
+            if plugins:
+                lanes.append((priority, plugins))
+        return lanes
+
+    def _dispatchLane(self, events, plugins, budget, traces, last):
+        """
+        Dispatch events to the plugins of a lane.
+
+        @param budget: The number of seconds the lane can take, None for no
+            limit.
+        @type budget: I{float}
+        @param traces: The traces of the events dispatched by a previous lane,
+            by event id.
+        @type traces: I{dict}
+        @param last: Whether this is the last lane, which finishes the traces.
+        @type last: I{bool}
+
+        @return: False if the lane ran out of time before the last event.
+        @rtype: I{bool}
+        """
+        lock = self._engine.lock
+        tracer = self._engine.tracer
+        start = time.time()
+        for event in events:
+            if budget is not None and time.time() - start >= budget:
+                return False
+
+            # The lock is released between events so control commands are
+            # handled promptly.
+            lock.acquire()
+            try:
+                if self._engine.isDraining():
+                    return True
+                if tracer is not None:
+                    if event['id'] in traces:
+                        tracer.resumeDispatch(traces.pop(event['id']))
+                    else:
+                        tracer.startDispatch((self._name, event['id']))
+                for plugin in plugins:
+                    if plugin.isActive():
+                        plugin.process(event)
+                    else:
+                        plugin.logger.debug('Skipping: inactive.')
+
+                # Completions of non-idempotent callbacks are in the ledger,
+                # the state can be saved less often.
+                self._sinceCheckpoint += 1
+                if self._sinceCheckpoint >= self._checkpointEvents:
+                    self.saveEventIdData()
+                    self._sinceCheckpoint = 0
+                if tracer is not None:
+                    if last:
+                        tracer.finishDispatch()
+                    else:
+                        trace = tracer.suspendDispatch()
+                        if trace is not None:
+                            traces[event['id']] = trace
+            finally:
+                lock.release()
+
+        return True
+
+    def hasMoreEvents(self):
+        """
+        Did the last fetch leave new events on the server or did a lane run
+        out of time.
+
+        @rtype: I{bool}
+        """
+        if self._catchUp is not None and self._catchUp.hasWork():
+            return True
+        return self._fetcher.hasMore() or self._lanesBehind
+
+    def _getActivePlugins(self):
+        """
+        @return: The active plugins served by the live lanes.
+        @rtype: I{list} of L{Plugin}
+        """
+        plugins = []
+        for collection in self._pluginCollections:
+            plugins.extend([p for p in collection if p.isActive() and not self.isCatchingUp(p)])
+        return plugins
+
+    def _getNewEvents(self):
+        """
+        Fetch new events from Shotgun.
+
+        Each active plugin is served the events past its own cursor and the
+        events of its backlog from the event window. Shotgun is only asked for
+        the events that were never fetched.
+
+        @return: Recent events that need to be processed by the engine.
+        @rtype: I{list} of Shotgun event dictionaries.
+        """
+        plugins = self._getActivePlugins()
+        if self._catchUp is not None and self._catchUp.assign(plugins):
+            plugins = self._getActivePlugins()
+        headId = self._fetcher.getHeadId()
+        newEvents = self._fetcher.fetch(plugins)
+        # Events fetched again for plugins behind the window were published
+        # already.
+        published = [e for e in newEvents if headId is None or e['id'] > headId]
+        resolved = self._gapResolver.resolve(plugins)
+        published.extend(resolved)
+        newEvents.extend(resolved)
+        self._engine.publishEvents(self, published)
+
+        history = self.getEventHistory()
+        if history is not None and published:
+            try:
+                history.add(published)
+            except eventHistory.HistoryError, err:
+                self.log.error('Could not add events to the history.\n\n%s', err)
+
+        pending = {}
+        for plugin in plugins:
+            for event in self._fetcher.getPendingEvents(plugin, newEvents):
+                pending[event['id']] = event
+
+        events = [pending[k] for k in sorted(pending)]
+        self.prefetchEntities(events, plugins)
+        return events
+
+    def prefetchEntities(self, events, plugins):
+        """
+        Read the fields the callbacks of the plugins prefetch from the
+        entities of the events, with a request per entity type and page
+        rather than one per event.
+
+        The entity is set as the I{entity_data} of each event a prefetching
+        callback can process, None if it was not found. Only the callbacks
+        the event is routed to are looked at. When a request fails, the
+        events are left without I{entity_data} and the callbacks read the
+        entities themselves.
+
+        @param events: The events about to be dispatched.
+        @type events: I{list} of Shotgun event dictionaries.
+        @param plugins: The plugins the events are dispatched to.
+        @type plugins: I{list} of L{Plugin}
+        """
+        fields = {}
+        entityIds = {}
+        for plugin in plugins:
+            if not [c for c in plugin if c.getPrefetchFields()]:
+                continue
+            for event in events:
+                entity = event.get('entity')
+                if not entity:
+                    continue
+                # The callbacks the event is routed to by the dispatch.
+                for callback in plugin.getCandidates(event):
+                    prefetch = callback.getPrefetchFields()
+                    if prefetch and entity.get('type') in prefetch and callback.isActive() and callback.canProcess(event):
+                        fields.setdefault(entity['type'], set()).update(prefetch[entity['type']])
+                        entityIds.setdefault(entity['type'], set()).add(entity['id'])
+
+        # Entities prefetched by an earlier pass would be stale.
+        for event in events:
+            event.pop('entity_data', None)
+
+        found = {}
+        for entityType, ids in entityIds.items():
+            ids = sorted(ids)
+            try:
+                for i in range(0, len(ids), self._prefetchSize):
+                    chunk = ids[i:i + self._prefetchSize]
+                    entities = self._sg.find(entityType, [['id', 'in', chunk]], sorted(fields[entityType]))
+                    self.metrics.increment('entities.requests')
+                    self.metrics.increment('entities.prefetched', len(entities))
+                    for entityId in chunk:
+                        found[(entityType, entityId)] = None
+                    for entity in entities:
+                        found[(entityType, entity['id'])] = entity
+            except (sg.ProtocolError, sg.ResponseError, socket.error, sg.Fault), err:
+                self.log.warning('Could not prefetch the %s entities of the events, the callbacks will read them.\n\n%s', entityType, err)
+
+        for event in events:
+            entity = event.get('entity')
+            if entity and (entity.get('type'), entity.get('id')) in found:
+                event['entity_data'] = found[(entity['type'], entity['id'])]
+
+    def getBacklogTimeout(self):
+        """
+        Get the number of seconds to wait for a skipped event id to show up.
+
+        @rtype: I{int}
+        """
+        return self._gapResolver.getTimeout()
+
+    def saveEventIdData(self):
+        """
+        Save the state of the plugins to persistant storage.
+
+        Next time the engine is started it will try to read the event id from
+        this location to know at which event it should start processing.
+
+        Only the state of the plugins that changed since the last save is
+        handed to the store.
+        """
+        store = self._getStateStore()
+
+        if store is not None:
+            changes = {}
+            for collection in self._pluginCollections:
+                collectionChanges = collection.getChangedState()
+                if collectionChanges:
+                    changes[collection.path] = collectionChanges
+
+            if changes:
+                try:
+                    store.save(changes)
+                except (OSError, IOError, stateStore.StateStoreError), err:
+                    self.log.error('Can not write event id data to %s.\n\n%s', self.config.getStateFile(self._name), traceback.format_exc(err))
+                    return
+
+                ledger = self.getLedger()
+                try:
+                    ledger.prune(changes)
+                except (OSError, IOError), err:
+                    self.log.error('Can not write the completion ledger %s.\n\n%s', self.config.getLedgerFile(self._name), traceback.format_exc(err))
+
+
+class PluginCollection(object):
+    """
+    A group of plugin files in a location on the disk.
+    """
+    def __init__(self, engine, site, path):
+        if not os.path.isdir(path):
+            raise ValueError('Invalid path: %s' % path)
+
+        self._engine = engine
+        self._site = site
+        self.path = path
+        self._plugins = {}
+        self._stateData = {}
+
+    def setState(self, state):
+        if isinstance(state, int):
+            for plugin in self:
+                plugin.setState(state)
+                self._stateData[plugin.getName()] = plugin.getState()
+        else:
+            self._stateData = state
+            for plugin in self:
+                pluginState = self._stateData.get(plugin.getName())
+                if pluginState:
+                    plugin.setState(pluginState)
+
+    def getState(self):
+        for plugin in self:
+            self._stateData[plugin.getName()] = plugin.getState()
+        return self._stateData
+
+    def getChangedState(self):
+        """
+        Get the state of the plugins that changed since the last call.
+
+        @return: A dict of plugin names to plugin states.
+        @rtype: I{dict}
+        """
+        changes = {}
+        for plugin in self:
+            if plugin.isStateChanged():
+                state = plugin.getState()
+                self._stateData[plugin.getName()] = state
+                changes[plugin.getName()] = state
+                plugin.setStateChanged(False)
+        return changes
+
+    def prepare(self, events):
+        """
+        Give the plugins of the live lanes a look at the events about to be
+        dispatched. The plugins the catch-up worker serves prepare its pages
+        instead.
+        """
+        for plugin in self:
+            if plugin.isActive() and not self._site.isCatchingUp(plugin):
+                plugin.prepare(events)
+
+    def load(self):
+        """
+        Load plugins from disk.
+
+        General behavior:
+        - Loop on all paths.
+        - Find all valid .py plugin files.
+        - Loop on all plugin files.
+        - For any new plugins, load them, otherwise, refresh them.
+        """
+        newPlugins = {}
+
+        for basename in os.listdir(self.path):
+            if not basename.endswith('.py') or basename.startswith('.'):
+                continue
+
+            if basename in self._plugins:
+                newPlugins[basename] = self._plugins[basename]
+            else:
+                newPlugins[basename] = Plugin(self._engine, self._site, os.path.join(self.path, basename))
+
+                # Make sure that newly loaded plugins have proper state.
+                pluginState = self._stateData.get(newPlugins[basename].getName())
+                if pluginState:
+                    newPlugins[basename].setState(pluginState)
+
+            newPlugins[basename].load()
+
+        for basename, plugin in self._plugins.items():
+            if basename not in newPlugins:
+                plugin.cancelTimers()
+
+        self._plugins = newPlugins
+
+    def __iter__(self):
+        for basename in sorted(self._plugins.keys()):
+            yield self._plugins[basename]
+
+
+class Plugin(object):
+    """
+    The plugin class represents a file on disk which contains one or more
+    callbacks.
+    """
+
+    PRIORITIES = ['high', 'normal', 'low']
+
+    SHEDDING_POLICIES = ['skip', 'latest', 'sample']
+
+    def __init__(self, engine, site, path):
         """
         @param engine: The engine that instanciated this plugin.
         @type engine: L{Engine}
+        @param site: The Shotgun site this plugin processes events for.
+        @type site: L{Site}
         @param path: The path of the plugin file to load.
         @type path: I{str}
 
         @raise ValueError: If the path to the plugin is not a valid file.
         """
         self._engine = engine
+        self._site = site
         self._path = path
 
         if not os.path.isfile(path):
@@ -565,21 +1638,139 @@ class Plugin(object):
         self._pluginName = os.path.splitext(os.path.split(self._path)[1])[0]
         self._active = True
         self._callbacks = []
+        self._timers = []
         self._mtime = None
         self._lastEventId = None
         self._backlog = {}
-
-        # Setup the plugin's logger
-        self.logger = logging.getLogger('plugin.' + self.getName())
+        self._stateChanged = False
+        self._sites = None
+        self._paused = False
+        self._registered = False
+        self._router = None
+        self._scriptNames = set()
+        self._priority = 'normal'
+        self._shedding = None
+        self._shed = set()
+        self._shedCount = 0
+
+        # Setup the plugin's logger, one per site when there are many.
+        loggerName = 'plugin.' + self.getName()
+        if site.getName() is not None:
+            loggerName = 'plugin.%s.%s' % (site.getName(), self.getName())
+        self.logger = logging.getLogger(loggerName)
         self.logger.config = self._engine.config
         self._engine.setEmailsOnLogger(self.logger, True)
         self.logger.setLevel(self._engine.config.getLogLevel())
         if self._engine.config.getLogMode() == 1:
-            _setFilePathOnLogger(self.logger, self._engine.config.getLogFile('plugin.' + self.getName()))
+            _setFilePathOnLogger(self.logger, self._engine.config.getLogFile(loggerName))
 
     def getName(self):
         return self._pluginName
 
+    def getSite(self):
+        return self._site
+
+    def getSiteName(self):
+        """
+        Get the name of the Shotgun site this plugin is processing events for.
+
+        @return: The site name or None when the daemon has a single [shotgun]
+            section.
+        @rtype: I{str}
+        """
+        return self._site.getName()
+
+    def getEventHistory(self):
+        """
+        Get the local copy of the recent events of the site, to look up event
+        history without querying Shotgun.
+
+        @return: The history or None if it is disabled.
+        @rtype: L{eventHistory.EventHistory}
+        """
+        return self._site.getEventHistory()
+
+    def getStore(self, name=None):
+        """
+        Get a key-value store kept by the engine across reloads of the plugin.
+
+        @param name: The name of a namespace shared by all plugins. By default
+            the store of this plugin on its site.
+        @type name: I{str}
+
+        @rtype: L{pluginStore.Store}
+        """
+        if name is not None:
+            return self._engine.getPluginStore('shared:' + name)
+        elif self._site.getName() is not None:
+            return self._engine.getPluginStore('plugin:%s:%s' % (self._site.getName(), self.getName()))
+        return self._engine.getPluginStore('plugin:' + self.getName())
+
+    def getPriority(self):
+        return self._priority
+
+    def setPriority(self, priority):
+        """
+        Set the lane the plugin's events are dispatched in.
+
+        @param priority: One of L{PRIORITIES}.
+        @type priority: I{str}
+
+        @raise ValueError: If the priority is unknown.
+        """
+        if priority not in self.PRIORITIES:
+            raise ValueError('Unknown priority %s, use one of %s.' % (priority, ', '.join(self.PRIORITIES)))
+        self._priority = priority
+
+    def setSheddingPolicy(self, policy, maxLag=300, sampleEvery=10):
+        """
+        Let the engine drop some of the events of this plugin when it lags
+        too far behind.
+
+        @param policy: One of L{SHEDDING_POLICIES} or None to process all the
+            events.
+        @type policy: I{str}
+        @param maxLag: The number of seconds since the oldest event waiting
+            for the plugin was created above which events are shed.
+        @type maxLag: I{int}
+        @param sampleEvery: For the I{sample} policy, the one event in how
+            many that is processed.
+        @type sampleEvery: I{int}
+
+        @raise ValueError: If the policy is unknown.
+        """
+        if policy is None:
+            self._shedding = None
+            return
+        if policy not in self.SHEDDING_POLICIES:
+            raise ValueError('Unknown shedding policy %s, use one of %s.' % (policy, ', '.join(self.SHEDDING_POLICIES)))
+        self._shedding = (policy, maxLag, max(int(sampleEvery), 1))
+
+    def getShedCount(self):
+        """
+        @return: The number of events shed since the plugin was loaded.
+        @rtype: I{int}
+        """
+        return self._shedCount
+
+    def setSites(self, *sites):
+        """
+        Set the names of the Shotgun sites this plugin applies to. By default
+        a plugin applies to all sites.
+
+        @param sites: The site names.
+        @type sites: I{str}
+        """
+        self._sites = sites
+
+    def appliesToSite(self):
+        """
+        Should this plugin process events of its site.
+
+        @rtype: I{bool}
+        """
+        return self._sites is None or self._site.getName() is None or self._site.getName() in self._sites
+
     def setState(self, state):
         if isinstance(state, int):
             self._lastEventId = state
@@ -587,10 +1778,28 @@ class Plugin(object):
             self._lastEventId, self._backlog = state
         else:
             raise ValueError('Unknown state type: %s.' % type(state))
+        self._stateChanged = True
 
     def getState(self):
         return (self._lastEventId, self._backlog)
 
+    def getLastEventId(self):
+        return self._lastEventId
+
+    def getBacklogIds(self):
+        return self._backlog.keys()
+
+    def isStateChanged(self):
+        """
+        Has the state of this plugin changed since it was last saved.
+
+        @rtype: I{bool}
+        """
+        return self._stateChanged
+
+    def setStateChanged(self, changed):
+        self._stateChanged = changed
+
     def getNextUnprocessedEventId(self):
         if self._lastEventId:
             nextId = self._lastEventId + 1
@@ -603,6 +1812,7 @@ class Plugin(object):
             if v < now:
                 self.logger.warning('Timeout elapsed on backlog event id %d.', k)
                 del(self._backlog[k])
+                self._stateChanged = True
             elif nextId is None or k < nextId:
                 nextId = k
 
@@ -615,27 +1825,73 @@ class Plugin(object):
         @return: True if this plugin's callbacks should be run, False otherwise.
         @rtype: I{bool}
         """
-        return self._active
+        return self._active and not self._paused and self.appliesToSite()
 
-    def setEmails(self, *emails):
+    def isPaused(self):
+        return self._paused
+
+    def setPaused(self, paused):
         """
-        Set the email addresses to whom this plugin should send errors.
+        Pause or resume the processing of events by this plugin. A paused
+        plugin keeps its state and catches up once resumed.
 
-        @param emails: See L{LogFactory.getLogger}'s emails argument for info.
-        @type emails: A I{list}/I{tuple} of email addresses or I{bool}.
+        @type paused: I{bool}
         """
-        self._engine.setEmailsOnLogger(self.logger, emails)
+        self._paused = paused
+        self.logger.info('Plugin %s.', 'paused' if paused else 'resumed')
 
-    def load(self):
+    def reactivate(self):
         """
-        Load/Reload the plugin and all its callbacks.
+        Reactivate this plugin and its callbacks after an error deactivated
+        them. Processing resumes from the last event processed.
 
-        If a plugin has never been loaded it will be loaded normally. If the
-        plugin has been loaded before it will be reloaded only if the file has
-        been modified on disk. In this event callbacks will all be cleared and
-        reloaded.
+        @raise ValueError: If the plugin could not even be registered.
+        """
+        if not self._registered:
+            raise ValueError('The plugin at %s was not registered, fix it so it reloads.' % self._path)
 
-        General behavior:
+        self._active = True
+        for callback in self:
+            callback.reactivate()
+        self.logger.info('Plugin reactivated from event %s.', self._lastEventId)
+
+    def skipTo(self, eventId):
+        """
+        Consider all the events up to an id processed.
+
+        @param eventId: The id of the last event to skip.
+        @type eventId: I{int}
+
+        @raise ValueError: If the plugin already went past that id.
+        """
+        if self._lastEventId is not None and eventId < self._lastEventId:
+            raise ValueError('Plugin %s already processed events up to %d.' % (self.getName(), self._lastEventId))
+
+        skipped = len([i for i in self._backlog if i <= eventId])
+        self._backlog = dict([(k, v) for k, v in self._backlog.items() if k > eventId])
+        self.logger.warning('Skipping events %s to %d and %d backlog events.', self._lastEventId, eventId, skipped)
+        self._lastEventId = eventId
+        self._stateChanged = True
+
+    def setEmails(self, *emails):
+        """
+        Set the email addresses to whom this plugin should send errors.
+
+        @param emails: See L{LogFactory.getLogger}'s emails argument for info.
+        @type emails: A I{list}/I{tuple} of email addresses or I{bool}.
+        """
+        self._engine.setEmailsOnLogger(self.logger, emails)
+
+    def load(self, force=False):
+        """
+        Load/Reload the plugin and all its callbacks.
+
+        If a plugin has never been loaded it will be loaded normally. If the
+        plugin has been loaded before it will be reloaded only if the file has
+        been modified on disk or if forced. In this event callbacks will all be
+        cleared and reloaded.
+
+        General behavior:
         - Try to load the source of the plugin.
         - Try to find a function called registerCallbacks in the file.
         - Try to run the registration function.
@@ -647,7 +1903,7 @@ class Plugin(object):
         mtime = os.path.getmtime(self._path)
         if self._mtime is None:
             self._engine.log.info('Loading plugin at %s' % self._path)
-        elif self._mtime < mtime:
+        elif self._mtime < mtime or force:
             self._engine.log.info('Reloading plugin at %s' % self._path)
         else:
             # The mtime of file is equal or older. We don't need to do anything.
@@ -656,10 +1912,20 @@ class Plugin(object):
         # Reset values
         self._mtime = mtime
         self._callbacks = []
+        self.cancelTimers()
+        self._router = None
+        self._scriptNames = set()
         self._active = True
+        self._registered = False
+        self._sites = None
+        self._priority = 'normal'
+        self._shedding = None
+        self._shed = set()
+        if self._site.limiter is not None:
+            self._site.limiter.setPluginRate(self.getName(), None)
 
         try:
-            plugin = imp.load_source(self._pluginName, self._path)
+            plugin = self._engine.loadPluginModule(self._pluginName, self._path, mtime, force)
         except:
             self._active = False
             self.logger.error('Could not load the plugin at %s.\n\n%s', self._path, traceback.format_exc())
@@ -672,71 +1938,1307 @@ class Plugin(object):
             except:
                 self._engine.log.critical('Error running register callback function from plugin at %s.\n\n%s', self._path, traceback.format_exc())
                 self._active = False
+            else:
+                self._registered = True
+
+            if not self.appliesToSite():
+                self._engine.log.info('Plugin at %s does not apply to site %s.', self._path, self._site.getName())
+                self._callbacks = []
+                self.cancelTimers()
         else:
             self._engine.log.critical('Did not find a registerCallbacks function in plugin at %s.', self._path)
             self._active = False
 
-    def registerCallback(self, sgScriptName, sgScriptKey, callback, matchEvents=None, args=None):
+    def registerCallback(self, sgScriptName, sgScriptKey, callback, matchEvents=None, args=None, coalesce=None, idempotent=True, predicates=None, ignoreOwnEvents=None, prefetch=None):
         """
         Register a callback in the plugin.
         """
-        global sg
-        sgConnection = sg.Shotgun(self._engine.config.getShotgunURL(), sgScriptName, sgScriptKey)
-        self._callbacks.append(Callback(callback, self, self._engine, sgConnection, matchEvents, args))
+        if not self.appliesToSite():
+            return
+
+        sgConnection = self._connect(sgScriptName, sgScriptKey)
+        self._addCallback(Callback(callback, self, self._engine, sgConnection, matchEvents, args, coalesce, idempotent, predicates, sgScriptName, ignoreOwnEvents, prefetch))
+        self._scriptNames.add(sgScriptName)
+        self._router = None
+
+    def registerBatchCallback(self, sgScriptName, sgScriptKey, callback, matchEvents=None, args=None, batchSize=None, batchAge=None, predicates=None, ignoreOwnEvents=None, prefetch=None):
+        """
+        Register a callback that receives lists of events in the plugin.
+        """
+        if not self.appliesToSite():
+            return
+
+        sgConnection = self._connect(sgScriptName, sgScriptKey)
+        self._addCallback(BatchCallback(callback, self, self._engine, sgConnection, matchEvents, args, batchSize, batchAge, predicates, sgScriptName, ignoreOwnEvents, prefetch))
+        self._scriptNames.add(sgScriptName)
+        self._router = None
+
+    def _addCallback(self, callback):
+        # Registrations of the same function or class are told apart in the
+        # ledger by their order.
+        key = callback.getLedgerKey()
+        count = len([c for c in self._callbacks if c.getLedgerKey().split('#')[0] == key])
+        if count:
+            callback.setLedgerKey('%s#%d' % (key, count + 1))
+        self._callbacks.append(callback)
+
+    def registerTimer(self, sgScriptName, sgScriptKey, callback, interval=None, cron=None, args=None, jitter=0, name=None):
+        """
+        Register a callback run periodically by the engine.
+        """
+        if not self.appliesToSite():
+            return
+
+        # Timers run concurrently with the event callbacks, each one gets its
+        # own connection.
+        sgConnection = self._connect(sgScriptName, sgScriptKey)
+        name = 'timers.%s.%s' % (self.getName(), name or callback.__name__)
+
+        def run():
+            if not self.isActive():
+                return
+            try:
+                callback(sgConnection, self.logger, args)
+            except:
+                self._site.metrics.increment(name + '.failures')
+                self.logger.critical('Error running timer %s.\n\n%s', callback.__name__, traceback.format_exc())
+
+        timer = timers.Timer(name, run, interval, cron, jitter, self._site.metrics)
+        self._timers.append(timer)
+        self._engine.addTimer(timer)
+
+    def cancelTimers(self):
+        """
+        Stop running the timers of the plugin, before it is reloaded or
+        removed.
+        """
+        for timer in self._timers:
+            timer.cancel()
+        self._timers = []
+
+    def getScriptNames(self):
+        """
+        @return: The names of the API scripts the callbacks connect with.
+        @rtype: I{set} of I{str}
+        """
+        return self._scriptNames
+
+    def setRateLimit(self, rate):
+        """
+        Override the number of requests per second the callbacks of this
+        plugin can make to the site.
+
+        @param rate: The requests per second, 0 for no limit.
+        @type rate: I{float}
+        """
+        if self._site.limiter is not None:
+            self._site.limiter.setPluginRate(self.getName(), rate)
+        else:
+            self.logger.warning('Requests to the site are not limited, ignoring the rate limit of %s.', rate)
+
+    def _connect(self, sgScriptName, sgScriptKey):
+        return self._site.connect(sgScriptName, sgScriptKey, self)
+
+    def prepare(self, events):
+        """
+        Give the callbacks a look at all the events this plugin is about to
+        process so they can plan ahead (coalescing).
+
+        @param events: The events about to be dispatched, in id order.
+        @type events: I{list} of Shotgun event dictionaries.
+        """
+        pending = []
+        for event in events:
+            if event['id'] in self._backlog or self._lastEventId is None or event['id'] > self._lastEventId:
+                pending.append(event)
+
+        # Events shed on a pass that stopped before reaching them stay shed.
+        carried = set([e['id'] for e in pending if e['id'] in self._shed])
+        self._shed = carried | self._getEventsToShed([e for e in pending if e['id'] not in carried])
+        if self._shed:
+            pending = [e for e in pending if e['id'] not in self._shed]
+
+        for callback in self:
+            if callback.isActive():
+                callback.prepare(pending)
+
+    def _getEventsToShed(self, events):
+        """
+        Apply the shedding policy to the events the plugin is about to
+        process.
+
+        @param events: The pending events, in id order.
+        @type events: I{list} of Shotgun event dictionaries.
+
+        @return: The ids of the events to consider processed without
+            dispatching them.
+        @rtype: I{set} of I{int}
+        """
+        if self._shedding is None or not events:
+            return set()
+
+        policy, maxLag, sampleEvery = self._shedding
+        lag = _getEventAge(events[0])
+        if lag is None or lag <= maxLag:
+            return set()
+
+        if policy == 'skip':
+            shed = set([e['id'] for e in events])
+        elif policy == 'latest':
+            latest = {}
+            for event in events:
+                entity = event.get('entity')
+                if entity:
+                    latest[(entity['type'], entity['id'])] = event['id']
+                else:
+                    latest[event['id']] = event['id']
+            kept = set(latest.values())
+            shed = set([e['id'] for e in events if e['id'] not in kept])
+        else:
+            shed = set([e['id'] for e in events if e['id'] % sampleEvery])
+
+        if shed:
+            self._shedCount += len(shed)
+            self._site.metrics.increment('events.shed', len(shed))
+            msg = 'Lagging %d seconds behind, shedding %d of %d events with the %s policy: %s'
+            self.logger.warning(msg, lag, len(shed), len(events), policy, _formatIdRanges(shed))
+        return shed
 
     def process(self, event):
         if event['id'] in self._backlog:
             if self._process(event):
+                self.logger.info('Processed id %d from backlog.', event['id'])
                 del(self._backlog[event['id']])
-                self._updateLastEventId(event['id'])
+                self._stateChanged = True
         elif self._lastEventId is not None and event['id'] <= self._lastEventId:
-            msg = 'Event %d is too old. Last event processed was (%d).'
-            self.logger.debug(msg, event['id'], self._lastEventId)
+            # Plugins are served from their own cursor, other plugins needed
+            # this event.
+            pass
         else:
             if self._process(event):
                 self._updateLastEventId(event['id'])
 
-        return self._active
+        return self._active
+
+    def _process(self, event):
+        if event['id'] in self._shed:
+            # Recorded as processed, it was logged when it was shed.
+            self._shed.discard(event['id'])
+            return self._active
+
+        # Only the callbacks accepting the project and user of the event.
+        for callback in self.getCandidates(event):
+            if callback.isActive():
+                if callback.canProcess(event):
+                    msg = 'Dispatching event %d to callback %s.'
+                    self.logger.debug(msg, event['id'], str(callback))
+                    if not self._processWithCallback(callback, event):
+                        # A callback in the plugin failed. Deactivate the whole
+                        # plugin.
+                        self._active = False
+                        break
+            else:
+                msg = 'Skipping inactive callback %s in plugin.'
+                self.logger.debug(msg, str(callback))
+
+        return self._active
+
+    def _processWithCallback(self, callback, event):
+        ledger = None
+        if not callback.isIdempotent():
+            ledger = self._site.getLedger()
+
+        if ledger is not None and ledger.isCompleted(self._path, callback.getLedgerKey(), event['id']):
+            self.logger.info('Event %d was already completed by callback %s.', event['id'], str(callback))
+            return True
+
+        tracer = self._engine.tracer
+        trace = tracer and tracer.getCurrentTrace()
+        if trace is None:
+            active = callback.process(event)
+        else:
+            trace.push('callback %s.%s' % (self.getName(), callback), {'plugin': self.getName(), 'callback': str(callback)})
+            active = callback.process(event)
+            trace.pop(None if active else 'The callback was deactivated.')
+
+        if active and ledger is not None:
+            try:
+                ledger.record(self._path, callback.getLedgerKey(), event['id'])
+            except (OSError, IOError), err:
+                self.logger.error('Can not record the completion of event %d: %s', event['id'], err)
+        return active
+
+    def _updateLastEventId(self, eventId):
+        if self._lastEventId is not None and eventId > self._lastEventId + 1:
+            expiration = datetime.datetime.now() + datetime.timedelta(seconds=self._site.getBacklogTimeout())
+            for skippedId in range(self._lastEventId + 1, eventId):
+                self.logger.debug('Adding event id %d to backlog.', skippedId)
+                self._backlog[skippedId] = expiration
+        self._lastEventId = eventId
+        self._stateChanged = True
+
+    def getCandidates(self, event):
+        """
+        @return: The callbacks of the plugin accepting the project and user of
+            the event, in registration order.
+        @rtype: I{list} of L{Callback}
+        """
+        if self._router is None:
+            self._router = CallbackRouter(self._site, self._callbacks)
+        return self._router.getCandidates(event)
+
+    def __iter__(self):
+        """
+        A plugin is iterable and will iterate over all its L{Callback} objects.
+        """
+        return self._callbacks.__iter__()
+
+    def __str__(self):
+        """
+        Provide the name of the plugin when it is cast as string.
+
+        @return: The name of the plugin.
+        @rtype: I{str}
+        """
+        return self.getName()
+
+
+class EventFetcher(object):
+    """
+    Fetches events from Shotgun and keeps the recently fetched ones in a
+    sliding window so each plugin can be served from its own cursor.
+
+    The window covers a contiguous range of event ids. Any id in that range
+    which is not in the window was not committed when it was fetched, those
+    are the only ids of the range ever asked for again.
+    """
+
+    FIELDS = ['id', 'event_type', 'attribute_name', 'meta', 'entity', 'user', 'project', 'session_uuid', 'created_at']
+
+    def __init__(self, site, shotgun, pageSize, windowSize):
+        """
+        @param site: The site events are fetched from.
+        @type site: L{Site}
+        @param shotgun: The connection used to fetch events.
+        @type shotgun: L{sg.Shotgun}
+        @param pageSize: The maximum number of events per request.
+        @type pageSize: I{int}
+        @param windowSize: The maximum number of events kept in memory.
+        @type windowSize: I{int}
+        """
+        self._site = site
+        self._sg = shotgun
+        self._pageSize = pageSize
+        self._windowSize = windowSize
+        self._events = {}
+        self._ids = []
+        self._startId = None
+        self._headId = None
+        self._more = False
+        self._gapResolver = None
+        self._prefetcher = None
+
+    def setPrefetcher(self, prefetcher):
+        """
+        @param prefetcher: Requests the new events in the background.
+        @type prefetcher: L{EventPrefetcher}
+        """
+        self._prefetcher = prefetcher
+
+    def stop(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+
+    def setGapResolver(self, gapResolver):
+        """
+        @param gapResolver: The resolver told about the ids skipped by fetches.
+        @type gapResolver: L{GapResolver}
+        """
+        self._gapResolver = gapResolver
+
+    def fetch(self, plugins):
+        """
+        Fetch the events the plugins need that are not in the window.
+
+        @param plugins: The active plugins.
+        @type plugins: I{list} of L{Plugin}
+
+        @return: The events added to the window, in id order.
+        @rtype: I{list} of Shotgun event dictionaries.
+        """
+        nextEventId = None
+        for newId in [p.getNextUnprocessedEventId() for p in plugins]:
+            if newId is not None and (nextEventId is None or newId < nextEventId):
+                nextEventId = newId
+
+        if nextEventId is None:
+            return []
+
+        fetched = []
+        self._more = False
+        if self._headId is None:
+            self._startId = nextEventId
+            self._headId = nextEventId - 1
+        elif nextEventId < self._startId:
+            # A plugin fell behind the window.
+            older = self.findEvents([['id', 'between', [nextEventId, self._startId - 1]]])
+            if len(older) < self._pageSize:
+                self._startId = nextEventId
+            else:
+                self._more = True
+            fetched.extend(older)
+
+        if self._prefetcher is None:
+            newEvents = self.findEvents([['id', 'greater_than', self._headId]])
+            if len(newEvents) >= self._pageSize:
+                self._more = True
+        else:
+            if not self._prefetcher.isRunning():
+                self._prefetcher.start(self._headId)
+            newEvents = self._prefetcher.getPage()
+            if self._prefetcher.hasPages():
+                self._more = True
+        if newEvents:
+            # Ids skipped in the new events were not committed yet.
+            returned = set([e['id'] for e in newEvents])
+            skipped = [i for i in xrange(self._headId + 1, newEvents[-1]['id']) if i not in returned]
+            if skipped and self._gapResolver is not None:
+                self._gapResolver.addGaps(skipped)
+            self._headId = newEvents[-1]['id']
+        fetched.extend(newEvents)
+
+        return self.add(fetched)
+
+    def add(self, events):
+        """
+        Add events to the window.
+
+        @param events: The fetched events.
+        @type events: I{list} of Shotgun event dictionaries.
+
+        @return: The events that were not in the window already, in id order.
+        @rtype: I{list} of Shotgun event dictionaries.
+        """
+        added = []
+        for event in events:
+            if event['id'] in self._events:
+                continue
+            self._events[event['id']] = event
+            if not self._ids or event['id'] > self._ids[-1]:
+                self._ids.append(event['id'])
+            else:
+                bisect.insort(self._ids, event['id'])
+            added.append(event)
+
+        added.sort(key=lambda e: e['id'])
+        return added
+
+    def getMissingIds(self, eventIds):
+        """
+        Get the ids of the covered range that are not in the window.
+
+        @param eventIds: The event ids to check.
+        @type eventIds: Any iterable of I{int}
+
+        @rtype: I{list} of I{int}
+        """
+        if self._headId is None:
+            return []
+        return [i for i in eventIds if self._startId <= i <= self._headId and i not in self._events]
+
+    def getPendingEvents(self, plugin, newEvents):
+        """
+        Get the events of the window a plugin still has to process.
+
+        @param plugin: The plugin to serve.
+        @type plugin: L{Plugin}
+        @param newEvents: The events added to the window by the last fetch.
+            Plugins that never processed an event only get these.
+        @type newEvents: I{list} of Shotgun event dictionaries.
+
+        @rtype: I{list} of Shotgun event dictionaries.
+        """
+        lastEventId = plugin.getLastEventId()
+        if lastEventId is None:
+            return newEvents
+
+        events = [self._events[i] for i in self._ids[bisect.bisect_right(self._ids, lastEventId):]]
+        for eventId in plugin.getBacklogIds():
+            if eventId in self._events:
+                events.append(self._events[eventId])
+        return events
+
+    def evict(self, plugins):
+        """
+        Drop the events no active plugin needs anymore and keep the window
+        within its maximum size.
+
+        @param plugins: The active plugins.
+        @type plugins: I{list} of L{Plugin}
+        """
+        keepFrom = None
+        for plugin in plugins:
+            newId = plugin.getNextUnprocessedEventId()
+            if newId is not None and (keepFrom is None or newId < keepFrom):
+                keepFrom = newId
+
+        index = 0
+        if keepFrom is not None:
+            index = bisect.bisect_left(self._ids, keepFrom)
+        index = max(index, len(self._ids) - self._windowSize)
+
+        if index > 0:
+            for eventId in self._ids[:index]:
+                del(self._events[eventId])
+            self._startId = max(self._startId, self._ids[index - 1] + 1)
+            self._ids = self._ids[index:]
+
+    def hasMore(self):
+        """
+        Did the last fetch leave new events on the server.
+
+        @rtype: I{bool}
+        """
+        return self._more
+
+    def getHeadId(self):
+        return self._headId
+
+    def getStartId(self):
+        return self._startId
+
+    def getPageSize(self):
+        return self._pageSize
+
+    def findEvents(self, filters, shotgun=None, order='asc', limit=None):
+        """
+        Request events from Shotgun, retrying until the connection succeeds.
+
+        @param filters: The filters on the EventLogEntry entities.
+        @type filters: I{list}
+        @param shotgun: The connection to use if not the fetcher's.
+        @type shotgun: L{sg.Shotgun}
+        @param order: The direction of the id order.
+        @type order: I{str}
+        @param limit: The maximum number of events, a page by default.
+        @type limit: I{int}
+
+        @return: At most a page of events, in id order.
+        @rtype: I{list} of Shotgun event dictionaries.
+        """
+        order = [{'column':'id', 'direction':order}]
+        shotgun = shotgun or self._sg
+
+        while True:
+            try:
+                start = time.time()
+                events = shotgun.find("EventLogEntry", filters=filters, fields=self.FIELDS, order=order, filter_operator='all', limit=limit or self._pageSize)
+            except (sg.ProtocolError, sg.ResponseError, socket.error), err:
+                # Reported to the health of the site, which delays the next
+                # attempt.
+                pass
+            except Exception, err:
+                self._site.health.recordFailure("Unknown error: %s" % str(err))
+            else:
+                tracer = self._site.getTracer()
+                if tracer is not None:
+                    end = time.time()
+                    attributes = {'site': str(self._site.getName()), 'fetch.size': len(events)}
+                    for event in events:
+                        tracer.recordFetch((self._site.getName(), event['id']), event['id'], start, end, attributes)
+                return events
+
+
+class EventPrefetcher(object):
+    """
+    Requests the pages of new events on its own thread so the next page is
+    fetched while the current one is dispatched.
+
+    At most I{depth} pages wait to be dispatched, the thread blocks when that
+    many are queued. Queued pages are not part of the plugins' state, they are
+    fetched again after a restart.
+    """
+
+    def __init__(self, site, fetcher, shotgun, depth, interval):
+        """
+        @param site: The site events are fetched from.
+        @type site: L{Site}
+        @param fetcher: The fetcher the pages are handed to.
+        @type fetcher: L{EventFetcher}
+        @param shotgun: The connection used by the thread.
+        @type shotgun: L{sg.Shotgun}
+        @param depth: The maximum number of queued pages.
+        @type depth: I{int}
+        @param interval: Seconds to wait when Shotgun has no more events.
+        @type interval: I{int}
+        """
+        self._site = site
+        self._fetcher = fetcher
+        self._sg = shotgun
+        self._queue = Queue.Queue(depth)
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def isRunning(self):
+        return self._thread is not None
+
+    def start(self, headId):
+        """
+        Start requesting the events following an id.
+
+        @param headId: The id of the last event already fetched.
+        @type headId: I{int}
+        """
+        self._thread = threading.Thread(target=self._run, args=(headId,), name='prefetch-%s' % self._site.getName())
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            # A request being retried may take longer, the thread is a daemon.
+            self._thread.join(self._interval + 1)
+
+    def getPage(self):
+        """
+        @return: The next queued page or an empty list.
+        @rtype: I{list} of Shotgun event dictionaries.
+        """
+        try:
+            page = self._queue.get_nowait()
+        except Queue.Empty:
+            page = []
+        self._site.metrics.setValue('prefetch.queued', self._queue.qsize())
+        return page
+
+    def hasPages(self):
+        return not self._queue.empty()
+
+    def _run(self, headId):
+        while not self._stopped.isSet():
+            try:
+                events = self._fetcher.findEvents([['id', 'greater_than', headId]], self._sg)
+            except Exception:
+                self._site.log.critical('Unexpected error prefetching events.\n\n%s', traceback.format_exc())
+                self._stopped.wait(self._interval)
+                continue
+
+            if events:
+                headId = events[-1]['id']
+                while not self._stopped.isSet():
+                    try:
+                        self._queue.put(events, timeout=1)
+                        break
+                    except Queue.Full:
+                        self._site.metrics.increment('prefetch.full')
+                self._site.wakeUp()
+
+            if len(events) < self._fetcher.getPageSize():
+                self._stopped.wait(self._interval)
+
+
+class CatchUpWorker(object):
+    """
+    Serves the plugins whose cursor is far behind the head, after a plugin is
+    added with an old state or comes back from a long pause, so the live
+    lanes don't walk history with them.
+
+    The worker pages through history with its own fetcher, in turns of a time
+    slice after the live lanes of each pass, with an optional limit on the
+    events dispatched per second. With a L{HistoryDownloader}, the history up
+    to the head is downloaded over several connections at once. A plugin goes
+    back to the live lanes once its cursor reaches the live event window.
+    """
+
+    def __init__(self, engine, site, fetcher, threshold, rate=0, downloader=None):
+        """
+        @param engine: The engine whose lock is held while dispatching.
+        @type engine: L{Engine}
+        @param site: The site the plugins process events of.
+        @type site: L{Site}
+        @param fetcher: The fetcher whose connection pages through history.
+        @type fetcher: L{EventFetcher}
+        @param threshold: The number of events a plugin must be behind the
+            head to be served by the worker.
+        @type threshold: I{int}
+        @param rate: The maximum number of events dispatched per second, 0
+            for no limit.
+        @type rate: I{float}
+        @param downloader: Downloads the history concurrently, if any.
+        @type downloader: L{HistoryDownloader}
+        """
+        self._engine = engine
+        self._site = site
+        self._fetcher = fetcher
+        self._threshold = threshold
+        self._downloader = downloader
+        self._headId = None
+        self._bucket = None
+        if rate > 0:
+            self._bucket = rateLimit.TokenBucket(rate)
+        self._reserved = False
+        self._readyAt = 0
+        self._plugins = []
+        self._events = []
+        # The id of the last event of the pages handed to the plugins.
+        self._lastId = None
+
+    def isCatchingUp(self, plugin):
+        return plugin in self._plugins
+
+    def hasWork(self):
+        """
+        Can the worker dispatch events right away.
+
+        @rtype: I{bool}
+        """
+        if time.time() < self._readyAt:
+            return False
+        return bool([p for p in self._plugins if p.isActive()])
+
+    def assign(self, plugins):
+        """
+        Take over the plugins too far behind the head.
+
+        @param plugins: The plugins of the live lanes.
+        @type plugins: I{list} of L{Plugin}
+
+        @return: Whether plugins were taken over.
+        @rtype: I{bool}
+        """
+        headId = self._site.getHeadEventId()
+        if headId is None:
+            if not [p for p in plugins if p.getLastEventId() is not None]:
+                return False
+            # Nothing was fetched yet, ask for the last event.
+            latest = self._fetcher.findEvents([], order='desc', limit=1)
+            if not latest:
+                return False
+            headId = latest[0]['id']
+        self._headId = headId
+
+        assigned = []
+        for plugin in plugins:
+            nextId = plugin.getNextUnprocessedEventId()
+            if nextId is not None and headId - nextId > self._threshold:
+                self._site.log.info('Plugin %s is %d events behind, catching up separately.', plugin.getName(), headId - nextId)
+                assigned.append(plugin)
+
+        if assigned:
+            self._plugins.extend(assigned)
+            # The next page starts from the oldest cursor.
+            self._events = []
+            self._lastId = None
+            if self._downloader is not None:
+                self._downloader.clear()
+            self._site.metrics.setValue('catchup.plugins', len(self._plugins))
+        return bool(assigned)
+
+    def stop(self):
+        if self._downloader is not None:
+            self._downloader.stop()
+
+    def run(self, budget):
+        """
+        Dispatch events to the plugins catching up for a time.
+
+        @param budget: The number of seconds the worker can take.
+        @type budget: I{float}
+        """
+        lock = self._engine.lock
+        tracer = self._site.getTracer()
+        start = time.time()
+
+        lock.acquire()
+        try:
+            self._release()
+        finally:
+            lock.release()
+
+        dispatched = 0
+        while self.hasWork() and time.time() - start < budget:
+            if not self._events and not self._fetchPage(budget - (time.time() - start)):
+                break
+
+            if self._bucket is not None and not self._reserved:
+                delay = self._bucket.reserve()
+                if delay > 0:
+                    # The token is the next event's.
+                    self._reserved = True
+                    self._readyAt = time.time() + delay
+                    break
+            self._reserved = False
+
+            event = self._events.pop(0)
+            lock.acquire()
+            try:
+                if self._engine.isDraining():
+                    break
+                if tracer is not None:
+                    tracer.startDispatch((self._site.getName(), event['id']))
+                for plugin in self._plugins:
+                    if plugin.isActive():
+                        plugin.process(event)
+                dispatched += 1
+                if tracer is not None:
+                    tracer.finishDispatch()
+            finally:
+                lock.release()
+
+        if dispatched:
+            self._site.metrics.increment('catchup.dispatched', dispatched)
+            lock.acquire()
+            try:
+                self._site.saveEventIdData()
+            finally:
+                lock.release()
+
+    def _fetchPage(self, timeout):
+        """
+        Fetch the next page of history for the plugins.
+
+        @param timeout: The maximum number of seconds to wait for the
+            downloader.
+        @type timeout: I{float}
+
+        @return: Whether there are events to dispatch.
+        @rtype: I{bool}
+        """
+        nextIds = [p.getNextUnprocessedEventId() for p in self._plugins if p.isActive()]
+        nextIds = [i for i in nextIds if i is not None]
+        if not nextIds:
+            return False
+
+        # The pages follow each other from the oldest cursor, the backlogs are
+        # only looked at again when a plugin is behind the events handed out.
+        cursorIds = [p.getLastEventId() for p in self._plugins if p.isActive()]
+        fromId = min([i + 1 for i in cursorIds if i is not None] or nextIds)
+        restart = self._lastId is None or fromId <= self._lastId
+        if restart:
+            fromId = min(nextIds)
+
+        events = None
+        if self._downloader is not None and self._headId is not None:
+            if restart:
+                self._downloader.reset(fromId, self._headId)
+            events = self._downloader.getPage(timeout)
+            if events == []:
+                # The next chunk is still downloading.
+                self._site.metrics.increment('catchup.waits')
+                return False
+
+        if events is None:
+            # Past the head known when the plugins were taken over, or
+            # without a downloader, page through with a single connection.
+            events = self._fetcher.findEvents([['id', 'greater_than', fromId - 1]])
+        self._events = events
+        if events:
+            self._lastId = events[-1]['id']
+        self._site.metrics.increment('catchup.pages')
+        if not self._events:
+            # Nothing left in history, the live fetcher takes it from here.
+            self._site.log.info('No more events to catch up with, back to the live events.')
+            self._plugins = []
+            self._site.metrics.setValue('catchup.plugins', 0)
+            return False
+
+        self._site.prefetchEntities(self._events, [p for p in self._plugins if p.isActive()])
+        for plugin in self._plugins:
+            if plugin.isActive():
+                plugin.prepare(self._events)
+        return bool(self._events)
+
+    def _release(self):
+        """
+        Hand the plugins that reached the live event window back to the live
+        lanes, and forget the plugins that were unloaded.
+        """
+        loaded = self._site.getPlugins()
+        startId = self._site.getLiveStartEventId()
+        plugins = []
+        for plugin in self._plugins:
+            if plugin not in loaded:
+                continue
+
+            nextId = plugin.getNextUnprocessedEventId()
+            if nextId is None or (startId is not None and nextId >= startId):
+                self._site.log.info('Plugin %s caught up, back to the live events.', plugin.getName())
+            else:
+                plugins.append(plugin)
+
+        if len(plugins) != len(self._plugins):
+            self._plugins = plugins
+            self._events = []
+            self._lastId = None
+            if self._downloader is not None:
+                self._downloader.clear()
+            self._site.metrics.setValue('catchup.plugins', len(self._plugins))
+
+
+class HistoryDownloader(object):
+    """
+    Downloads a range of history over several connections at once for the
+    L{CatchUpWorker}.
+
+    The range is split in chunks of a page worth of ids, each thread
+    requesting the next chunk nobody took yet. Downloaded chunks wait in a
+    reorder buffer until the chunks before them are read, so events are
+    handed out in id order. The threads stop taking chunks while the buffer
+    is full.
+    """
+
+    def __init__(self, site, fetcher, connections, bufferSize, interval):
+        """
+        @param site: The site events are downloaded from.
+        @type site: L{Site}
+        @param fetcher: The fetcher whose requests are used.
+        @type fetcher: L{EventFetcher}
+        @param connections: The connections of the threads, one each.
+        @type connections: I{list} of L{sg.Shotgun}
+        @param bufferSize: The maximum number of events downloaded ahead.
+        @type bufferSize: I{int}
+        @param interval: Seconds to wait after an unexpected error.
+        @type interval: I{int}
+        """
+        self._site = site
+        self._fetcher = fetcher
+        self._connections = connections
+        self._chunkSize = fetcher.getPageSize()
+        self._maxChunks = max(bufferSize // self._chunkSize, len(connections))
+        self._interval = interval
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+        # The range is replaced, and chunks being downloaded are dropped, on
+        # each reset.
+        self._generation = 0
+        self._startId = None
+        self._endId = None
+        self._nextChunk = 0
+        self._readChunk = 0
+        self._retries = []
+        self._chunks = {}
+
+    def reset(self, startId, endId):
+        """
+        Start downloading a range of ids.
+
+        @param startId: The first id of the range.
+        @type startId: I{int}
+        @param endId: The last id of the range.
+        @type endId: I{int}
+        """
+        self._condition.acquire()
+        try:
+            self._clear()
+            self._startId = startId
+            self._endId = endId
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+        if not self._threads:
+            for index, shotgun in enumerate(self._connections):
+                thread = threading.Thread(target=self._run, args=(shotgun,), name='catchup-%s-%d' % (self._site.getName(), index))
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        self._site.log.info('Downloading events %d to %d over %d connections.', startId, endId, len(self._connections))
+
+    def clear(self):
+        """
+        Drop the range and the downloaded events.
+        """
+        self._condition.acquire()
+        try:
+            self._clear()
+        finally:
+            self._condition.release()
+
+    def _clear(self):
+        self._generation += 1
+        self._startId = None
+        self._endId = None
+        self._nextChunk = 0
+        self._readChunk = 0
+        self._retries = []
+        self._chunks = {}
+        self._site.metrics.setValue('catchup.buffered', 0)
+
+    def stop(self):
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        for thread in self._threads:
+            # A request being retried may take longer, the threads are daemons.
+            thread.join(1)
+
+    def getPage(self, timeout):
+        """
+        Get the events of the next downloaded chunks.
+
+        @param timeout: The maximum number of seconds to wait for the next
+            chunk.
+        @type timeout: I{float}
+
+        @return: The events, an empty list if the next chunk was not
+            downloaded in time or None once the whole range was read.
+        @rtype: I{list} of Shotgun event dictionaries.
+        """
+        deadline = time.time() + timeout
+        self._condition.acquire()
+        try:
+            while self._startId is not None:
+                if self._getChunkStart(self._readChunk) > self._endId:
+                    return None
+
+                if self._readChunk in self._chunks:
+                    events = self._chunks.pop(self._readChunk)
+                    self._readChunk += 1
+                    self._condition.notifyAll()
+                    self._site.metrics.setValue('catchup.buffered', sum([len(c) for c in self._chunks.values()]))
+                    if events:
+                        return events
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self._condition.wait(remaining)
+            return None
+        finally:
+            self._condition.release()
+
+    def _getChunkStart(self, index):
+        return self._startId + index * self._chunkSize
+
+    def _takeChunk(self):
+        """
+        Wait for a chunk to download.
+
+        @return: The generation, index, first and last ids of the chunk or
+            None when stopped.
+        @rtype: I{tuple}
+        """
+        self._condition.acquire()
+        try:
+            while not self._stopped:
+                if self._startId is not None and self._retries:
+                    index = self._retries.pop(0)
+                elif (self._startId is not None and self._getChunkStart(self._nextChunk) <= self._endId
+                      and self._nextChunk - self._readChunk < self._maxChunks):
+                    index = self._nextChunk
+                    self._nextChunk += 1
+                else:
+                    self._condition.wait(1)
+                    continue
+
+                firstId = self._getChunkStart(index)
+                return self._generation, index, firstId, min(firstId + self._chunkSize - 1, self._endId)
+            return None
+        finally:
+            self._condition.release()
+
+    def _run(self, shotgun):
+        while True:
+            chunk = self._takeChunk()
+            if chunk is None:
+                return
+            generation, index, firstId, lastId = chunk
+
+            try:
+                events = self._fetcher.findEvents([['id', 'between', [firstId, lastId]]], shotgun)
+            except Exception:
+                self._site.log.critical('Unexpected error downloading events %d to %d.\n\n%s', firstId, lastId, traceback.format_exc())
+                events = None
+
+            self._condition.acquire()
+            try:
+                if generation == self._generation:
+                    if events is None:
+                        self._retries.append(index)
+                    else:
+                        self._chunks[index] = events
+                        self._site.metrics.increment('catchup.chunks')
+                        self._condition.notifyAll()
+            finally:
+                self._condition.release()
+
+            if events is None:
+                time.sleep(self._interval)
+
+
+class GapResolver(object):
+    """
+    Resolves the gaps left in the event ids by events committed out of order.
+
+    The event ids still in the backlog of the plugins are requested by id on
+    their own schedule. The time it takes for a gap to be filled is observed
+    to adapt how long plugins keep a skipped id in their backlog.
+    """
+
+    SAFETY_FACTOR = 3
+    OBSERVED_DELAYS = 100
+
+    def __init__(self, site, fetcher, checkInterval, chunkSize, timeouts):
+        """
+        @param site: The site the gaps are resolved for.
+        @type site: L{Site}
+        @param fetcher: The fetcher holding the window of events.
+        @type fetcher: L{EventFetcher}
+        @param checkInterval: Seconds between two requests for missing ids.
+        @type checkInterval: I{int}
+        @param chunkSize: Maximum number of ids per request.
+        @type chunkSize: I{int}
+        @param timeouts: The minimum and maximum backlog timeouts in seconds.
+        @type timeouts: I{tuple}
+        """
+        self._site = site
+        self._fetcher = fetcher
+        self._checkInterval = checkInterval
+        self._chunkSize = chunkSize
+        self._minTimeout, self._maxTimeout = timeouts
+        self._gaps = {}
+        self._delays = []
+        self._lastCheck = None
+
+    def addGaps(self, eventIds):
+        """
+        Record event ids that were skipped by a fetch.
+
+        @param eventIds: The skipped ids.
+        @type eventIds: I{list} of I{int}
+        """
+        now = time.time()
+        for eventId in eventIds:
+            self._gaps.setdefault(eventId, now)
+        self._site.metrics.increment('gaps.detected', len(eventIds))
+
+    def resolve(self, plugins):
+        """
+        Request the missing ids of the plugins' backlogs if it is time to.
+
+        @param plugins: The active plugins.
+        @type plugins: I{list} of L{Plugin}
+
+        @return: The late events added to the window, in id order.
+        @rtype: I{list} of Shotgun event dictionaries.
+        """
+        now = time.time()
+        if self._lastCheck is not None and now - self._lastCheck < self._checkInterval:
+            return []
+        self._lastCheck = now
+
+        wanted = set()
+        processedId = None
+        for plugin in plugins:
+            wanted.update(plugin.getBacklogIds())
+            lastEventId = plugin.getLastEventId()
+            if lastEventId is not None and (processedId is None or lastEventId < processedId):
+                processedId = lastEventId
+
+        # Gaps every plugin went past without waiting for them have expired.
+        expired = [i for i in self._gaps if i not in wanted and processedId is not None and i <= processedId]
+        for eventId in expired:
+            del(self._gaps[eventId])
+        self._site.metrics.increment('gaps.expired', len(expired))
+
+        missing = sorted(self._fetcher.getMissingIds(wanted))
+        found = []
+        for index in range(0, len(missing), self._chunkSize):
+            found.extend(self._fetcher.findEvents([['id', 'in', missing[index:index + self._chunkSize]]]))
+
+        for event in found:
+            detected = self._gaps.pop(event['id'], None)
+            if detected is not None:
+                self._delays.append(now - detected)
+            self._site.log.debug('Gap at event id %d filled.', event['id'])
+        self._site.metrics.increment('gaps.filled', len(found))
+
+        del(self._delays[:-self.OBSERVED_DELAYS])
+        self._site.metrics.setValue('gaps.pending', len(self._gaps))
+        self._site.metrics.setValue('gaps.timeout', self.getTimeout())
+
+        if found or expired:
+            msg = 'Gaps: %d filled, %d expired, %d pending. Backlog timeout is %d seconds.'
+            self._site.log.info(msg, len(found), len(expired), len(self._gaps), self.getTimeout())
+
+        return self._fetcher.add(found)
+
+    def getTimeout(self):
+        """
+        Get the number of seconds a skipped id should stay in a backlog.
+
+        Until delays are observed the maximum timeout is used, afterwards the
+        longest recent delay with a safety margin.
+
+        @rtype: I{int}
+        """
+        if not self._delays:
+            return self._maxTimeout
+
+        timeout = int(max(self._delays) * self.SAFETY_FACTOR) + self._checkInterval
+        return min(max(timeout, self._minTimeout), self._maxTimeout)
+
+
+class Metrics(object):
+    """
+    Counters and values describing the activity of the engine.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        self._lock.acquire()
+        try:
+            self._values[name] = self._values.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def setValue(self, name, value):
+        self._lock.acquire()
+        try:
+            self._values[name] = value
+        finally:
+            self._lock.release()
+
+    def getValues(self):
+        """
+        @return: A copy of all the metrics.
+        @rtype: I{dict}
+        """
+        self._lock.acquire()
+        try:
+            return dict(self._values)
+        finally:
+            self._lock.release()
 
-    def _process(self, event):
-        for callback in self:
-            if callback.isActive():
-                if callback.canProcess(event):
-                    msg = 'Dispatching event %d to callback %s.'
-                    self.logger.debug(msg, event['id'], str(callback))
-                    if not callback.process(event):
-                        # A callback in the plugin failed. Deactivate the whole
-                        # plugin.
-                        self._active = False
-                        break
-            else:
-                msg = 'Skipping inactive callback %s in plugin.'
-                self.logger.debug(msg, str(callback))
 
-        return self._active
+class ShotgunProxy(object):
+    """
+    Wraps a Shotgun connection to report the outcome of the requests to the
+    health of the site, to record a span for each request made while
+    processing a traced event and to keep the requests within the budget of
+    the site.
 
-    def _updateLastEventId(self, eventId):
-        if self._lastEventId is not None and eventId > self._lastEventId + 1:
-            expiration = datetime.datetime.now() + datetime.timedelta(minutes=5)
-            for skippedId in range(self._lastEventId + 1, eventId):
-                self.logger.debug('Adding event id %d to backlog.', skippedId)
-                self._backlog[skippedId] = expiration
-        self._lastEventId = eventId
+    Everything else is handed to the connection untouched.
+    """
 
-    def __iter__(self):
+    API_METHODS = set([
+        'find', 'find_one', 'summarize', 'create', 'update', 'delete', 'revive',
+        'batch', 'upload', 'upload_thumbnail', 'upload_filmstrip_thumbnail',
+        'download_attachment', 'share_thumbnail', 'schema_read',
+        'schema_entity_read', 'schema_field_read', 'text_search', 'note_thread_read',
+        'activity_stream_read', 'follow', 'unfollow', 'followers',
+    ])
+
+    def __init__(self, shotgun, tracer=None, limiter=None, site=None, key=None, health=None):
         """
-        A plugin is iterable and will iterate over all its L{Callback} objects.
+        @param shotgun: The connection to wrap.
+        @type shotgun: L{sg.Shotgun}
+        @param tracer: The tracer holding the traces of the events, if any.
+        @type tracer: L{tracing.Tracer}
+        @param limiter: The budget of the requests to the site, if any.
+        @type limiter: L{rateLimit.RateLimiter}
+        @param site: The site whose metrics get the time spent waiting.
+        @type site: L{Site}
+        @param key: The name of the plugin the connection is for or None for
+            the engine, whose requests go first.
+        @type key: I{str}
+        @param health: The health of the site, if tracked.
+        @type health: L{connectionHealth.ConnectionHealth}
         """
-        return self._callbacks.__iter__()
+        self._shotgun = shotgun
+        self._tracer = tracer
+        self._limiter = limiter
+        self._site = site
+        self._key = key
+        self._health = health
 
-    def __str__(self):
-        """
-        Provide the name of the plugin when it is cast as string.
+    def __getattr__(self, name):
+        attr = getattr(self._shotgun, name)
+        if name not in self.API_METHODS:
+            return attr
+
+        if self._limiter is not None:
+            attr = self._limit(attr)
+        if self._health is not None:
+            attr = self._guard(attr)
+
+        tracer = self._tracer
+        if tracer is None:
+            return attr
+
+        def call(*args, **kwargs):
+            trace = tracer.getCurrentTrace()
+            if trace is None:
+                return attr(*args, **kwargs)
+
+            attributes = {'shotgun.method': name}
+            if args and isinstance(args[0], basestring):
+                attributes['shotgun.entity_type'] = args[0]
+            trace.push('shotgun.' + name, attributes)
+            try:
+                result = attr(*args, **kwargs)
+            except Exception, err:
+                trace.pop('%s: %s' % (type(err).__name__, err))
+                raise
+            trace.pop()
+            return result
 
-        @return: The name of the plugin.
-        @rtype: I{str}
-        """
-        return self.getName()
+        return call
+
+    def _guard(self, method):
+        health = self._health
+
+        def call(*args, **kwargs):
+            # Requests wait while the site is down instead of failing.
+            health.before()
+            try:
+                result = method(*args, **kwargs)
+            except (sg.ProtocolError, sg.ResponseError, socket.error), err:
+                health.recordFailure(err)
+                raise
+            except Exception:
+                # The site answered, with an error about the request. The
+                # loops retrying the request report it as a failure so they
+                # back off.
+                health.recordAnswer()
+                raise
+            health.recordSuccess()
+            return result
+
+        return call
+
+    def _limit(self, method):
+        limiter = self._limiter
+        metrics = self._site.metrics
+        suffix = self._key or 'engine'
+        key = self._key
+
+        def call(*args, **kwargs):
+            waited = limiter.acquire(key)
+            metrics.increment('api.requests.' + suffix)
+            metrics.increment('api.wait.' + suffix, waited)
+
+            start = time.time()
+            failed = False
+            try:
+                return method(*args, **kwargs)
+            except (sg.ProtocolError, sg.ResponseError, socket.error):
+                failed = True
+                raise
+            finally:
+                limiter.release(time.time() - start, failed)
+
+        return call
 
 
 class Registrar(object):
@@ -748,7 +3250,7 @@ class Registrar(object):
         Wrap a plugin so it can be passed to a user.
         """
         self._plugin = plugin
-        self._allowed = ['logger', 'setEmails', 'registerCallback']
+        self._allowed = ['logger', 'setEmails', 'registerCallback', 'registerBatchCallback', 'registerTimer', 'setSites', 'getSiteName', 'getStore', 'getEventHistory', 'setRateLimit', 'setPriority', 'setSheddingPolicy']
 
     def getLogger(self):
         """
@@ -766,12 +3268,149 @@ class Registrar(object):
         raise AttributeError("type object '%s' has no attribute '%s'" % (type(self).__name__, name))
 
 
+class EventMatcher(object):
+    """
+    The compiled form of the matchEvents filter and predicates of a callback.
+
+    Each predicate becomes a test function run in a fixed order, the cheapest
+    first. The projects and users accepted are exposed so the callbacks can be
+    indexed for routing.
+    """
+
+    PREDICATES = ['entity_type', 'project', 'user', 'old_value', 'new_value']
+
+    def __init__(self, matchEvents=None, predicates=None):
+        """
+        @param matchEvents: Event types to lists of attribute names.
+        @type matchEvents: I{dict}
+        @param predicates: Predicate names to the value or list of values
+            accepted, see L{PREDICATES}.
+        @type predicates: I{dict}
+
+        @raise ValueError: If a predicate is unknown.
+        """
+        self._matchEvents = matchEvents
+        self._tests = []
+        self.projects = None
+        self.users = None
+
+        predicates = predicates or {}
+        unknown = [k for k in predicates if k not in self.PREDICATES]
+        if unknown:
+            raise ValueError('Unknown predicates %s, use %s.' % (', '.join(unknown), ', '.join(self.PREDICATES)))
+
+        if matchEvents:
+            self._tests.append(self._matchesEventType)
+
+        if 'entity_type' in predicates:
+            entityTypes = set(_asList(predicates['entity_type']))
+            self._tests.append(lambda e: _getEntityType(e) in entityTypes)
+
+        if 'project' in predicates:
+            self.projects = set([isinstance(p, dict) and p.get('id') or p for p in _asList(predicates['project'])])
+            self._tests.append(lambda e: self.acceptsProject(_getEntityId(e.get('project'))))
+
+        if 'user' in predicates:
+            self.users = set([_matchKey(u) for u in _asList(predicates['user'])])
+            self._tests.append(lambda e: self.acceptsUser(_matchKey(e.get('user'))))
+
+        for name in ('old_value', 'new_value'):
+            if name in predicates:
+                self._tests.append(self._valueTest(name, set([_matchKey(v) for v in _asList(predicates[name])])))
+
+    def _valueTest(self, name, accepted):
+        def test(event):
+            meta = event.get('meta') or {}
+            return name in meta and _matchKey(meta[name]) in accepted
+        return test
+
+    def _matchesEventType(self, event):
+        if '*' in self._matchEvents:
+            eventType = '*'
+        else:
+            eventType = event['event_type']
+            if eventType not in self._matchEvents:
+                return False
+
+        attributes = self._matchEvents[eventType]
+
+        if attributes is None or '*' in attributes:
+            return True
+
+        if event['attribute_name'] and event['attribute_name'] in attributes:
+            return True
+
+        return False
+
+    def acceptsProject(self, projectId):
+        return self.projects is None or projectId in self.projects
+
+    def acceptsUser(self, userKey):
+        """
+        @param userKey: The (type, id) of the user of an event or None.
+        """
+        if self.users is None:
+            return True
+        return userKey in self.users or (userKey is not None and userKey[1] in self.users)
+
+    def matches(self, event):
+        for test in self._tests:
+            if not test(event):
+                return False
+        return True
+
+
+class CallbackRouter(object):
+    """
+    Indexes the callbacks of a plugin by the project and user of the events
+    they accept, so only the candidate callbacks are looked at for an event.
+    Events generated by the scripts a callback ignores are dropped here too.
+
+    The index is filled as (project, user) combinations are seen.
+    """
+
+    MAX_ROUTES = 10000
+
+    def __init__(self, site, callbacks):
+        self._site = site
+        self._callbacks = list(callbacks)
+        self._routes = {}
+        self._scriptNames = site.getScriptNames()
+
+    def getCandidates(self, event):
+        """
+        @return: The callbacks whose project and user predicates accept the
+            event, in registration order.
+        @rtype: I{list} of L{Callback}
+        """
+        # The routes depend on the scripts used by the daemon.
+        if self._site.getScriptNames() is not self._scriptNames:
+            self._scriptNames = self._site.getScriptNames()
+            self._routes = {}
+
+        user = event.get('user')
+        route = (_getEntityId(event.get('project')), _matchKey(user), _getScriptName(user))
+
+        candidates = self._routes.get(route)
+        if candidates is None:
+            if len(self._routes) >= self.MAX_ROUTES:
+                self._routes = {}
+            candidates = [c for c in self._callbacks if c.acceptsRoute(*route)]
+            self._routes[route] = candidates
+        return candidates
+
+
 class Callback(object):
     """
     A part of a plugin that can be called to process a Shotgun event.
     """
 
-    def __init__(self, callback, plugin, engine, shotgun, matchEvents=None, args=None):
+    DEFAULT_COALESCE_WINDOW = 5
+    DEFAULT_COALESCE_COUNT = 100
+
+    IGNORE_OWN_EVENTS = [None, 'script', 'daemon']
+
+    def __init__(self, callback, plugin, engine, shotgun, matchEvents=None, args=None, coalesce=None, idempotent=True, predicates=None, scriptName=None, ignoreOwnEvents=None, prefetch=None):
         """
         @param callback: The function to run when a Shotgun event occurs.
         @type callback: A function object.
@@ -787,26 +3426,76 @@ class Callback(object):
         @param args: Any datastructure you would like to be passed to your
             callback function. Defaults to None.
         @type args: Any object.
+        @param coalesce: Merge matching events on the same entity into a single
+            invocation. Accepts the I{window} (seconds between the first and
+            last merged event) and I{count} (maximum merged events) keys.
+            Defaults to None, no coalescing.
+        @type coalesce: I{dict}
+        @param idempotent: False if processing an event twice has side
+            effects. The completions of such callbacks are recorded so they
+            aren't run again when recovering from a crash.
+        @type idempotent: I{bool}
+        @param predicates: Conditions on the entity type, project, user and
+            meta old and new values of the events, see L{EventMatcher}.
+        @type predicates: I{dict}
+        @param scriptName: The name of the API script the connection uses.
+        @type scriptName: I{str}
+        @param ignoreOwnEvents: I{script} to ignore the events generated by
+            the script of this callback, I{daemon} to ignore the events of all
+            the scripts used by the daemon on the site. Defaults to None.
+        @type ignoreOwnEvents: I{str}
+        @param prefetch: The fields to read from the entities of the events
+            this callback processes, by entity type. They are requested for a
+            whole page of events at once and handed in the I{entity_data} key
+            of the events.
+        @type prefetch: I{dict}
 
         @raise TypeError: If the callback is not a callable object.
+        @raise ValueError: If ignoreOwnEvents is not a known value.
         """
         if not callable(callback):
             raise TypeError('The callback must be a callable object (function, method or callable class instance).')
 
+        if ignoreOwnEvents not in self.IGNORE_OWN_EVENTS:
+            raise ValueError('The ignoreOwnEvents argument should be None, script or daemon.')
+
+        if coalesce is not None:
+            if not isinstance(coalesce, dict):
+                raise TypeError('The coalesce argument should be a dict with window and/or count keys.')
+            coalesce = {
+                'window': coalesce.get('window', self.DEFAULT_COALESCE_WINDOW),
+                'count': coalesce.get('count', self.DEFAULT_COALESCE_COUNT),
+            }
+
+        if prefetch is not None:
+            if not isinstance(prefetch, dict):
+                raise TypeError('The prefetch argument should be a dict of entity types to lists of fields.')
+            prefetch = dict([(k, list(v)) for k, v in prefetch.items() if v])
+
         self._name = None
         self._shotgun = shotgun
         self._callback = callback
         self._engine = engine
+        self._site = plugin.getSite()
         self._logger = None
-        self._matchEvents = matchEvents
+        self._matcher = EventMatcher(matchEvents, predicates)
+        self._scriptNames = frozenset([scriptName])
+        self._ignoreOwnEvents = ignoreOwnEvents
         self._args = args
+        self._coalesce = coalesce
+        self._idempotent = idempotent
+        self._prefetch = prefetch or {}
+        self._plan = {}
         self._active = True
 
         # Find a name for this object
         if hasattr(callback, '__name__'):
             self._name = callback.__name__
+            self._ledgerKey = self._name
         elif hasattr(callback, '__class__') and hasattr(callback, '__call__'):
             self._name = '%s_%s' % (callback.__class__.__name__, hex(id(callback)))
+            # The id changes with each run, the key must not.
+            self._ledgerKey = callback.__class__.__name__
         else:
             raise ValueError('registerCallback should be called with a function or a callable object instance as callback argument.')
 
@@ -815,25 +3504,89 @@ class Callback(object):
         self._logger.config = self._engine.config
 
     def canProcess(self, event):
-        if not self._matchEvents:
-            return True
+        if self._ignoreOwnEvents and self._isIgnoredScript(_getScriptName(event.get('user'))):
+            return False
+        return self._matcher.matches(event)
 
-        if '*' in self._matchEvents:
-            eventType = '*'
-        else:
-            eventType = event['event_type']
-            if eventType not in self._matchEvents:
-                return False
+    def acceptsRoute(self, projectId, userKey, scriptName=None):
+        """
+        Can events of a project and user be processed by this callback.
 
-        attributes = self._matchEvents[eventType]
+        @param projectId: The id of the project of the events or None.
+        @type projectId: I{int}
+        @param userKey: The (type, id) of the user of the events or None.
+        @type userKey: I{tuple}
+        @param scriptName: The name of the API script that generated the
+            events or None if a person did.
+        @type scriptName: I{str}
 
-        if attributes is None or '*' in attributes:
-            return True
+        @rtype: I{bool}
+        """
+        if self._ignoreOwnEvents and self._isIgnoredScript(scriptName):
+            return False
+        return self._matcher.acceptsProject(projectId) and self._matcher.acceptsUser(userKey)
+
+    def _isIgnoredScript(self, scriptName):
+        if scriptName is None:
+            return False
+        elif self._ignoreOwnEvents == 'daemon':
+            return scriptName in self._site.getScriptNames()
+        return scriptName in self._scriptNames
+
+    def prepare(self, events):
+        """
+        Plan the coalescing of the upcoming events.
 
-        if event['attribute_name'] and event['attribute_name'] in attributes:
-            return True
+        Matching events on the same entity are grouped as long as the group
+        fits in the coalescing window. The first event of a group triggers a
+        single invocation with the latest event of the group, the others are
+        considered processed without invoking the callback.
 
-        return False
+        @param events: The events the plugin is about to process, in id order.
+        @type events: I{list} of Shotgun event dictionaries.
+        """
+        # A lane out of time may have stopped between the events of a group,
+        # the rest of the group stays coalesced into its processed event.
+        eventIds = set([e['id'] for e in events])
+        plan = self._plan
+        self._plan = dict([(k, v) for k, v in plan.items() if k in eventIds and not isinstance(v, dict) and v not in plan])
+        if not self._coalesce:
+            return
+
+        groups = []
+        openGroups = {}
+        for event in events:
+            if event['id'] in self._plan or not event.get('entity') or not self.canProcess(event):
+                continue
+
+            key = (event['entity']['type'], event['entity']['id'])
+            group = openGroups.get(key)
+            if group is None or not self._fitsInGroup(group, event):
+                group = openGroups[key] = []
+                groups.append(group)
+            group.append(event)
+
+        for group in groups:
+            if len(group) < 2:
+                continue
+
+            merged = dict(group[-1])
+            merged['coalesced_ids'] = [e['id'] for e in group]
+            self._plan[group[0]['id']] = merged
+            for event in group[1:]:
+                self._plan[event['id']] = group[0]['id']
+
+    def _fitsInGroup(self, group, event):
+        if self._coalesce['count'] and len(group) >= self._coalesce['count']:
+            return False
+
+        window = self._coalesce['window']
+        if window is not None:
+            elapsed = _secondsBetween(group[0], event)
+            if elapsed is None or elapsed > window:
+                return False
+
+        return True
 
     def process(self, event):
         """
@@ -845,12 +3598,35 @@ class Callback(object):
         @param event: The Shotgun event to process.
         @type event: I{dict}
         """
+        if self._coalesce:
+            planned = self._plan.pop(event['id'], None)
+            if isinstance(planned, dict):
+                event = planned
+            elif planned is not None:
+                self._logger.debug('Event %d was coalesced into event %d.', event['id'], planned)
+                return self._active
+            else:
+                event = dict(event)
+                event['coalesced_ids'] = [event['id']]
+
         # set session_uuid for UI updates
-        if self._engine._use_session_uuid:
+        if self._site.usesSessionUuid():
             self._shotgun.set_session_uuid(event['session_uuid'])
 
+        self._invoke(event)
+        return self._active
+
+    def _invoke(self, payload):
+        """
+        Run the callback function, deactivating this callback if it raises.
+
+        @param payload: The event or list of events to hand to the callback.
+
+        @return: The value returned by the callback function or None if an
+            error occured.
+        """
         try:
-            self._callback(self._shotgun, self._logger, event, self._args)
+            result = self._callback(self._shotgun, self._logger, payload, self._args)
         except:
             # Get the local variables of the frame of our plugin
             tb = sys.exc_info()[2]
@@ -862,8 +3638,9 @@ class Callback(object):
             msg = 'An error occured processing an event.\n\n%s\n\nLocal variables at outer most frame in plugin:\n\n%s'
             self._logger.critical(msg, traceback.format_exc(), pprint.pformat(stack[1].f_locals))
             self._active = False
+            return None
 
-        return self._active
+        return result
 
     def isActive(self):
         """
@@ -875,6 +3652,30 @@ class Callback(object):
         """
         return self._active
 
+    def reactivate(self):
+        self._active = True
+
+    def isIdempotent(self):
+        return self._idempotent
+
+    def getLedgerKey(self):
+        """
+        @return: The name of the callback in the completion ledger, the same
+            from one run of the daemon to the next.
+        @rtype: I{str}
+        """
+        return self._ledgerKey
+
+    def setLedgerKey(self, key):
+        self._ledgerKey = key
+
+    def getPrefetchFields(self):
+        """
+        @return: The fields to prefetch, by entity type.
+        @rtype: I{dict}
+        """
+        return self._prefetch
+
     def __str__(self):
         """
         The name of the callback.
@@ -885,6 +3686,247 @@ class Callback(object):
         return self._name
 
 
+class BatchCallback(Callback):
+    """
+    A callback that processes lists of events in a single invocation.
+
+    Upcoming matching events are split in batches when the plugin prepares
+    them. The whole batch is processed when its first event is dispatched and
+    the result for each event is then reported as the plugin reaches it so the
+    plugin's state stays exact.
+    """
+
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, callback, plugin, engine, shotgun, matchEvents=None, args=None, batchSize=None, batchAge=None, predicates=None, scriptName=None, ignoreOwnEvents=None, prefetch=None):
+        """
+        See L{Callback} for the common arguments.
+
+        @param batchSize: The maximum number of events in a batch.
+        @type batchSize: I{int}
+        @param batchAge: The maximum number of seconds between the first and
+            last events of a batch. None for no limit.
+        @type batchAge: I{int}
+        """
+        super(BatchCallback, self).__init__(callback, plugin, engine, shotgun, matchEvents, args, predicates=predicates, scriptName=scriptName, ignoreOwnEvents=ignoreOwnEvents, prefetch=prefetch)
+
+        self._batchSize = batchSize or self.DEFAULT_BATCH_SIZE
+        self._batchAge = batchAge
+        self._batches = {}
+        self._results = {}
+
+    def prepare(self, events):
+        """
+        Split the upcoming matching events into batches.
+
+        @param events: The events the plugin is about to process, in id order.
+        @type events: I{list} of Shotgun event dictionaries.
+        """
+        # A lane out of time may have stopped in the middle of a processed
+        # batch, the outcome of the rest of the batch is kept.
+        eventIds = set([e['id'] for e in events])
+        self._batches = {}
+        self._results = dict([(k, v) for k, v in self._results.items() if k in eventIds])
+
+        batch = None
+        for event in events:
+            if event['id'] in self._results or not self.canProcess(event):
+                continue
+
+            if batch is None or not self._fitsInBatch(batch, event):
+                batch = self._batches[event['id']] = []
+            batch.append(event)
+
+    def _fitsInBatch(self, batch, event):
+        if len(batch) >= self._batchSize:
+            return False
+
+        if self._batchAge is not None:
+            elapsed = _secondsBetween(batch[0], event)
+            if elapsed is None or elapsed > self._batchAge:
+                return False
+
+        return True
+
+    def process(self, event):
+        """
+        Report the outcome of the batch for an event, processing the batch if
+        the event is the first of one.
+
+        A failure reported for an event deactivates the callback when that
+        event is reached, after the previous events were marked as processed.
+
+        @param event: The Shotgun event to process.
+        @type event: I{dict}
+        """
+        if event['id'] not in self._results:
+            self._processBatch(self._batches.pop(event['id'], [event]))
+
+        result = self._results.pop(event['id'], None)
+        if not result:
+            if result is False:
+                self._logger.critical('The batch callback reported a failure processing event %d.', event['id'])
+            self._active = False
+
+        return self._active
+
+    def _processBatch(self, batch):
+        msg = 'Processing a batch of %d events (%d to %d).'
+        self._logger.debug(msg, len(batch), batch[0]['id'], batch[-1]['id'])
+
+        # set session_uuid for UI updates when the whole batch shares one
+        if self._site.usesSessionUuid():
+            sessions = set([e['session_uuid'] for e in batch])
+            self._shotgun.set_session_uuid(sessions.pop() if len(sessions) == 1 else None)
+
+        failures = self._invoke(batch)
+        if not self._active:
+            # The error was already logged, every event of the batch fails
+            # once the plugin reaches it.
+            self._active = True
+            for event in batch:
+                self._results[event['id']] = None
+            return
+
+        if failures is None:
+            failures = []
+        elif isinstance(failures, dict):
+            for eventId, reason in failures.items():
+                self._logger.error('Event %d failed: %s', eventId, reason)
+
+        failures = set(failures)
+        for event in batch:
+            self._results[event['id']] = event['id'] not in failures
+
+
+class Controller(object):
+    """
+    Runs the commands received on the control socket against the engine.
+
+    Plugins are selected by name, prefixed by the site name and a colon to
+    pick the plugin of a single site (I{production:myPlugin}).
+    """
+
+    COMMANDS = ['list', 'pause', 'resume', 'reactivate', 'reload', 'skip', 'stats']
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def handle(self, command, args):
+        if command == 'handoff':
+            # Sent by a process taking over, it takes the lock itself once
+            # dispatching stopped.
+            return self._engine.handOff()
+
+        if command not in self.COMMANDS:
+            raise control.ControlError('Unknown command: %s. Use one of %s.' % (command, ', '.join(self.COMMANDS)))
+
+        self._engine.lock.acquire()
+        try:
+            return getattr(self, '_' + command)(*args)
+        finally:
+            self._engine.lock.release()
+
+    def _findPlugins(self, selector=None):
+        if selector is None:
+            raise control.ControlError('A plugin name is required.')
+
+        siteName = None
+        name = selector
+        if ':' in selector:
+            siteName, name = selector.split(':', 1)
+
+        plugins = []
+        for site in self._engine.getSites():
+            if siteName is None or site.getName() == siteName:
+                plugins.extend([p for p in site.getPlugins() if p.getName() == name])
+
+        if not plugins:
+            raise control.ControlError('No plugin named %s.' % selector)
+        return plugins
+
+    def _list(self):
+        result = []
+        for site in self._engine.getSites():
+            headId = site.getHeadEventId()
+            for plugin in site.getPlugins():
+                lastEventId = plugin.getLastEventId()
+                lag = None
+                if headId is not None and lastEventId is not None:
+                    lag = max(headId - lastEventId, 0)
+                result.append({
+                    'site': site.getName(),
+                    'plugin': plugin.getName(),
+                    'active': plugin.isActive(),
+                    'paused': plugin.isPaused(),
+                    'priority': plugin.getPriority(),
+                    'catchingUp': site.isCatchingUp(plugin),
+                    'shed': plugin.getShedCount(),
+                    'lastEventId': lastEventId,
+                    'backlog': len(plugin.getBacklogIds()),
+                    'lag': lag,
+                    'callbacks': [{'name': str(c), 'active': c.isActive()} for c in plugin],
+                })
+        return result
+
+    def _pause(self, selector=None):
+        plugins = self._findPlugins(selector)
+        for plugin in plugins:
+            plugin.setPaused(True)
+        return 'Paused %d plugin(s).' % len(plugins)
+
+    def _resume(self, selector=None):
+        plugins = self._findPlugins(selector)
+        for plugin in plugins:
+            plugin.setPaused(False)
+        return 'Resumed %d plugin(s).' % len(plugins)
+
+    def _reactivate(self, selector=None):
+        plugins = self._findPlugins(selector)
+        for plugin in plugins:
+            try:
+                plugin.reactivate()
+            except ValueError, err:
+                raise control.ControlError(str(err))
+        return 'Reactivated %d plugin(s).' % len(plugins)
+
+    def _reload(self, selector=None):
+        plugins = self._findPlugins(selector)
+        for plugin in plugins:
+            plugin.load(force=True)
+        return 'Reloaded %d plugin(s).' % len(plugins)
+
+    def _skip(self, selector=None, eventId=None):
+        plugins = self._findPlugins(selector)
+        try:
+            eventId = int(eventId)
+        except (TypeError, ValueError):
+            raise control.ControlError('An event id is required.')
+
+        for plugin in plugins:
+            try:
+                plugin.skipTo(eventId)
+            except ValueError, err:
+                raise control.ControlError(str(err))
+
+        for site in set([p.getSite() for p in plugins]):
+            site.saveEventIdData()
+        return 'Skipped %d plugin(s) to event %d.' % (len(plugins), eventId)
+
+    def _stats(self):
+        sites = {}
+        for site in self._engine.getSites():
+            values = site.metrics.getValues()
+            values['events.head'] = site.getHeadEventId()
+            values['plugins.active'] = len([p for p in site.getPlugins() if p.isActive()])
+            values['plugins.total'] = len(site.getPlugins())
+            if site.limiter is not None:
+                values.update(site.limiter.getStats())
+            sites[site.getName() or 'shotgun'] = values
+
+        return {'pid': os.getpid(), 'uptime': int(self._engine.getUptime()), 'sites': sites}
+
+
 class CustomSMTPHandler(logging.handlers.SMTPHandler):
     """
     A custom SMTPHandler subclass that will adapt it's subject depending on the
@@ -903,6 +3945,89 @@ class CustomSMTPHandler(logging.handlers.SMTPHandler):
         return subject
 
 
+def _asList(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return list(value)
+    return [value]
+
+
+def _matchKey(value):
+    """
+    Get a hashable key to compare a value of an event with, entity
+    dictionaries are compared by type and id.
+    """
+    if isinstance(value, dict):
+        if 'type' in value and 'id' in value:
+            return (value['type'], value['id'])
+        return tuple(sorted([(k, _matchKey(v)) for k, v in value.items()]))
+    elif isinstance(value, list):
+        return tuple([_matchKey(v) for v in value])
+    return value
+
+
+def _getEntityId(entity):
+    if entity:
+        return entity.get('id')
+    return None
+
+
+def _getScriptName(user):
+    """
+    Get the name of the API script an event's user is, None for people.
+    """
+    if user and user.get('type') == 'ApiUser':
+        return user.get('name')
+    return None
+
+
+def _getEntityType(event):
+    if event.get('entity'):
+        return event['entity']['type']
+    return (event.get('meta') or {}).get('entity_type')
+
+
+def _getEventAge(event):
+    """
+    Get the number of seconds since an event was created.
+
+    @return: The number of seconds or None if the event has no creation time.
+    @rtype: I{int}
+    """
+    created = event.get('created_at')
+    if created is None:
+        return None
+
+    delta = datetime.datetime.now(created.tzinfo) - created
+    return delta.days * 86400 + delta.seconds
+
+
+def _formatIdRanges(eventIds):
+    """
+    Format event ids as ranges of consecutive ids (I{1-5, 8}).
+    """
+    ranges = []
+    for eventId in sorted(eventIds):
+        if ranges and ranges[-1][1] == eventId - 1:
+            ranges[-1][1] = eventId
+        else:
+            ranges.append([eventId, eventId])
+    return ', '.join([a == b and str(a) or '%d-%d' % (a, b) for a, b in ranges])
+
+
+def _secondsBetween(first, last):
+    """
+    Get the number of seconds between the creation of two events.
+
+    @return: The number of seconds or None if an event has no creation time.
+    @rtype: I{int}
+    """
+    if first.get('created_at') is None or last.get('created_at') is None:
+        return None
+
+    delta = last['created_at'] - first['created_at']
+    return delta.days * 86400 + delta.seconds
+
+
 class EventDaemonError(Exception):
     pass
 
@@ -912,6 +4037,9 @@ class ConfigError(EventDaemonError):
 
 
 def main():
+    if len(sys.argv) >= 2 and sys.argv[1] == 'ctl':
+        return _control(sys.argv[2:])
+
     if len(sys.argv) == 2:
         daemon = Engine(_getConfigPath())
 
@@ -927,9 +4055,47 @@ def main():
         # Call the requested function
         func()
     else:
-        print "usage: %s start|stop|restart|foreground" % sys.argv[0]
+        print "usage: %s start|stop|restart|foreground|ctl <command>" % sys.argv[0]
+        return 2
+
+    return 0
+
+
+def _control(args):
+    """
+    Send a command to the running daemon and print its result.
+    """
+    if not args:
+        print "usage: %s ctl list|stats|pause <plugin>|resume <plugin>|reactivate <plugin>|reload <plugin>|skip <plugin> <event id>" % sys.argv[0]
         return 2
 
+    path = Config(_getConfigPath()).getControlSocket()
+    if not path:
+        print "The control socket is disabled in the config."
+        return 2
+
+    try:
+        result = control.sendCommand(path, args[0], args[1:])
+    except control.ControlError, err:
+        print "Error: %s" % err
+        return 1
+
+    if args[0] == 'list':
+        for plugin in result:
+            state = plugin['paused'] and 'paused' or plugin['active'] and 'active' or 'inactive'
+            if state == 'active' and plugin['catchingUp']:
+                state = 'catch-up'
+            name = plugin['plugin']
+            if plugin['site'] is not None:
+                name = '%s:%s' % (plugin['site'], name)
+            print '%-40s %-8s %-6s last=%s lag=%s backlog=%d shed=%d' % (name, state, plugin['priority'], plugin['lastEventId'], plugin['lag'], plugin['backlog'], plugin['shed'])
+            for callback in plugin['callbacks']:
+                print '    %-36s %s' % (callback['name'], callback['active'] and 'active' or 'inactive')
+    elif isinstance(result, dict):
+        print json.dumps(result, indent=4, sort_keys=True)
+    else:
+        print result
+
     return 0
 
 
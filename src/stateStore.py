@@ -0,0 +1,330 @@
+"""
+Persistent storage for the event processing state of the plugins.
+
+The state of a plugin is a tuple of its last processed event id and of its
+backlog, a dict of skipped event ids to their expiration datetime. The state
+of the whole engine is a dict of plugin collection paths to dicts of plugin
+names to plugin states.
+
+Stores receive only the plugin states that changed since the last save, it is
+up to the store to decide how much work that represents.
+"""
+
+import datetime
+import json
+import os
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class StateStoreError(Exception):
+    pass
+
+
+class StateStore(object):
+    """
+    Base class of the state stores.
+    """
+
+    def load(self):
+        """
+        Load the state of the engine.
+
+        @return: The state dict, an I{int} for old-style files holding a single
+            last processed event id or None if no state was ever saved.
+        """
+        raise NotImplementedError('You must implement the method in your class.')
+
+    def save(self, changes):
+        """
+        Save the state of the plugins that changed.
+
+        @param changes: A dict of collection paths to dicts of plugin names to
+            plugin states. Only the plugins listed are updated.
+        @type changes: I{dict}
+        """
+        raise NotImplementedError('You must implement the method in your class.')
+
+    def close(self):
+        pass
+
+
+class PickleStateStore(StateStore):
+    """
+    The original store, a single file holding the pickled state of the engine.
+
+    The whole file is rewritten on each save.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._data = {}
+
+    def load(self):
+        if not os.path.exists(self._path):
+            return None
+
+        fh = open(self._path, 'rb')
+        try:
+            try:
+                self._data = pickle.load(fh)
+            except (pickle.UnpicklingError, EOFError, ValueError):
+                # Backwards compatibility:
+                # Read an old-style id file containing a single int which is
+                # the last id properly processed.
+                fh.seek(0)
+                line = fh.readline().strip()
+                if line.isdigit():
+                    self._data = {}
+                    return int(line)
+                raise StateStoreError('Unknown state file format: %s' % self._path)
+        finally:
+            fh.close()
+
+        return self._data
+
+    def save(self, changes):
+        for colPath, pluginStates in changes.items():
+            self._data.setdefault(colPath, {}).update(pluginStates)
+
+        # Write to a temporary file first so a crash never leaves a truncated
+        # state file behind.
+        tmpPath = self._path + '.tmp'
+        fh = open(tmpPath, 'wb')
+        try:
+            pickle.dump(self._data, fh)
+        finally:
+            fh.close()
+        os.rename(tmpPath, self._path)
+
+
+class SqliteStateStore(StateStore):
+    """
+    A store keeping one row per plugin cursor and one row per backlog range in
+    an SQLite database in WAL mode.
+
+    Only the plugins that changed are written on save, in a single transaction.
+    The WAL journal lets monitoring tools read the database while the daemon
+    writes to it.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS cursors ('
+        '    collection TEXT NOT NULL,'
+        '    plugin TEXT NOT NULL,'
+        '    last_id INTEGER,'
+        '    updated REAL NOT NULL,'
+        '    PRIMARY KEY (collection, plugin))',
+        'CREATE TABLE IF NOT EXISTS backlog ('
+        '    collection TEXT NOT NULL,'
+        '    plugin TEXT NOT NULL,'
+        '    start_id INTEGER NOT NULL,'
+        '    end_id INTEGER NOT NULL,'
+        '    expiration REAL NOT NULL,'
+        '    PRIMARY KEY (collection, plugin, start_id))',
+    ]
+
+    def __init__(self, path, legacyPath=None):
+        """
+        @param path: The path of the SQLite database.
+        @type path: I{str}
+        @param legacyPath: The path of a pickled or old-style id file to import
+            if the database holds no state yet.
+        @type legacyPath: I{str}
+        """
+        import sqlite3
+
+        self._sqlite3 = sqlite3
+        self._path = path
+        self._legacyPath = legacyPath
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+    def load(self):
+        data = {}
+        for colPath, pluginName, lastId in self._conn.execute('SELECT collection, plugin, last_id FROM cursors'):
+            data.setdefault(colPath, {})[pluginName] = (lastId, {})
+
+        query = 'SELECT collection, plugin, start_id, end_id, expiration FROM backlog'
+        for colPath, pluginName, startId, endId, expiration in self._conn.execute(query):
+            state = data.get(colPath, {}).get(pluginName)
+            if state is None:
+                continue
+            expiration = datetime.datetime.fromtimestamp(expiration)
+            for eventId in range(startId, endId + 1):
+                state[1][eventId] = expiration
+
+        if data:
+            return data
+
+        if self._legacyPath and os.path.exists(self._legacyPath):
+            legacy = PickleStateStore(self._legacyPath).load()
+            if isinstance(legacy, dict):
+                self.save(legacy)
+            return legacy
+
+        return None
+
+    def save(self, changes):
+        now = time.time()
+        conn = self._conn
+        try:
+            for colPath, pluginStates in changes.items():
+                for pluginName, (lastId, backlog) in pluginStates.items():
+                    conn.execute(
+                        'INSERT OR REPLACE INTO cursors (collection, plugin, last_id, updated) VALUES (?, ?, ?, ?)',
+                        (colPath, pluginName, lastId, now)
+                    )
+                    conn.execute('DELETE FROM backlog WHERE collection = ? AND plugin = ?', (colPath, pluginName))
+                    conn.executemany(
+                        'INSERT INTO backlog (collection, plugin, start_id, end_id, expiration) VALUES (?, ?, ?, ?, ?)',
+                        [(colPath, pluginName) + r for r in _backlogRanges(backlog)]
+                    )
+            conn.commit()
+        except self._sqlite3.Error, err:
+            conn.rollback()
+            raise StateStoreError('Could not save the state to %s: %s' % (self._path, err))
+
+    def close(self):
+        self._conn.close()
+
+
+class CompletionLedger(object):
+    """
+    Records the events that non-idempotent callbacks completed since the last
+    save of the state so they are not run again when recovering from a crash.
+
+    Each completion is appended and synced to a file. Completions covered by
+    the saved state are dropped from the file when the state is saved.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: The path of the ledger file.
+        @type path: I{str}
+        """
+        self._path = path
+        self._entries = set()
+        self._fh = None
+
+        if os.path.exists(path):
+            fh = open(path, 'r')
+            try:
+                for line in fh:
+                    try:
+                        pluginPath, callbackName, eventId = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash, it was never completed.
+                        continue
+                    self._entries.add((str(pluginPath), str(callbackName), eventId))
+            finally:
+                fh.close()
+
+    def isCompleted(self, pluginPath, callbackName, eventId):
+        return (pluginPath, callbackName, eventId) in self._entries
+
+    def record(self, pluginPath, callbackName, eventId):
+        """
+        Record that a callback completed an event.
+
+        @param pluginPath: The path of the plugin file.
+        @type pluginPath: I{str}
+        @param callbackName: The key of the callback in its plugin.
+        @type callbackName: I{str}
+        @param eventId: The id of the event.
+        @type eventId: I{int}
+        """
+        if self._fh is None:
+            self._fh = open(self._path, 'a')
+        self._entries.add((pluginPath, callbackName, eventId))
+        self._fh.write(json.dumps([pluginPath, callbackName, eventId]) + '\n')
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def prune(self, changes):
+        """
+        Forget the completions of events the saved state considers processed.
+
+        @param changes: The plugin states that were saved, as handed to
+            L{StateStore.save}.
+        @type changes: I{dict}
+        """
+        if not self._entries:
+            return
+
+        covered = set()
+        for colPath, pluginStates in changes.items():
+            for pluginName, (lastId, backlog) in pluginStates.items():
+                pluginPath = os.path.join(colPath, pluginName + '.py')
+                for entry in self._entries:
+                    if entry[0] == pluginPath and lastId is not None and entry[2] <= lastId and entry[2] not in backlog:
+                        covered.add(entry)
+
+        if not covered:
+            return
+
+        self._entries -= covered
+        self.close()
+
+        tmpPath = self._path + '.tmp'
+        fh = open(tmpPath, 'w')
+        try:
+            for entry in sorted(self._entries):
+                fh.write(json.dumps(list(entry)) + '\n')
+        finally:
+            fh.close()
+        os.rename(tmpPath, self._path)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+def _backlogRanges(backlog):
+    """
+    Compress a backlog into ranges of consecutive event ids sharing the same
+    expiration.
+
+    @return: A list of (start id, end id, expiration timestamp) tuples.
+    @rtype: I{list}
+    """
+    ranges = []
+    for eventId in sorted(backlog):
+        expiration = backlog[eventId]
+        expiration = time.mktime(expiration.timetuple()) + expiration.microsecond / 1000000.0
+        if ranges and ranges[-1][1] == eventId - 1 and ranges[-1][2] == expiration:
+            ranges[-1] = (ranges[-1][0], eventId, expiration)
+        else:
+            ranges.append((eventId, eventId, expiration))
+    return ranges
+
+
+def getStateStore(backend, path, legacyPath=None):
+    """
+    Get the state store for a backend name.
+
+    @param backend: Either I{pickle} or I{sqlite}.
+    @type backend: I{str}
+    @param path: The path where the store keeps the state.
+    @type path: I{str}
+    @param legacyPath: For the I{sqlite} backend, a pickled or old-style id
+        file to import.
+    @type legacyPath: I{str}
+
+    @raise StateStoreError: If the backend is unknown.
+    """
+    if backend == 'pickle':
+        return PickleStateStore(path)
+    elif backend == 'sqlite':
+        return SqliteStateStore(path, legacyPath)
+    raise StateStoreError('Unknown state backend: %s' % backend)
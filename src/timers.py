@@ -0,0 +1,358 @@
+"""
+Periodic work of the plugins, run by the engine away from event dispatch.
+
+Timers are kept on a hashed timer wheel: a ring of short time slots a single
+thread walks through, each timer sitting in the slot of its next run with the
+number of turns of the wheel left before it. Scheduling and cancelling cost
+the same whatever the number of timers. Due timers are handed to a pool of
+worker threads so a slow timer never delays the events or the other timers.
+
+A timer runs every I{interval} seconds or on a cron schedule, delayed by a
+random I{jitter} so timers registered together don't all query Shotgun at the
+same time. A run is skipped if the previous one is still going.
+"""
+
+import datetime
+import math
+import Queue
+import random
+import threading
+import time
+
+
+class CronSchedule(object):
+    """
+    A cron expression: I{minute hour day-of-month month day-of-week}, in
+    local time.
+
+    Each field is I{*}, a number, a range I{a-b} or a list of those separated
+    by commas, optionally followed by a step I{/n}. Days of the week go from 0,
+    Sunday, to 6, 7 being Sunday too. As in cron, a day matches either the day
+    of the month or the day of the week when both are restricted.
+    """
+
+    FIELDS = [('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12), ('day of week', 0, 7)]
+
+    def __init__(self, expression):
+        """
+        @param expression: The cron expression.
+        @type expression: I{str}
+
+        @raise ValueError: If the expression is invalid.
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Invalid cron expression %r, it needs 5 fields.' % expression)
+
+        values = []
+        for field, (name, low, high) in zip(fields, self.FIELDS):
+            values.append(self._parseField(field, name, low, high))
+        self._minutes, self._hours, self._days, self._months, self._weekdays = values
+        if 7 in self._weekdays:
+            self._weekdays.add(0)
+        self._anyDay = fields[2] == '*'
+        self._anyWeekday = fields[4] == '*'
+        self._expression = expression
+
+    def __str__(self):
+        return self._expression
+
+    def _parseField(self, field, name, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = self._parseNumber(step, name, 1, high)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [self._parseNumber(p, name, low, high) for p in part.split('-', 1)]
+            else:
+                start = self._parseNumber(part, name, low, high)
+                end = step > 1 and high or start
+            if start > end:
+                raise ValueError('Invalid %s range %s.' % (name, part))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _parseNumber(self, value, name, low, high):
+        try:
+            number = int(value)
+        except ValueError:
+            raise ValueError('Invalid %s %r.' % (name, value))
+        if not low <= number <= high:
+            raise ValueError('Invalid %s %d, it must be between %d and %d.' % (name, number, low, high))
+        return number
+
+    def _matchesDay(self, day):
+        weekday = (day.weekday() + 1) % 7
+        if self._anyDay:
+            return self._anyWeekday or weekday in self._weekdays
+        if self._anyWeekday:
+            return day.day in self._days
+        return day.day in self._days or weekday in self._weekdays
+
+    def getNext(self, after):
+        """
+        Get the next time matching the schedule.
+
+        @param after: The time, in seconds since the epoch, to start from.
+        @type after: I{float}
+
+        @return: The time, in seconds since the epoch.
+        @rtype: I{float}
+        """
+        moment = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # Jump to the next matching month, day, hour and minute in turn, a
+        # few years covers the schedules matching only on February 29th.
+        limit = moment + datetime.timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self._months:
+                year = moment.year + moment.month // 12
+                moment = moment.replace(year=year, month=moment.month % 12 + 1, day=1, hour=0, minute=0)
+            elif not self._matchesDay(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self._hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self._minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(moment.timetuple())
+        raise ValueError('The cron expression %s never matches.' % self._expression)
+
+
+class Timer(object):
+    """
+    A function run periodically by a L{TimerWheel}.
+    """
+
+    def __init__(self, name, function, interval=None, cron=None, jitter=0, metrics=None):
+        """
+        @param name: The name of the timer in the metrics and logs.
+        @type name: I{str}
+        @param function: Called with no arguments on each run. Errors must be
+            handled by the function.
+        @type function: A I{callable}
+        @param interval: The number of seconds between two runs.
+        @type interval: I{float}
+        @param cron: A cron expression, see L{CronSchedule}, instead of an
+            interval.
+        @type cron: I{str}
+        @param jitter: The maximum number of seconds each run is randomly
+            delayed by.
+        @type jitter: I{float}
+        @param metrics: Gets the I{runs}, I{skipped}, I{duration} and
+            I{lateness} of the timer, prefixed by its name.
+        @type metrics: An object with I{increment} and I{setValue} methods.
+
+        @raise ValueError: If the schedule is invalid.
+        """
+        if (interval is None) == (cron is None):
+            raise ValueError('A timer needs either an interval or a cron expression.')
+        if interval is not None and interval <= 0:
+            raise ValueError('Invalid timer interval %s, it must be positive.' % interval)
+        if jitter < 0:
+            raise ValueError('Invalid timer jitter %s, it must not be negative.' % jitter)
+
+        self._name = name
+        self._function = function
+        self._interval = interval
+        self._schedule = cron is not None and CronSchedule(cron) or None
+        self._jitter = jitter
+        self._metrics = metrics
+        self._base = None
+        self._due = None
+        self._runDue = None
+        self._running = False
+        self._cancelled = False
+
+    def getName(self):
+        return self._name
+
+    def getDue(self):
+        """
+        @return: The time of the next run, in seconds since the epoch.
+        @rtype: I{float}
+        """
+        return self._due
+
+    def isRunning(self):
+        return self._running
+
+    def isCancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """
+        Stop scheduling the timer, a run in progress finishes.
+        """
+        self._cancelled = True
+
+    def scheduleNext(self, now):
+        """
+        Compute the time of the next run.
+
+        Interval timers are scheduled from their previous scheduled time
+        rather than from the end of the run, so they don't drift.
+
+        @param now: The current time, in seconds since the epoch.
+        @type now: I{float}
+
+        @return: The time of the next run.
+        @rtype: I{float}
+        """
+        if self._schedule is not None:
+            self._base = self._schedule.getNext(now)
+        elif self._base is None:
+            self._base = now + self._interval
+        else:
+            self._base += self._interval
+            if self._base <= now:
+                # Runs missed while the process was suspended are dropped.
+                self._base += math.ceil((now - self._base) / self._interval) * self._interval
+        self._due = self._base + random.uniform(0, self._jitter)
+        return self._due
+
+    def skip(self):
+        self._count('skipped')
+
+    def start(self):
+        self._running = True
+        self._runDue = self._due
+
+    def run(self):
+        if self._cancelled:
+            self._running = False
+            return
+
+        start = time.time()
+        try:
+            self._function()
+        finally:
+            self._running = False
+            self._count('runs')
+            self._setValue('duration', time.time() - start)
+            self._setValue('lateness', max(start - self._runDue, 0))
+
+    def _count(self, name):
+        if self._metrics is not None:
+            self._metrics.increment('%s.%s' % (self._name, name))
+
+    def _setValue(self, name, value):
+        if self._metrics is not None:
+            self._metrics.setValue('%s.%s' % (self._name, name), value)
+
+
+class TimerWheel(object):
+    """
+    Runs the timers of the engine from background threads.
+    """
+
+    # Seconds per slot and number of slots of the wheel, timers run at most a
+    # tick late.
+    TICK = 0.25
+    SLOTS = 1024
+
+    def __init__(self, log, workers=2):
+        """
+        @param log: The logger errors are reported to.
+        @type log: I{logging.Logger}
+        @param workers: The number of threads running the timers.
+        @type workers: I{int}
+        """
+        self._log = log
+        self._workerCount = max(workers, 1)
+        self._slots = [[] for i in range(self.SLOTS)]
+        self._position = 0
+        self._time = time.time()
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._turn, name='timerWheel')]
+        for i in range(self._workerCount):
+            self._threads.append(threading.Thread(target=self._work, name='timerWorker%d' % i))
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Stop the wheel, waiting for the runs in progress.
+
+        @param timeout: The maximum number of seconds to wait for each thread.
+        @type timeout: I{float}
+        """
+        self._stopped.set()
+        for i in range(self._workerCount):
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def add(self, timer):
+        """
+        Schedule a timer.
+
+        @param timer: The timer.
+        @type timer: L{Timer}
+        """
+        self._lock.acquire()
+        try:
+            self._insert(timer, timer.scheduleNext(time.time()))
+        finally:
+            self._lock.release()
+
+    def _insert(self, timer, due):
+        ticks = max(int(math.ceil((due - self._time) / self.TICK)), 1)
+        slot = (self._position + ticks) % self.SLOTS
+        self._slots[slot].append([timer, (ticks - 1) // self.SLOTS])
+
+    def _turn(self):
+        while not self._stopped.isSet():
+            self._stopped.wait(max(self._time + self.TICK - time.time(), 0))
+            if self._stopped.isSet():
+                break
+
+            self._lock.acquire()
+            try:
+                # Catch up on the ticks missed while the thread was late.
+                while self._time + self.TICK <= time.time():
+                    self._time += self.TICK
+                    self._position = (self._position + 1) % self.SLOTS
+                    self._advance()
+            finally:
+                self._lock.release()
+
+    def _advance(self):
+        entries = self._slots[self._position]
+        self._slots[self._position] = []
+        now = time.time()
+        for entry in entries:
+            timer, rounds = entry
+            if timer.isCancelled():
+                continue
+            if rounds > 0:
+                entry[1] -= 1
+                self._slots[self._position].append(entry)
+                continue
+
+            if timer.isRunning():
+                timer.skip()
+            else:
+                timer.start()
+                self._queue.put(timer)
+            self._insert(timer, timer.scheduleNext(now))
+
+    def _work(self):
+        while True:
+            timer = self._queue.get()
+            if timer is None:
+                break
+            try:
+                timer.run()
+            except:
+                self._log.exception('Timer %s failed.', timer.getName())
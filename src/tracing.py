@@ -0,0 +1,245 @@
+"""
+Sampled tracing of the processing of events.
+
+Each sampled event gets a trace whose spans are written, once the event is
+processed, as a line of OpenTelemetry (OTLP) JSON to a local file. The file can
+be loaded by any tool understanding the OTLP JSON file format.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class Span(object):
+    """
+    A timed operation in a trace.
+    """
+
+    def __init__(self, trace, name, parent=None, start=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.spanId = os.urandom(8).encode('hex')
+        self.parentId = parent and parent.spanId
+        self.start = start or time.time()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def finish(self, end=None, error=None):
+        self.end = end or time.time()
+        self.error = error
+
+    def toDict(self):
+        span = {
+            'traceId': self.trace.traceId,
+            'spanId': self.spanId,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(int(self.start * 1e9)),
+            'endTimeUnixNano': str(int((self.end or self.start) * 1e9)),
+            'attributes': [_attribute(k, v) for k, v in sorted(self.attributes.items())],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parentId:
+            span['parentSpanId'] = self.parentId
+        return span
+
+
+class Trace(object):
+    """
+    The spans recorded for a single event.
+    """
+
+    def __init__(self, name, start, attributes):
+        self.traceId = os.urandom(16).encode('hex')
+        self.root = None
+        self.spans = []
+        self.root = self.startSpan(name, None, start, attributes)
+        self._stack = [self.root]
+
+    def startSpan(self, name, parent=None, start=None, attributes=None):
+        span = Span(self, name, parent, start, attributes)
+        self.spans.append(span)
+        return span
+
+    def push(self, name, attributes=None):
+        """
+        Start a span, child of the current one, that becomes the current one.
+
+        @rtype: L{Span}
+        """
+        span = self.startSpan(name, self._stack[-1], attributes=attributes)
+        self._stack.append(span)
+        return span
+
+    def pop(self, error=None):
+        """
+        Finish the current span.
+        """
+        span = self._stack.pop()
+        span.finish(error=error)
+        return span
+
+
+class Tracer(object):
+    """
+    Samples events and exports their traces to a file.
+
+    The sampling decision is made from the event id so it costs a
+    multiplication per event. Traces are kept per thread, which lets the
+    instrumented Shotgun connections find the trace of the event they work
+    for.
+    """
+
+    MAX_PENDING = 10000
+
+    def __init__(self, path, sampleRate, serviceName, version):
+        """
+        @param path: The file the traces are appended to.
+        @type path: I{str}
+        @param sampleRate: The fraction of events traced, from 0 to 1.
+        @type sampleRate: I{float}
+        @param serviceName: The service name of the exported resource.
+        @type serviceName: I{str}
+        @param version: The version of the instrumentation scope.
+        @type version: I{str}
+        """
+        self._path = path
+        self._threshold = int(max(0.0, min(1.0, sampleRate)) * 10000)
+        self._serviceName = serviceName
+        self._version = version
+        self._pending = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def isSampled(self, eventId):
+        # Knuth's multiplicative hash spreads consecutive ids.
+        return (eventId * 2654435761) % 10000 < self._threshold
+
+    def recordFetch(self, key, eventId, start, end, attributes=None):
+        """
+        Start the trace of a sampled event with the request that fetched it.
+
+        @param key: A key unique to the event, site included.
+        @param eventId: The id of the event.
+        @type eventId: I{int}
+        @param start: When the request was sent.
+        @type start: I{float}
+        @param end: When the response was received.
+        @type end: I{float}
+        """
+        if not self.isSampled(eventId):
+            return
+
+        attributes = dict(attributes or {})
+        attributes['event.id'] = eventId
+        trace = Trace('event %d' % eventId, start, attributes)
+        fetch = trace.startSpan('fetch', trace.root, start, attributes)
+        fetch.finish(end)
+
+        self._lock.acquire()
+        try:
+            if len(self._pending) >= self.MAX_PENDING:
+                # Never dispatched, the oldest traces are dropped.
+                for oldKey in sorted(self._pending)[:self.MAX_PENDING / 10]:
+                    del(self._pending[oldKey])
+            self._pending[key] = trace
+        finally:
+            self._lock.release()
+
+    def startDispatch(self, key, attributes=None):
+        """
+        Make the trace of an event the current one of this thread.
+
+        @param key: The key the event was fetched with.
+
+        @return: The trace or None if the event is not sampled.
+        @rtype: L{Trace}
+        """
+        self._lock.acquire()
+        try:
+            trace = self._pending.pop(key, None)
+        finally:
+            self._lock.release()
+
+        if trace is not None:
+            now = time.time()
+            fetch = trace.spans[-1]
+            wait = trace.startSpan('wait', trace.root, fetch.end, attributes)
+            wait.finish(now)
+        self._local.trace = trace
+        return trace
+
+    def getCurrentTrace(self):
+        """
+        @return: The trace of the event processed by this thread, if sampled.
+        @rtype: L{Trace}
+        """
+        return getattr(self._local, 'trace', None)
+
+    def suspendDispatch(self):
+        """
+        Stop making the current trace the current one of this thread, the
+        event is dispatched again later.
+
+        @return: The trace or None if the event is not sampled.
+        @rtype: L{Trace}
+        """
+        trace = self.getCurrentTrace()
+        self._local.trace = None
+        return trace
+
+    def resumeDispatch(self, trace):
+        """
+        Make a suspended trace the current one of this thread.
+
+        @param trace: The trace returned by L{suspendDispatch}.
+        @type trace: L{Trace}
+        """
+        self._local.trace = trace
+
+    def finishDispatch(self):
+        """
+        Finish the current trace and export it.
+        """
+        trace = self.getCurrentTrace()
+        self._local.trace = None
+        if trace is None:
+            return
+
+        trace.root.finish()
+        self._export(trace)
+
+    def _export(self, trace):
+        request = {
+            'resourceSpans': [{
+                'resource': {'attributes': [_attribute('service.name', self._serviceName)]},
+                'scopeSpans': [{
+                    'scope': {'name': self._serviceName, 'version': self._version},
+                    'spans': [s.toDict() for s in trace.spans],
+                }],
+            }],
+        }
+        line = json.dumps(request, separators=(',', ':')) + '\n'
+
+        self._lock.acquire()
+        try:
+            fh = open(self._path, 'a')
+            try:
+                fh.write(line)
+            finally:
+                fh.close()
+        finally:
+            self._lock.release()
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    elif isinstance(value, (int, long)):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    elif isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
@@ -0,0 +1,228 @@
+"""
+Fixtures shared by the tests: a daemon configured in a temporary directory,
+talking to an in-memory Shotgun server.
+
+The tests needing the daemon module are skipped when shotgun_api3 is not
+installed, the requests are answered by L{FakeShotgun} either way.
+"""
+
+import datetime
+import logging
+import logging.handlers
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+try:
+    import shotgun_api3
+except ImportError:
+    shotgun_api3 = None
+
+if shotgun_api3 is not None:
+    import shotgunEventDaemon
+else:
+    shotgunEventDaemon = None
+
+
+requiresShotgun = unittest.skipIf(shotgun_api3 is None, 'shotgun_api3 is not installed')
+
+# What the callbacks of the test plugins were called with, the plugins import
+# this module to append to it.
+calls = []
+
+
+def makeEvent(eventId, eventType='Shotgun_Shot_Change', attributeName='sg_cut_in', entityId=1, created=None):
+    """
+    @return: An EventLogEntry as the daemon fetches it.
+    @rtype: I{dict}
+    """
+    if created is None:
+        created = datetime.datetime.now()
+    return {
+        'type': 'EventLogEntry',
+        'id': eventId,
+        'event_type': eventType,
+        'attribute_name': attributeName,
+        'meta': {'old_value': None, 'new_value': eventId},
+        'entity': {'type': 'Shot', 'id': entityId},
+        'user': {'type': 'HumanUser', 'id': 1, 'name': 'artist'},
+        'project': {'type': 'Project', 'id': 65},
+        'session_uuid': None,
+        'created_at': created,
+    }
+
+
+class FakeServer(object):
+    """
+    The events and entities of a site.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.entities = {}
+        self.requests = []
+
+    def addEvents(self, firstId, lastId, **kwargs):
+        self.events.extend([makeEvent(i, **kwargs) for i in range(firstId, lastId + 1)])
+
+
+class FakeShotgun(object):
+    """
+    A connection to the L{FakeServer} of the test, supporting the requests
+    the daemon makes.
+    """
+
+    server = None
+
+    def __init__(self, url, name, key, **kwargs):
+        self.script_name = name
+
+    def info(self):
+        return {'version': [8, 0, 0]}
+
+    def set_session_uuid(self, sessionUuid):
+        pass
+
+    def find(self, entityType, filters=None, fields=None, order=None, filter_operator=None, limit=0, **kwargs):
+        self.server.requests.append((self.script_name, entityType, filters))
+        if entityType == 'EventLogEntry':
+            records = self.server.events
+        else:
+            records = self.server.entities.get(entityType, [])
+
+        found = [dict(r) for r in records if all([_matches(r, f) for f in filters or []])]
+        if order and order[0]['direction'] == 'desc':
+            found.reverse()
+        if limit:
+            found = found[:limit]
+        return found
+
+    def find_one(self, entityType, filters=None, fields=None, order=None, **kwargs):
+        found = self.find(entityType, filters, fields, order, limit=1)
+        return found and found[0] or None
+
+    def update(self, entityType, entityId, data, **kwargs):
+        self.server.requests.append((self.script_name, 'update', entityType, entityId))
+
+
+def _matches(record, condition):
+    field, operator, value = condition[:3]
+    actual = record.get(field)
+    if operator == 'is':
+        return actual == value
+    if operator == 'greater_than':
+        return actual > value
+    if operator == 'less_than':
+        return actual < value
+    if operator == 'between':
+        return value[0] <= actual <= value[1]
+    if operator == 'in':
+        return actual in value
+    raise ValueError('Unsupported filter operator %s.' % operator)
+
+
+CONFIG = """
+[daemon]
+pidFile: %(dir)s/daemon.pid
+eventIdFile: %(dir)s/daemon.id
+logMode: 0
+logPath: %(dir)s
+logFile: daemon.log
+logging: 20
+fetch_interval: 0
+max_conn_retries: 2
+conn_retry_sleep: 1
+prefetch_depth: 0
+%(settings)s
+
+[shotgun]
+server: https://fake.shotgunstudio.com
+name: daemon
+key: key
+use_session_uuid: False
+
+[plugins]
+paths: %(pluginDir)s
+
+[emails]
+server:
+from:
+to:
+subject: shotgunEventDaemon
+"""
+
+
+class DaemonTestCase(unittest.TestCase):
+    """
+    Runs a daemon loading the I{PLUGINS} sources, configured with the
+    I{SETTINGS} lines of the [daemon] section.
+    """
+
+    PLUGINS = {}
+    SETTINGS = ''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pluginDir = os.path.join(self.dir, 'plugins')
+        os.mkdir(self.pluginDir)
+        for name, source in self.PLUGINS.items():
+            fh = open(os.path.join(self.pluginDir, name + '.py'), 'w')
+            fh.write(source)
+            fh.close()
+
+        self.configPath = os.path.join(self.dir, 'daemon.conf')
+        fh = open(self.configPath, 'w')
+        fh.write(CONFIG % {'dir': self.dir, 'pluginDir': self.pluginDir, 'settings': self.SETTINGS})
+        fh.close()
+
+        self.server = FakeServer()
+        FakeShotgun.server = self.server
+        self._shotgunClass = shotgunEventDaemon.sg.Shotgun
+        shotgunEventDaemon.sg.Shotgun = FakeShotgun
+        self.engine = None
+        del calls[:]
+
+    def tearDown(self):
+        if self.engine is not None:
+            for site in self.engine.getSites():
+                site.stop()
+            self.engine._pluginStores.close()
+        shotgunEventDaemon.sg.Shotgun = self._shotgunClass
+        rootLogger = logging.getLogger()
+        for handler in rootLogger.handlers[:]:
+            if isinstance(handler, logging.handlers.TimedRotatingFileHandler):
+                rootLogger.removeHandler(handler)
+                handler.close()
+        shutil.rmtree(self.dir)
+
+    def startEngine(self, state=None):
+        """
+        Create the engine and load the plugins, from a state of the plugins
+        in the pluginDir collection if given.
+
+        @param state: Plugin names to (last event id, backlog) tuples.
+        @type state: I{dict}
+
+        @return: The site of the engine.
+        @rtype: L{shotgunEventDaemon.Site}
+        """
+        if state is not None:
+            store = shotgunEventDaemon.stateStore.getStateStore('pickle', os.path.join(self.dir, 'daemon.id'))
+            store.save({self.pluginDir: state})
+            store.close()
+
+        self.engine = shotgunEventDaemon.Engine(self.configPath)
+        site = self.engine.getSites()[0]
+        site.loadPlugins()
+        site.loadEventIdData()
+        return site
+
+    def runPass(self, site):
+        site.fetchEvents()
+        site.processEvents()
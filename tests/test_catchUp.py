@@ -0,0 +1,55 @@
+import helpers
+from helpers import requiresShotgun
+
+
+BATCH_PLUGIN = """
+import time
+import helpers
+
+def registerCallbacks(reg):
+    reg.registerBatchCallback('script', 'key', record, batchSize=40)
+    reg.registerCallback('script', 'key', slow)
+
+def record(sg, logger, events, args):
+    helpers.calls.extend([e['id'] for e in events])
+
+def slow(sg, logger, event, args):
+    time.sleep(0.001)
+"""
+
+LIVE_PLUGIN = """
+def registerCallbacks(reg):
+    reg.registerCallback('script', 'key', ignore)
+
+def ignore(sg, logger, event, args):
+    pass
+"""
+
+
+@requiresShotgun
+class CatchUpTestCase(helpers.DaemonTestCase):
+    PLUGINS = {'late': BATCH_PLUGIN, 'live': LIVE_PLUGIN}
+    # The worker gets a few events per pass, pages and batches span passes.
+    SETTINGS = '\n'.join([
+        'catchup_threshold: 100',
+        'catchup_connections: 1',
+        'max_event_batch_size: 200',
+        'lane_time_slice: 0.02',
+    ])
+
+    def testLivePassesKeepCatchUpBatches(self):
+        self.server.addEvents(1, 1000)
+        site = self.startEngine({'late': (100, {}), 'live': (1000, {})})
+        late = [p for p in site.getPlugins() if p.getName() == 'late'][0]
+
+        for i in range(1000):
+            if i == 5:
+                # The live plugin gets events while the other catches up.
+                self.server.addEvents(1001, 1010)
+            self.runPass(site)
+            if not site.hasMoreEvents():
+                break
+
+        self.assertFalse(site.isCatchingUp(late))
+        self.assertEqual(late.getState()[0], 1010)
+        self.assertEqual(helpers.calls, range(101, 1011))
@@ -0,0 +1,41 @@
+import logging
+import threading
+import time
+import unittest
+
+import helpers  # Puts the src folder on the path.
+import connectionHealth
+
+
+# The opened circuit is logged as an error.
+LOG = logging.getLogger('test.connectionHealth')
+LOG.addHandler(logging.NullHandler())
+LOG.propagate = False
+
+
+class ConnectionHealthTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.health = connectionHealth.ConnectionHealth(LOG, failureThreshold=1, minDelay=60, maxDelay=60)
+
+    def testRequestsWaitWhileTheCircuitIsOpen(self):
+        self.health.recordFailure('down')
+        self.assertEqual(self.health.getState(), connectionHealth.ConnectionHealth.OPEN)
+
+        thread = threading.Thread(target=self.health.before)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.isAlive())
+
+        # Shutting down lets the waiting request through.
+        self.health.stop()
+        thread.join(5)
+        self.assertFalse(thread.isAlive())
+
+    def testNoWaitOnceStopped(self):
+        self.health.recordFailure('down')
+        self.health.stop()
+        start = time.time()
+        self.health.before()
+        self.assertTrue(time.time() - start < 1)
@@ -0,0 +1,65 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import helpers
+import eventHistory
+
+
+class EventHistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'history')
+        self.history = eventHistory.EventHistory(self.path, retention=0)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.dir)
+
+    def testEventsAreReadBackAsSaved(self):
+        created = datetime.datetime(2020, 1, 1, 12, 30, 15, 250)
+        event = helpers.makeEvent(1, created=created)
+        event['description'] = 'Caf\xc3\xa9 lighting'
+        event['meta']['new_value'] = datetime.date(2020, 2, 1)
+        self.history.add([event])
+
+        found = self.history.find()
+        self.assertEqual(found, [event])
+        self.assertTrue(isinstance(found[0]['event_type'], str))
+        self.assertTrue(isinstance(found[0]['created_at'], datetime.datetime))
+
+    def testEventsAreSavedAsJson(self):
+        self.history.add([helpers.makeEvent(1, created=datetime.datetime(2020, 1, 1))])
+        conn = sqlite3.connect(self.path)
+        try:
+            data = conn.execute('SELECT data FROM events').fetchone()[0]
+        finally:
+            conn.close()
+        self.assertTrue('"created_at":{"__datetime__":"2020-01-01T00:00:00"}' in data)
+
+    def testUtcOffsetsAreKept(self):
+        created = datetime.datetime(2020, 1, 1, 12, 0, tzinfo=eventHistory._FixedOffset(-300))
+        self.history.add([helpers.makeEvent(1, created=created)])
+        found = self.history.find()[0]['created_at']
+        self.assertEqual(found, created)
+        self.assertEqual(found.utcoffset(), datetime.timedelta(hours=-5))
+
+    def testPickledEventsOfEarlierVersionsAreDropped(self):
+        self.history.close()
+        os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE events (id INTEGER PRIMARY KEY, event_type TEXT, entity_type TEXT,'
+                     ' entity_id INTEGER, project_id INTEGER, user_type TEXT, user_id INTEGER,'
+                     ' attribute_name TEXT, created REAL, data BLOB NOT NULL)')
+        conn.execute("INSERT INTO events (id, data) VALUES (1, X'80027d71012e')")
+        conn.commit()
+        conn.close()
+
+        self.history = eventHistory.EventHistory(self.path, retention=0)
+        self.assertEqual(self.history.find(), [])
+        self.history.add([helpers.makeEvent(2)])
+        self.assertEqual([e['id'] for e in self.history.find()], [2])
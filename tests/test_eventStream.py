@@ -0,0 +1,52 @@
+import unittest
+
+import helpers
+import eventStream
+
+
+class ChannelFindTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = eventStream.Channel(3)
+
+    def publish(self, *eventIds):
+        self.channel.publish([helpers.makeEvent(i) for i in eventIds])
+
+    def readIds(self, position):
+        entries, position = self.channel.read(position, 0)
+        return [e[0] for e in entries]
+
+    def testNextEventsWithoutAnId(self):
+        self.publish(1, 2)
+        position = self.channel.find()
+        self.publish(3)
+        self.assertEqual(self.readIds(position), [3])
+
+    def testResumeFromAKeptEvent(self):
+        self.publish(1, 2, 3)
+        self.assertEqual(self.readIds(self.channel.find(1)), [2, 3])
+
+    def testResumeRightBeforeTheOldestEvent(self):
+        self.publish(5, 6, 7)
+        self.assertEqual(self.readIds(self.channel.find(4)), [5, 6, 7])
+
+    def testResumeBeforeTheOldestEventIsRefused(self):
+        self.publish(5, 6, 7)
+        self.assertRaises(eventStream.EventStreamError, self.channel.find, 3)
+
+    def testResumeFromADroppedEvent(self):
+        # Event 1 is dropped, the ids have a hole between 1 and 5.
+        self.publish(1, 5, 6, 7)
+        self.assertEqual(self.readIds(self.channel.find(1)), [5, 6, 7])
+        self.assertEqual(self.readIds(self.channel.find(3)), [5, 6, 7])
+
+    def testResumeBeforeADroppedEventIsRefused(self):
+        self.publish(2, 5, 6, 7)
+        self.assertRaises(eventStream.EventStreamError, self.channel.find, 1)
+
+    def testEventsFoundLateAreServed(self):
+        # The gap resolver found event 4 after 5 was published.
+        self.publish(3, 5, 4)
+        self.assertEqual(self.readIds(self.channel.find(3)), [5, 4])
+        # A subscriber that got event 4 got 5 before it.
+        self.assertEqual(self.readIds(self.channel.find(4)), [])
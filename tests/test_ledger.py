@@ -0,0 +1,62 @@
+import os
+
+import helpers
+from helpers import requiresShotgun
+
+
+PLUGIN = """
+import helpers
+
+def registerCallbacks(reg):
+    reg.registerCallback('script', 'key', notify, args='first', idempotent=False)
+    reg.registerCallback('script', 'key', notify, args='second', idempotent=False)
+    reg.registerCallback('script', 'key', Notifier(), args='instance', idempotent=False)
+
+def notify(sg, logger, event, args):
+    helpers.calls.append((args, event['id']))
+
+class Notifier(object):
+    def __call__(self, sg, logger, event, args):
+        helpers.calls.append((args, event['id']))
+"""
+
+
+@requiresShotgun
+class LedgerTestCase(helpers.DaemonTestCase):
+    PLUGINS = {'notify': PLUGIN}
+    # The state is only saved every 100 events, the ledger covers the rest.
+    SETTINGS = 'checkpoint_events: 100'
+
+    def testLedgerKeys(self):
+        self.server.addEvents(1, 1)
+        site = self.startEngine({'notify': (1, {})})
+        keys = [c.getLedgerKey() for c in site.getPlugins()[0]]
+        self.assertEqual(keys, ['notify', 'notify#2', 'Notifier'])
+
+    def testRegistrationsOfTheSameFunctionAllRun(self):
+        self.server.addEvents(1, 3)
+        site = self.startEngine({'notify': (1, {})})
+        self.runPass(site)
+        self.assertEqual(sorted(helpers.calls), [
+            ('first', 2), ('first', 3),
+            ('instance', 2), ('instance', 3),
+            ('second', 2), ('second', 3),
+        ])
+
+    def testCompletedEventsAreSkippedAfterACrash(self):
+        self.server.addEvents(1, 3)
+        site = self.startEngine({'notify': (1, {})})
+        # The process crashes before saving the state.
+        site.saveEventIdData = lambda: None
+        self.runPass(site)
+        self.assertEqual(len(helpers.calls), 6)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'daemon.id.ledger')))
+
+        # A new process, with callable instances of a new id, reads the
+        # ledger left behind by the crashed one.
+        site.stop()
+        self.engine._pluginStores.close()
+        del helpers.calls[:]
+        site = self.startEngine()
+        self.runPass(site)
+        self.assertEqual(helpers.calls, [])
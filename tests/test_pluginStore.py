@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import helpers  # Puts the src folder on the path.
+import pluginStore
+
+
+class StoreRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'stores')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _load(self, namespace):
+        registry = pluginStore.StoreRegistry(self.path)
+        try:
+            return dict([(k, registry.getStore(namespace)[k]) for k in registry.getStore(namespace).keys()])
+        finally:
+            registry.close()
+
+    def testFlush(self):
+        registry = pluginStore.StoreRegistry(self.path)
+        store = registry.getStore('plugin')
+        store['a'] = 1
+        store['b'] = [2]
+        registry.flush()
+        del store['a']
+        registry.flush()
+        registry.close()
+
+        self.assertEqual(self._load('plugin'), {'b': [2]})
+
+    def testChangesAreKeptWhenTheSaveFails(self):
+        registry = pluginStore.StoreRegistry(self.path)
+        store = registry.getStore('plugin')
+        store['kept'] = 1
+        # Can't be pickled, the whole flush of the store fails.
+        store['broken'] = lambda: None
+        self.assertRaises(pluginStore.StoreError, registry.flush)
+
+        store['broken'] = 2
+        registry.flush()
+        registry.close()
+
+        self.assertEqual(self._load('plugin'), {'kept': 1, 'broken': 2})
+
+    def testOpenError(self):
+        path = os.path.join(self.dir, 'missing', 'stores')
+        self.assertRaises(pluginStore.StoreError, pluginStore.StoreRegistry, path)
@@ -0,0 +1,60 @@
+import helpers
+from helpers import requiresShotgun
+
+
+PLUGIN = """
+import helpers
+
+def registerCallbacks(reg):
+    reg.registerCallback('script', 'key', cut, prefetch={'Shot': ['code']})
+    reg.registerCallback('script', 'key', other, predicates={'project': 66}, prefetch={'Shot': ['sg_status_list']})
+
+def cut(sg, logger, event, args):
+    helpers.calls.append((event['id'], event.get('entity_data', 'missing')))
+
+def other(sg, logger, event, args):
+    pass
+"""
+
+
+@requiresShotgun
+class PrefetchTestCase(helpers.DaemonTestCase):
+    PLUGINS = {'cut': PLUGIN}
+
+    def setUp(self):
+        helpers.DaemonTestCase.setUp(self)
+        self.server.entities['Shot'] = [{'type': 'Shot', 'id': 1, 'code': 'sh010'}]
+        self.server.addEvents(1, 2)
+        self.site = self.startEngine({'cut': (1, {})})
+        self.events = [helpers.makeEvent(2)]
+
+    def _prefetch(self):
+        del self.server.requests[:]
+        self.site.prefetchEntities(self.events, self.site.getPlugins())
+
+    def testEntitiesAreSetOnTheEvents(self):
+        self.runPass(self.site)
+        self.assertEqual(helpers.calls, [(2, {'type': 'Shot', 'id': 1, 'code': 'sh010'})])
+
+    def testOnlyTheRoutedCallbacksArePrefetchedFor(self):
+        fields = []
+        find = self.site._sg.find
+
+        def recordingFind(entityType, filters, fields_):
+            fields.append(fields_)
+            return find(entityType, filters, fields_)
+        self.site._sg.find = recordingFind
+
+        self._prefetch()
+        # The event of project 65 is not routed to the callback of project 66.
+        self.assertEqual(fields, [['code']])
+
+    def testFailedRequestsClearTheEntities(self):
+        self._prefetch()
+        self.assertEqual(self.events[0]['entity_data']['code'], 'sh010')
+
+        def failingFind(*args, **kwargs):
+            raise helpers.shotgunEventDaemon.sg.ProtocolError('host', 503, 'unavailable', {})
+        self.site._sg.find = failingFind
+        self._prefetch()
+        self.assertFalse('entity_data' in self.events[0])
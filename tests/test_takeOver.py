@@ -0,0 +1,23 @@
+import subprocess
+import sys
+
+import helpers
+from helpers import requiresShotgun
+
+
+@requiresShotgun
+class WaitForPreviousTestCase(helpers.DaemonTestCase):
+
+    def testGivesUpOnAProcessThatDoesNotExit(self):
+        self.server.addEvents(1, 1)
+        self.startEngine()
+        # A daemon stuck in a request, ignoring the stop signal.
+        process = subprocess.Popen([sys.executable, '-c', 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); print; time.sleep(30)'], stdout=subprocess.PIPE)
+        try:
+            process.stdout.readline()
+            self.engine._handoffPid = process.pid
+            self.engine.EXIT_TIMEOUT = 1
+            self.assertRaises(helpers.shotgunEventDaemon.control.ControlError, self.engine._waitForPrevious)
+        finally:
+            process.kill()
+            process.wait()